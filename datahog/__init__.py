@@ -2,6 +2,7 @@
 
 from __future__ import absolute_import
 
-from .api import alias, name, node, prop, relationship
+from . import record
+from .api import alias, bulk, export, name, node, prop, purge, relationship
 from .const import *
 from .pool import *
@@ -5,12 +5,13 @@ from __future__ import absolute_import
 import hashlib
 import hmac
 
-from .. import error
-from ..const import table, util
+from .. import error, record
+from ..const import codec, table, util
 from ..db import query, txn
 
 
-__all__ = ['set', 'lookup', 'list', 'batch', 'set_flags', 'shift', 'remove']
+__all__ = ['set', 'lookup', 'list', 'iter', 'batch', 'set_flags', 'shift',
+        'remove']
 
 
 def set(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
@@ -66,7 +67,7 @@ def set(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
     if util.ctx_tbl(ctx) != table.ALIAS:
         raise error.BadContext(ctx)
 
-    flags = util.flags_to_int(ctx, flags or [])
+    flags = codec.get(ctx).flags_to_int(flags or [])
 
     return txn.set_alias(pool, base_id, ctx, value, flags, index, timeout)
 
@@ -88,19 +89,20 @@ def lookup(pool, value, ctx, timeout=None):
 
     :returns:
         an alias dict (containing ``base_id``, ``ctx``, ``value``, and
-        ``flags`` keys), or None if there is no alias for the given
+        ``flags`` keys), or an :class:`Alias <datahog.record.Alias>` record
+        from a ``compact`` pool, or None if there is no alias for the given
         ``ctx/value``
     '''
     digest = hmac.new(pool.digestkey, value.encode('utf8'),
             hashlib.sha1).digest()
     result = txn.lookup_alias(pool, digest, ctx, timeout)
 
-    if result is not None:
-        # we selected on alias_lookup, which doesn't store the value
-        result['value'] = value
-        result['flags'] = util.int_to_flags(ctx, result['flags'])
+    if result is None:
+        return None
 
-    return result
+    # we selected on alias_lookup, which doesn't store the value
+    return record.maker(pool, record.Alias)(result['base_id'], ctx, value,
+            codec.get(ctx).int_to_flags(result['flags']))
 
 
 def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
@@ -117,8 +119,8 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
     :param int limit: maximum number of aliases to return
 
     :param int start:
-        an integer representing the index in the list of aliases from which to
-        start the results
+        ``0`` to start at the beginning of the list of aliases, or a position
+        returned by a previous call to pick up from there
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -126,20 +128,55 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :returns:
         two-tuple with a list of alias dicts (containing ``base_id``, ``ctx``,
-        ``value``, and ``flags`` keys), and an integer position that can be
-        used as ``start`` in a subsequent call to page forward from after the
-        end of this result list.
+        ``value``, and ``flags`` keys) or, from a ``compact`` pool,
+        :class:`Alias <datahog.record.Alias>` records, and an integer position
+        that can be used as ``start`` in a subsequent call to page forward
+        from after the end of this result list.
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
-        results = query.select_aliases(
-                conn.cursor(), base_id, ctx, limit, start)
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
+        rows = query.select_aliases(conn.cursor(), base_id, ctx, limit, start)
+
+    make = record.maker(pool, record.Alias)
+    int_to_flags = codec.get(ctx).int_to_flags
+    results = [make(base_id, ctx, value.decode('utf8'), int_to_flags(flags))
+            for flags, value, pos in rows]
+
+    return results, rows[-1][2] + 1 if rows else 0
+
+
+def iter(pool, base_id, ctx, start=0, fetch_size=1000):
+    '''iterate over all the aliases of a id object for a given context
+
+    unlike :func:`list`, this reads through a server-side cursor, fetching
+    ``fetch_size`` aliases per round trip, and holds a single connection
+    until the generator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent object
 
-    pos = -1
-    for result in results:
-        result['flags'] = util.int_to_flags(ctx, result['flags'])
-        pos = result.pop('pos')
+    :param int ctx: the alias's context
 
-    return results, pos + 1
+    :param int start:
+        ``0`` to start at the beginning of the list of aliases, or a position
+        returned by a previous call to pick up from there
+
+    :param int fetch_size: the number of aliases to fetch at a time
+
+    :returns:
+        a generator of alias dicts (containing ``base_id``, ``ctx``,
+        ``value``, and ``flags`` keys), or of :class:`Alias
+        <datahog.record.Alias>` records from a ``compact`` pool
+    '''
+    make = record.maker(pool, record.Alias)
+    int_to_flags = codec.get(ctx).int_to_flags
+    with pool.get_by_id(base_id, replica=True) as conn:
+        for flags, value, pos in query.iter_aliases(
+                conn.cursor('datahog_iter_aliases'),
+                base_id, ctx, start, fetch_size):
+            yield make(base_id, ctx, value.decode('utf8'), int_to_flags(flags))
 
 
 def batch(pool, bid_ctx_pairs, timeout=None):
@@ -151,7 +188,8 @@ def batch(pool, bid_ctx_pairs, timeout=None):
 
     :param list bid_ctx_pairs:
         a list of two-tuples each containing base_id and ctx. the first alias
-        for each base_id/ctx will come up in the results
+        for each base_id/ctx will come up in the results. the shards holding
+        these base_ids are queried concurrently.
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -160,7 +198,9 @@ def batch(pool, bid_ctx_pairs, timeout=None):
     :returns:
         a list of the same length as bid_ctx_pairs. if there exists one or more
         alias for each base_id/ctx combination, then the first one (as a dict
-        with ``base_id``, ``ctx``, ``flags``, and ``value`` keys) shows up in
+        with ``base_id``, ``ctx``, ``flags``, and ``value`` keys, or an
+        :class:`Alias <datahog.record.Alias>` record from a ``compact`` pool)
+        shows up in
         the result list in the same position as the corresponding pair in
         ``bid_ctx_pairs``. if not, then that position is occupied by ``None``.
     '''
@@ -169,21 +209,15 @@ def batch(pool, bid_ctx_pairs, timeout=None):
     for bid, ctx in bid_ctx_pairs:
         groups.setdefault(pool.shard_by_id(bid), []).append((bid, ctx))
 
-    if timeout is not None:
-        deadline = time.time() + timeout
-
-    aliases = []
-    for shard, group in groups.iteritems():
-        with pool.get_by_shard(shard, timeout=timeout) as conn:
-            aliases.extend(query.select_alias_batch(conn.cursor(), group))
-
-        if timeout is not None:
-            timeout = deadline - time.time()
+    jobs = [(shard, (group,)) for shard, group in groups.iteritems()]
 
+    make = record.maker(pool, record.Alias)
     results = [None] * len(bid_ctx_pairs)
-    for al in aliases:
-        al['flags'] = util.int_to_flags(al['ctx'], al['flags'])
-        results[order[(al['base_id'], al['ctx'])]] = al
+    for aliases in txn.fanout(
+            pool, jobs, query.select_alias_batch, timeout, replica=True):
+        for base_id, flags, ctx, value in aliases:
+            results[order[(base_id, ctx)]] = make(
+                    base_id, ctx, value, codec.get(ctx).int_to_flags(flags))
 
     return results
 
@@ -228,8 +262,8 @@ def set_flags(pool, base_id, ctx, value, add, clear, timeout=None):
     if util.ctx_tbl(ctx) != table.ALIAS:
         raise error.BadContext(ctx)
 
-    add = util.flags_to_int(ctx, add)
-    clear = util.flags_to_int(ctx, clear)
+    add = codec.get(ctx).flags_to_int(add)
+    clear = codec.get(ctx).flags_to_int(clear)
 
     result = txn.set_alias_flags(
             pool, base_id, ctx, value, add, clear, timeout)
@@ -237,7 +271,7 @@ def set_flags(pool, base_id, ctx, value, add, clear, timeout=None):
     if result is None:
         return None
 
-    return util.int_to_flags(ctx, result)
+    return codec.get(ctx).int_to_flags(result)
 
 
 def shift(pool, base_id, ctx, value, index, timeout=None):
@@ -0,0 +1,224 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import hashlib
+import hmac
+import json
+
+import psycopg2
+
+from .. import error
+from ..const import codec, storage, table, util
+from ..db import txn
+
+
+__all__ = ['load', 'read_jsonl']
+
+
+def load(pool, records, batch_size=10000, timeout=None):
+    '''load a stream of nodes, properties, aliases and names in bulk
+
+    records are grouped into batches, and each batch is routed to the shards
+    and loaded there with ``COPY`` into staging tables and a few set-based
+    inserts, with all the shards in a batch loading concurrently.
+
+    each record is a dict with a ``type`` (one of ``'node'``, ``'prop'``,
+    ``'alias'`` or ``'name'``), a ``ctx``, a ``value`` and optionally a list
+    of ``flags``. the parent object is given as either a ``base_id``, or as
+    a ``base`` naming the ``ref`` of a node record earlier in the stream.
+    nodes without a parent are root nodes.
+
+    this skips, rather than raises on, records that the single-object API
+    calls would refuse: those whose parent doesn't exist, properties that
+    are already set, names already present on their parent, and aliases
+    claimed by any object. these are left out of the counts returned.
+
+    loads are not atomic across shards or batches. a load that fails part
+    way through should be cleaned up rather than retried, as retried nodes
+    would be created again.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param iterable records: the record dicts to load
+
+    :param int batch_size: the number of records to load at a time
+
+    :param timeout:
+        maximum time in seconds allowed for each step of loading a batch; the
+        default of ``None`` means no limit
+
+    :returns:
+        a two-tuple of a dict mapping the node ``ref``\\s to their new ids
+        (``None`` for nodes that weren't loaded), and a dict of the counts
+        of objects loaded (keyed by record ``type``)
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if a record's ``ctx`` isn't registered for the table its ``type``
+        calls for, or has no node ``base_ctx`` where one is needed
+
+    :raises BadFlag:
+        if a record has a flag not registered for its ``ctx``
+
+    :raises StorageClassError:
+        if a value doesn't match its context's storage class
+
+    :raises ValueError:
+        for a record of an unknown ``type``, or one whose ``base`` names a
+        ``ref`` that hasn't been seen yet
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    refs = {}
+    counts = dict.fromkeys(_TABLES, 0)
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            _load_batch(pool, batch, refs, counts, timeout)
+            batch = []
+    if batch:
+        _load_batch(pool, batch, refs, counts, timeout)
+
+    return refs, counts
+
+
+def read_jsonl(fp):
+    '''parse records for :func:`load` from a file of JSON lines
+
+    JSON has no byte strings, so values for ``STR`` storage contexts are
+    encoded as utf8.
+    '''
+    for line in fp:
+        line = line.strip()
+        if not line:
+            continue
+
+        record = json.loads(line)
+        if (isinstance(record.get('value'), unicode)
+                and util.ctx_tbl(record.get('ctx')) is not None
+                and util.ctx_storage(record['ctx']) == storage.STR):
+            record['value'] = record['value'].encode('utf8')
+        yield record
+
+
+_TABLES = {
+    'node': table.NODE,
+    'prop': table.PROPERTY,
+    'alias': table.ALIAS,
+    'name': table.NAME,
+}
+
+
+def _load_batch(pool, batch, refs, counts, timeout):
+    records = []
+    shards = {}
+
+    # route the nodes first; a child always goes to its parent's shard
+    for seq, record in enumerate(batch):
+        tbl = _TABLES.get(record.get('type'))
+        if tbl is None:
+            raise ValueError("unknown record type: %r" % record.get('type'))
+
+        ctx = record['ctx']
+        base_ctx = util.ctx_base_ctx(ctx)
+        if util.ctx_tbl(ctx) != tbl or (
+                base_ctx is None and tbl != table.NODE) or (
+                base_ctx is not None and util.ctx_tbl(base_ctx) != table.NODE):
+            raise error.BadContext(ctx)
+
+        if 'base' in record:
+            if record['base'] in shards:
+                base_id, shard = None, shards[record['base']]
+            elif record['base'] in refs:
+                base_id = refs[record['base']]
+                if base_id is None:
+                    # the parent wasn't loaded, so this can't be either
+                    continue
+                shard = pool.shard_by_id(base_id)
+            else:
+                raise ValueError("unknown base ref: %r" % record['base'])
+        else:
+            base_id = record.get('base_id')
+            if base_id is not None:
+                shard = pool.shard_by_id(base_id)
+            elif tbl == table.NODE and base_ctx is None:
+                shard = pool.shard_for_root_insert()
+            else:
+                raise error.MissingParent()
+
+        if tbl == table.NODE and 'ref' in record:
+            shards[record['ref']] = shard
+
+        records.append((seq, record, tbl, ctx, base_ctx, base_id, shard))
+
+    wanted = {}
+    for seq, record, tbl, ctx, base_ctx, base_id, shard in records:
+        if tbl == table.NODE:
+            wanted[shard] = wanted.get(shard, 0) + 1
+    ids = dict((shard, iter(allocated)) for shard, allocated in
+            txn.allocate_node_ids(pool, wanted, timeout).iteritems())
+
+    nodes, props, aliases, names = {}, {}, {}, {}
+    new_refs = {}
+    for seq, record, tbl, ctx, base_ctx, base_id, shard in records:
+        if base_id is None and 'base' in record:
+            base_id = new_refs.get(record['base'], refs.get(record['base']))
+
+        conv = codec.get(ctx)
+        flags = conv.flags_to_int(record.get('flags') or ())
+
+        if tbl == table.NODE:
+            node_id = next(ids[shard])
+            if 'ref' in record:
+                new_refs[record['ref']] = node_id
+            num, value = _num_value(conv, record.get('value'))
+            nodes.setdefault(shard, []).append(
+                    (seq, node_id, ctx, flags, num, value, base_id, base_ctx))
+
+        elif tbl == table.PROPERTY:
+            num, value = _num_value(conv, record.get('value'))
+            props.setdefault(shard, []).append(
+                    (seq, base_id, base_ctx, ctx, flags, num, value))
+
+        elif tbl == table.ALIAS:
+            value = record['value']
+            digest = hmac.new(pool.digestkey, value.encode('utf8'),
+                    hashlib.sha1).digest()
+            candidates = pool.shards_for_lookup_hash(digest)
+            aliases.setdefault(shard, []).append((
+                (seq, base_id, base_ctx, ctx, value, flags),
+                candidates[0],
+                (seq, psycopg2.Binary(digest), ctx, base_id, flags),
+                candidates[1:]))
+
+        else:
+            if util.ctx_search(ctx) is None:
+                raise error.BadContext(ctx)
+            names.setdefault(shard, []).append(
+                    (seq, base_id, base_ctx, ctx, record['value'], flags))
+
+    node_ids, prop_count, name_count, alias_count = txn.bulk_load(
+            pool, nodes, props, aliases, names, timeout)
+
+    loaded = set(node_ids)
+    for ref, node_id in new_refs.iteritems():
+        refs[ref] = node_id if node_id in loaded else None
+
+    counts['node'] += len(node_ids)
+    counts['prop'] += prop_count
+    counts['alias'] += alias_count
+    counts['name'] += name_count
+
+
+def _num_value(conv, value):
+    value = conv.wrap(value)
+    if conv.storage == storage.INT:
+        return value, None
+    return None, value
@@ -0,0 +1,287 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import struct
+import sys
+import zlib
+
+import mummy
+
+from ..const import codec, context, storage, table
+from ..db import query
+
+
+__all__ = ['dump', 'read', 'records']
+
+
+MAGIC = 'DHOGSNAP'
+VERSION = 1
+
+# dumped in this order on every shard, so bases come before what's on them
+_TABLES = [table.NODE, table.PROPERTY, table.ALIAS, table.NAME,
+        table.RELATIONSHIP]
+
+_length = struct.Struct('>I')
+
+
+def dump(pool, fp, chunk_size=5000, replica=True):
+    '''write a snapshot of every live object in the cluster to a file
+
+    each shard is read concurrently through server-side cursors, so no
+    shard's full result set is ever held in memory. removed objects are left
+    out, and values are decoded through their context's storage class.
+
+    every table on a shard is read in one ``repeatable read`` transaction, so
+    what's dumped from a shard is consistent as of a single moment. the
+    shards are read independently though, and aren't consistent with each
+    other: an object moved or removed during the dump can show up on both
+    shards involved, or on neither.
+
+    relationships are in the snapshot, but :func:`records` can't produce
+    them for a re-import; restore them with :func:`datahog.relationship.create`
+    from :func:`read`'s rows.
+
+    the snapshot starts with the registered context metadata, followed by
+    zlib-compressed chunks of up to ``chunk_size`` rows of a single table.
+    use :func:`read` or :func:`records` to get them back out.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param file fp: a file opened for writing in binary mode
+
+    :param int chunk_size: the most rows to put in a single chunk
+
+    :param bool replica:
+        whether to read from the shards' replicas, where there are any
+
+    :returns: a dict of the number of rows written, by table name
+
+    :raises BadContext:
+        if a row's ctx isn't registered in this process
+    '''
+    fp.write(MAGIC)
+    _write_chunk(fp, {'version': VERSION, 'contexts': _contexts()})
+
+    shards = [s['shard'] for s in pool._dbconf['shards']]
+    out = pool._q()
+    stopped = []
+    for shard in shards:
+        pool._background(lambda shard=shard: _dump_shard(
+            pool, shard, chunk_size, replica, out, stopped))
+
+    counts = dict((table.NAMES[tbl], 0) for tbl in _TABLES)
+    failure = None
+    remaining = len(shards)
+    while remaining:
+        item = out.get()
+        if item[0] == 'done':
+            remaining -= 1
+        elif item[0] == 'failed':
+            failure = failure or item[1]
+            stopped.append(True)
+        else:
+            tag, tbl, count, data, ev = item
+            if failure is None:
+                fp.write(data)
+                counts[table.NAMES[tbl]] += count
+            ev.set()
+
+    if failure is not None:
+        klass, exc, tb = failure
+        raise klass, exc, tb
+
+    _write_chunk(fp, {'counts': counts})
+    return counts
+
+
+def read(fp):
+    '''read a snapshot written by :func:`dump`
+
+    :returns:
+        a two-tuple of the snapshot's context metadata (a dict mapping each
+        ctx to its table and meta dict) and an iterator over the ``(table,
+        row)`` pairs in the snapshot. the rows are tuples of:
+
+        - nodes: ``(id, ctx, flags, value, base_id)``
+        - properties, aliases and names: ``(base_id, ctx, flags, value)``
+        - relationships: ``(base_id, ctx, flags, rel_id)``
+
+        ``flags`` are left as bitmap integers.
+
+    :raises ValueError: if the file isn't a snapshot, or is truncated
+    '''
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a datahog snapshot")
+
+    header = _read_chunk(fp)
+    if header is None or header.get('version') != VERSION:
+        raise ValueError("unsupported snapshot version")
+
+    return header['contexts'], _read_rows(fp)
+
+
+def records(fp):
+    '''read a snapshot as records for :func:`datahog.bulk.load`
+
+    node ids are used as the ``ref``\\s. records whose parent isn't in the
+    snapshot are dropped, and any that come ahead of their parent are held
+    back until it has been seen.
+
+    relationships aren't produced, as the bulk loader doesn't handle them, so
+    these records alone don't restore a whole snapshot (see :func:`dump`).
+    the contexts and flags must be registered in this process.
+    '''
+    contexts, rows = read(fp)
+
+    seen = set()
+    waiting = {}
+    for tbl, row in rows:
+        if tbl == table.RELATIONSHIP:
+            continue
+
+        if tbl == table.NODE:
+            node_id, ctx, flags, value, base_id = row
+            record = {'type': 'node', 'ref': node_id}
+        else:
+            base_id, ctx, flags, value = row
+            record = {'type': _RECORD_TYPES[tbl]}
+
+        record['ctx'] = ctx
+        record['value'] = value
+        record['flags'] = sorted(codec.get(ctx).int_to_flags(flags))
+
+        if base_id is not None:
+            record['base'] = base_id
+            if base_id not in seen:
+                waiting.setdefault(base_id, []).append(record)
+                continue
+
+        for ready in _release(record, seen, waiting):
+            yield ready
+
+
+_RECORD_TYPES = {
+    table.PROPERTY: 'prop',
+    table.ALIAS: 'alias',
+    table.NAME: 'name',
+}
+
+
+def _release(record, seen, waiting):
+    # a record, and everything that was waiting on it (if it's a node)
+    ready = [record]
+    while ready:
+        record = ready.pop()
+        yield record
+        if record['type'] == 'node':
+            seen.add(record['ref'])
+            ready.extend(reversed(waiting.pop(record['ref'], ())))
+
+
+def _contexts():
+    contexts = {}
+    for ctx, (tbl, meta) in context.META.iteritems():
+        meta = dict(meta or ())
+        if 'schema' in meta:
+            meta['schema'] = meta['schema'].SCHEMA
+        contexts[ctx] = (tbl, meta)
+    return contexts
+
+
+def _dump_shard(pool, shard, chunk_size, replica, out, stopped):
+    try:
+        with pool.get_by_shard(shard, replica=replica) as conn:
+            query.set_snapshot(conn.cursor())
+            for tbl in _TABLES:
+                cursor = conn.cursor('datahog_dump_%s' % table.NAMES[tbl])
+                query.select_live_rows(cursor, tbl)
+
+                while not stopped:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    # hold off on the next chunk until this one is written
+                    ev = pool._ev()
+                    out.put(('chunk', tbl, len(rows),
+                        _encode_chunk((tbl, _decode(tbl, rows))), ev))
+                    ev.wait()
+
+                cursor.close()
+    except Exception:
+        out.put(('failed', sys.exc_info()))
+    finally:
+        out.put(('done',))
+
+
+def _decode(tbl, rows):
+    get = codec.get
+
+    if tbl == table.NODE:
+        return [(node_id, ctx, flags, _value(get(ctx), num, value), base_id)
+                for node_id, ctx, flags, num, value, base_id in rows]
+
+    if tbl == table.PROPERTY:
+        return [(base_id, ctx, flags, _value(get(ctx), num, value))
+                for base_id, ctx, flags, num, value in rows]
+
+    if tbl == table.RELATIONSHIP:
+        return [tuple(row) for row in rows]
+
+    # aliases and names
+    return [(base_id, ctx, flags, _text(value))
+            for base_id, ctx, flags, value in rows]
+
+
+def _value(conv, num, value):
+    if conv.storage == storage.INT:
+        return num
+    if value is None:
+        return None
+    return conv.unwrap(value)
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf8')
+    return value
+
+
+def _encode_chunk(payload):
+    data = zlib.compress(mummy.dumps(payload))
+    return _length.pack(len(data)) + data
+
+
+def _write_chunk(fp, payload):
+    fp.write(_encode_chunk(payload))
+
+
+def _read_chunk(fp):
+    head = fp.read(_length.size)
+    if not head:
+        return None
+    if len(head) < _length.size:
+        raise ValueError("truncated snapshot")
+
+    length, = _length.unpack(head)
+    data = fp.read(length)
+    if len(data) < length:
+        raise ValueError("truncated snapshot")
+    return mummy.loads(zlib.decompress(data))
+
+
+def _read_rows(fp):
+    while 1:
+        chunk = _read_chunk(fp)
+        if chunk is None:
+            raise ValueError("truncated snapshot")
+        if isinstance(chunk, dict):
+            # the trailer
+            return
+
+        tbl, rows = chunk
+        for row in rows:
+            yield tbl, tuple(row)
@@ -2,12 +2,13 @@
 
 from __future__ import absolute_import
 
-from .. import error
-from ..const import search as searchconst, table, util
+from .. import error, record
+from ..const import codec, search as searchconst, table, util
 from ..db import query, txn
 
 
-__all__ = ['create', 'search', 'list', 'set_flags', 'shift', 'remove']
+__all__ = ['create', 'search', 'list', 'iter', 'set_flags', 'shift',
+        'remove']
 
 
 def create(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
@@ -54,7 +55,7 @@ def create(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
     if util.ctx_tbl(ctx) != table.NAME:
         raise error.BadContext(ctx)
 
-    flags = util.flags_to_int(ctx, flags or [])
+    flags = codec.get(ctx).flags_to_int(flags or [])
 
     return txn.create_name(pool, base_id, ctx, value, flags, index, timeout)
 
@@ -84,8 +85,9 @@ def search(pool, value, ctx, limit=100, start=None, timeout=None):
 
     :returns:
         a two-tuple with a list of name dicts (each containing ``base_id``,
-        ``ctx``, ``value``, and ``flags`` keys), and a ``page_token`` that can
-        be used as the value of ``start`` in subsequent calls to continue
+        ``ctx``, ``value``, and ``flags`` keys) or, from a ``compact`` pool,
+        :class:`Name <datahog.record.Name>` records, and a ``page_token`` that
+        can be used as the value of ``start`` in subsequent calls to continue
         paging from the end of this result list. the result list will be in
         sorted order of the string name values.
     '''
@@ -94,10 +96,8 @@ def search(pool, value, ctx, limit=100, start=None, timeout=None):
 
     results, token = txn.search_names(pool, value, ctx, limit, start, timeout)
 
-    for result in results:
-        result['flags'] = util.int_to_flags(ctx, result['flags'])
-
-    return results, token
+    return [record.from_dict(pool, record.Name, r)
+            for r in codec.decode_rows(results, value=False)], token
 
 
 def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
@@ -114,8 +114,8 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
     :param int limit: maximum number of names to return
 
     :param int start:
-        an integer representing the index in the list of aliases from which
-        to start the results
+        ``0`` to start at the beginning of the list of names, or a position
+        returned by a previous call to pick up from there
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -123,19 +123,55 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :returns:
         a two-tuple with a list of name dicts (each containing ``base_id``,
-        ``ctx``, ``value``, and ``flags`` keys) and a ``page_token`` that can
-        be used as the value of ``start`` in subsequent calls, to continue
+        ``ctx``, ``value``, and ``flags`` keys) or, from a ``compact`` pool,
+        :class:`Name <datahog.record.Name>` records, and a ``page_token`` that
+        can be used as the value of ``start`` in subsequent calls, to continue
         paging from the end of this result list
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
-        results = query.select_names(conn.cursor(), base_id, ctx, limit, start)
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
+        rows = query.select_names(conn.cursor(), base_id, ctx, limit, start)
+
+    make = record.maker(pool, record.Name)
+    int_to_flags = codec.get(ctx).int_to_flags
+    results = [make(base_id, ctx, value, int_to_flags(flags))
+            for flags, value, pos in rows]
+
+    return results, rows[-1][2] + 1 if rows else 0
+
+
+def iter(pool, base_id, ctx, start=0, fetch_size=1000):
+    '''iterate over all the names under a id object for a given context
 
-    pos = -1
-    for result in results:
-        result['flags'] = util.int_to_flags(ctx, result['flags'])
-        pos = result.pop('pos')
+    unlike :func:`list`, this reads through a server-side cursor, fetching
+    ``fetch_size`` names per round trip, and holds a single connection until
+    the generator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
 
-    return results, pos + 1
+    :param int base_id: id of the parent object
+
+    :param int ctx: context of the names to list
+
+    :param int start:
+        ``0`` to start at the beginning of the list of names, or a position
+        returned by a previous call to pick up from there
+
+    :param int fetch_size: the number of names to fetch at a time
+
+    :returns:
+        a generator of name dicts (each containing ``base_id``, ``ctx``,
+        ``value``, and ``flags`` keys), or of :class:`Name
+        <datahog.record.Name>` records from a ``compact`` pool
+    '''
+    make = record.maker(pool, record.Name)
+    int_to_flags = codec.get(ctx).int_to_flags
+    with pool.get_by_id(base_id, replica=True) as conn:
+        for flags, value, pos in query.iter_names(
+                conn.cursor('datahog_iter_names'),
+                base_id, ctx, start, fetch_size):
+            yield make(base_id, ctx, value, int_to_flags(flags))
 
 
 def set_flags(pool, base_id, ctx, value, add, clear, timeout=None):
@@ -178,15 +214,15 @@ def set_flags(pool, base_id, ctx, value, add, clear, timeout=None):
     if util.ctx_tbl(ctx) != table.NAME:
         raise error.BadContext(ctx)
 
-    add = util.flags_to_int(ctx, add)
-    clear = util.flags_to_int(ctx, clear)
+    add = codec.get(ctx).flags_to_int(add)
+    clear = codec.get(ctx).flags_to_int(clear)
 
     result = txn.set_name_flags(pool, base_id, ctx, value, add, clear, timeout)
 
     if result is None:
         return None
 
-    return util.int_to_flags(ctx, result)
+    return codec.get(ctx).int_to_flags(result)
 
 
 def shift(pool, base_id, ctx, value, index, timeout=None):
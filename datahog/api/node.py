@@ -4,14 +4,14 @@ from __future__ import absolute_import
 
 import time
 
-from .. import error
-from ..const import context, storage, table, util
+from .. import error, record
+from ..const import codec, context, storage, table, util
 from ..db import query, txn
 
 
 __all__ = ['create', 'get', 'batch_get', 'child_of', 'list_children',
-        'get_children', 'update', 'increment', 'set_flags', 'move',
-        'shift', 'remove']
+        'get_children', 'iter_child_ids', 'iter_children', 'update',
+        'increment', 'set_flags', 'move', 'shift', 'remove']
 
 
 _missing = object()
@@ -44,6 +44,8 @@ def create(pool, ctx, value, base_id=None, index=None, flags=None, timeout=None)
 
     :returns:
         a node dict, containing keys ``id``, ``ctx``, ``value``, ``flags``
+        (or a :class:`Node <datahog.record.Node>` record from a ``compact``
+        pool)
 
     :raises ReadOnly: if the provided pool is read-only
 
@@ -71,18 +73,17 @@ def create(pool, ctx, value, base_id=None, index=None, flags=None, timeout=None)
     if base_ctx is not None and base_id is None:
         raise error.MissingParent()
 
-    flags = util.flags_to_int(ctx, flags or [])
-    value = util.storage_wrap(ctx, value)
+    flags = codec.get(ctx).flags_to_int(flags or [])
+    value = codec.get(ctx).wrap(value)
 
     node = txn.create_node(pool, base_id, ctx, value, index, flags, timeout)
 
     if node is None:
         raise error.NoObject("node<%d/%r>" % (base_ctx, base_id))
 
-    node['flags'] = util.int_to_flags(ctx, node['flags'])
-    node['value'] = util.storage_unwrap(ctx, node['value'])
-
-    return node
+    conv = codec.get(ctx)
+    return record.maker(pool, record.Node)(node['id'], ctx,
+            conv.unwrap(node['value']), conv.int_to_flags(node['flags']))
 
 
 def get(pool, node_id, ctx, timeout=None):
@@ -102,7 +103,8 @@ def get(pool, node_id, ctx, timeout=None):
 
     :returns:
         a node dict (contains ``id``, ``ctx``, ``value``, and ``flags``
-        keys), or ``None`` if there is no such node
+        keys), or a :class:`Node <datahog.record.Node>` record from a
+        ``compact`` pool, or ``None`` if there is no such node
 
     :raises BadContext:
         if ``ctx`` isn't a registered context for ``table.NODE``, or
@@ -113,16 +115,16 @@ def get(pool, node_id, ctx, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(node_id, timeout=timeout) as conn:
-        node = query.select_node(conn.cursor(), node_id, ctx)
+    with pool.get_by_id(node_id, timeout=timeout, replica=True) as conn:
+        row = query.select_node(conn.cursor(), node_id, ctx)
 
-    if node is None:
+    if row is None:
         return None
 
-    node['flags'] = util.int_to_flags(ctx, node['flags'])
-    node['value'] = util.storage_unwrap(ctx, node['value'])
-
-    return node
+    flags, value = row
+    conv = codec.get(ctx)
+    return record.maker(pool, record.Node)(
+            node_id, ctx, conv.unwrap(value), conv.int_to_flags(flags))
 
 
 def batch_get(pool, nid_ctx_pairs, timeout=None):
@@ -133,7 +135,8 @@ def batch_get(pool, nid_ctx_pairs, timeout=None):
         getting a database connection
 
     :param list nid_ctx_pairs:
-        list of ``(id, ctx)`` tuples describing the nodes to fetch
+        list of ``(id, ctx)`` tuples describing the nodes to fetch. the shards
+        holding these nodes are queried concurrently.
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -141,7 +144,8 @@ def batch_get(pool, nid_ctx_pairs, timeout=None):
 
     :returns:
         a list of node dicts containing ``id``, ``ctx``, ``value`` and
-        ``flags`` keys. any ``(id, ctx)`` pairs from ``nid_ctx_pairs`` for
+        ``flags`` keys (:class:`Node <datahog.record.Node>` records from a
+        ``compact`` pool). any ``(id, ctx)`` pairs from ``nid_ctx_pairs`` for
         which no node could be found, a None will be in that position in the
         results list
     '''
@@ -150,23 +154,17 @@ def batch_get(pool, nid_ctx_pairs, timeout=None):
     for nid, ctx in nid_ctx_pairs:
         groups.setdefault(pool.shard_by_id(nid), []).append((nid, ctx))
 
-    if timeout is not None:
-        deadline = time.time() + timeout
-
-    nodes = []
-    for shard, group in groups.iteritems():
-        with pool.get_by_shard(shard, timeout=timeout) as conn:
-            nodes.extend(
-                    query.select_nodes(conn.cursor(), group))
-
-        if timeout is not None:
-            timeout = deadline - time.time()
+    jobs = [(shard, (group,)) for shard, group in groups.iteritems()]
 
+    make = record.maker(pool, record.Node)
     results = [None] * len(nid_ctx_pairs)
-    for node in nodes:
-        node['flags'] = util.int_to_flags(node['ctx'], node['flags'])
-        node['value'] = util.storage_unwrap(node['ctx'], node['value'])
-        results[order[node['id']]] = node
+    for nodes in txn.fanout(
+            pool, jobs, query.select_nodes, timeout, replica=True):
+        for nid, ctx, flags, num, value in nodes:
+            conv = codec.get(ctx)
+            results[order[nid]] = make(nid, ctx, conv.unwrap(
+                    num if conv.storage == storage.INT else value),
+                conv.int_to_flags(flags))
 
     return results
 
@@ -199,7 +197,7 @@ def child_of(pool, node_id, ctx, base_id, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
         return query.select_edge_exists(
                 conn.cursor(), node_id, ctx, base_id)
 
@@ -218,8 +216,8 @@ def list_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     :param int limit: maximum number of nodes to return
 
     :param int start:
-        an integer representing the index in the list of nodes from which to
-        start the results
+        ``0`` to start at the beginning of the list of nodes, or a position
+        returned by a previous call to pick up from there
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -239,7 +237,7 @@ def list_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
         results = query.select_node_ids(
                 conn.cursor(), base_id, limit, start, ctx)
 
@@ -262,8 +260,8 @@ def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     :param int limit: maximum number of nodes to return
 
     :param int start:
-        an integer representing the index in the list of nodes from which to
-        start the results
+        ``0`` to start at the beginning of the list of nodes, or a position
+        returned by a previous call to pick up from there
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -271,7 +269,9 @@ def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :returns:
         two tuple with a list of node dicts (each containing ``id``, ``ctx``,
-        ``value`` and ``flags`` keys), and an integer that can be used as
+        ``value`` and ``flags`` keys) or, from a ``compact`` pool,
+        :class:`Node <datahog.record.Node>` records, and an integer that can
+        be used as
         ``start`` in subsequent ``get_children`` calls to pick up paging after
         this result list
 
@@ -285,13 +285,95 @@ def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     nids, pos = list_children(pool, base_id, ctx, limit, start, timeout)
 
     if timeout is not None:
-        timeout = deadline - time.time()
+        timeout = max(deadline - time.time(), 0)
 
     nodes = batch_get(pool, [(nid, ctx) for nid in nids], timeout)
 
     return [node for node in nodes if node is not None], pos
 
 
+def iter_child_ids(pool, base_id, ctx, start=0, fetch_size=1000):
+    '''iterate over the ids of all the nodes under a common parent
+
+    unlike :func:`list_children`, this reads through a server-side cursor,
+    fetching ``fetch_size`` ids per round trip, and holds a single connection
+    until the generator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent node
+
+    :param int ctx: context of the nodes
+
+    :param int start:
+        ``0`` to start at the beginning of the list of nodes, or a position
+        returned by a previous call to pick up from there
+
+    :param int fetch_size: the number of ids to fetch at a time
+
+    :returns: a generator of the child nodes' ids
+
+    :raises BadContext:
+        if ``ctx`` isn't a registered context for ``table.NODE``, or
+        doesn't have both a ``base_ctx`` and ``storage`` configured
+    '''
+    if (util.ctx_tbl(ctx) != table.NODE
+            or util.ctx_base_ctx(ctx) is None
+            or util.ctx_storage(ctx) is None):
+        raise error.BadContext(ctx)
+
+    with pool.get_by_id(base_id, replica=True) as conn:
+        for child_id, ctx, pos in query.iter_node_ids(
+                conn.cursor('datahog_iter_node_ids'),
+                base_id, ctx, start, fetch_size):
+            yield child_id
+
+
+def iter_children(pool, base_id, ctx, start=0, fetch_size=1000):
+    '''iterate over all the nodes under a common parent
+
+    the ids are read a page of ``fetch_size`` at a time as with
+    :func:`list_children`, and each page's nodes fetched with
+    :func:`batch_get`. no connection is held between pages, nor while the
+    nodes are fetched, so this never waits on a connection it holds itself.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent node
+
+    :param int ctx: context of the nodes
+
+    :param int start:
+        ``0`` to start at the beginning of the list of nodes, or a position
+        returned by a previous call to pick up from there
+
+    :param int fetch_size: the number of nodes to fetch at a time
+
+    :returns:
+        a generator of node dicts (each containing ``id``, ``ctx``, ``value``
+        and ``flags`` keys), or of :class:`Node <datahog.record.Node>` records
+        from a ``compact`` pool
+
+    :raises BadContext:
+        if ``ctx`` isn't a registered context for ``table.NODE``, or
+        doesn't have both a ``base_ctx`` and ``storage`` configured
+    '''
+    while 1:
+        nids, start = list_children(pool, base_id, ctx, fetch_size, start)
+
+        if nids:
+            for node in batch_get(pool, [(nid, ctx) for nid in nids]):
+                if node is not None:
+                    yield node
+
+        if len(nids) < fetch_size:
+            return
+
+
 def update(pool, node_id, ctx, value, old_value=_missing, timeout=None):
     '''overwrite the value stored in a node
 
@@ -331,13 +413,13 @@ def update(pool, node_id, ctx, value, old_value=_missing, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    value = util.storage_wrap(ctx, value)
+    value = codec.get(ctx).wrap(value)
 
     with pool.get_by_id(node_id, timeout=timeout) as conn:
         if old_value is _missing:
             return query.update_node(conn.cursor(), node_id, ctx, value)
         else:
-            old_value = util.storage_wrap(ctx, old_value)
+            old_value = codec.get(ctx).wrap(old_value)
             return query.update_node(
                     conn.cursor(), node_id, ctx, value, old_value)
 
@@ -423,8 +505,8 @@ def set_flags(pool, node_id, ctx, add, clear, timeout=None):
     if util.ctx_tbl(ctx) != table.NODE:
         raise error.BadContext(ctx)
 
-    add = util.flags_to_int(ctx, add)
-    clear = util.flags_to_int(ctx, clear)
+    add = codec.get(ctx).flags_to_int(add)
+    clear = codec.get(ctx).flags_to_int(clear)
 
     with pool.get_by_id(node_id, timeout=timeout) as conn:
         result = query.set_flags(conn.cursor(), 'node', add, clear,
@@ -433,7 +515,7 @@ def set_flags(pool, node_id, ctx, add, clear, timeout=None):
     if not result:
         return None
 
-    return util.int_to_flags(ctx, result[0])
+    return codec.get(ctx).int_to_flags(result[0])
 
 
 def shift(pool, node_id, ctx, base_id, index, timeout=None):
@@ -2,12 +2,13 @@
 
 from __future__ import absolute_import
 
-from .. import error
-from ..const import context, storage, table, util
+from .. import error, record
+from ..const import codec, context, storage, table, util
 from ..db import query, txn
 
 
-__all__ = ['set', 'get', 'get_list', 'increment', 'set_flags', 'remove']
+__all__ = ['set', 'get', 'get_list', 'get_many', 'get_lists', 'increment',
+        'set_flags', 'remove']
 
 
 _missing = object()
@@ -62,9 +63,9 @@ def set(pool, base_id, ctx, value, flags=None, timeout=None):
     if util.ctx_tbl(ctx) != table.PROPERTY or base_ctx is None:
         raise error.BadContext(ctx)
 
-    flags = util.flags_to_int(ctx, flags or [])
+    flags = codec.get(ctx).flags_to_int(flags or [])
 
-    value = util.storage_wrap(ctx, value)
+    value = codec.get(ctx).wrap(value)
 
     with pool.get_by_id(base_id, timeout=timeout) as conn:
         inserted, updated = txn.set_property(conn, base_id, ctx, value, flags)
@@ -93,8 +94,9 @@ def get(pool, base_id, ctx, timeout=None):
 
     :returns:
         property dict (containing ``base_id``, ``ctx``, ``flags``, and
-        ``value`` keys) or ``None`` if there is no property for the
-        ``base_id/ctx``
+        ``value`` keys), or a :class:`Property <datahog.record.Property>`
+        record from a ``compact`` pool, or ``None`` if there is no property
+        for the ``base_id/ctx``
 
     :raises BadContext:
         if ``ctx`` isn't a registered context associated with
@@ -103,17 +105,15 @@ def get(pool, base_id, ctx, timeout=None):
     if util.ctx_tbl(ctx) != table.PROPERTY or util.ctx_storage(ctx) is None:
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
         exists, value, flags = query.select_property(
                 conn.cursor(), base_id, ctx)
         if not exists:
             return None
-        return {
-            'base_id': base_id,
-            'ctx': ctx,
-            'flags': util.int_to_flags(ctx, flags),
-            'value': util.storage_unwrap(ctx, value),
-        }
+
+    conv = codec.get(ctx)
+    return record.maker(pool, record.Property)(
+            base_id, ctx, conv.unwrap(value), conv.int_to_flags(flags))
 
 
 def get_list(pool, base_id, ctx_list=None, timeout=None):
@@ -135,19 +135,126 @@ def get_list(pool, base_id, ctx_list=None, timeout=None):
 
     :returns:
         a list of the same length as ``ctx_list`` of property dicts (containing
-        ``base_id``, ``ctx``, ``flags``, and ``value`` keys) or ``None``s,
-        depending on whether the property exists for a given context.
+        ``base_id``, ``ctx``, ``flags``, and ``value`` keys, or
+        :class:`Property <datahog.record.Property>` records from a ``compact``
+        pool) or ``None``s, depending on whether the property exists for a
+        given context.
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
-        results = query.select_properties(conn.cursor(), base_id, ctx_list)
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
+        rows = query.select_properties(conn.cursor(), base_id, ctx_list)
+
+    results = [(ctx, prop) for _, ctx, prop
+            in _decode(pool, ((base_id,) + tuple(row) for row in rows))]
+
+    if ctx_list is None:
+        return [result for ctx, result in results]
+    return map(dict(results).get, ctx_list)
+
+
+def get_many(pool, pairs, timeout=None):
+    '''fetch properties of any number of parent objects at once
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param list pairs:
+        ``(base_id, ctx)`` tuples describing the properties to fetch. there is
+        one query for each shard holding any of the ``base_id``\\s, and the
+        shards are queried concurrently.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list of the same length as ``pairs`` of property dicts (containing
+        ``base_id``, ``ctx``, ``flags``, and ``value`` keys, or
+        :class:`Property <datahog.record.Property>` records from a ``compact``
+        pool) or ``None``s where
+        there is no property for the ``base_id/ctx``
+
+    :raises BadContext:
+        if any ``ctx`` isn't a registered context associated with
+        ``table.PROPERTY``, or it doesn't have a configured ``storage``
+    '''
+    order = {}
+    groups = {}
+    for i, (base_id, ctx) in enumerate(pairs):
+        if (base_id, ctx) not in order:
+            _check_ctx(ctx)
+            groups.setdefault(pool.shard_by_id(base_id), []).append(
+                    (base_id, ctx))
+        order.setdefault((base_id, ctx), []).append(i)
+
+    jobs = [(shard, (group,)) for shard, group in groups.iteritems()]
+
+    results = [None] * len(pairs)
+    for rows in txn.fanout(
+            pool, jobs, query.select_property_batch, timeout, replica=True):
+        for base_id, ctx, prop in _decode(pool, rows):
+            for i in order[(base_id, ctx)]:
+                results[i] = prop
 
-    for r in results:
-        if r is not None:
-            r['flags'] = util.int_to_flags(r['ctx'], r['flags'])
-         
     return results
 
 
+def get_lists(pool, base_ids, ctx_list=None, timeout=None):
+    '''fetch the properties under many base_ids for a list of contexts
+
+    this is :func:`get_list` for any number of ``base_id``\\s, with one
+    query for each shard holding any of them and the shards queried
+    concurrently.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param list base_ids: the ids of the parent objects
+
+    :param ctx_list:
+        the contexts of the properties to fetch. can be a list of context ints,
+        or ``None`` (default) to fetch all contexts for each ``base_id``
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list of the same length as ``base_ids``, of what :func:`get_list`
+        would return for each of them
+
+    :raises BadContext:
+        if any context in ``ctx_list`` isn't a registered context associated
+        with ``table.PROPERTY``, or it doesn't have a configured ``storage``
+    '''
+    if ctx_list is not None:
+        ctx_list = list(ctx_list)
+        for ctx in ctx_list:
+            _check_ctx(ctx)
+
+    seen = {}
+    groups = {}
+    for base_id in base_ids:
+        if base_id not in seen:
+            seen[base_id] = True
+            groups.setdefault(pool.shard_by_id(base_id), []).append(base_id)
+
+    jobs = [(shard, (group, ctx_list)) for shard, group in groups.iteritems()]
+
+    found = {}
+    for rows in txn.fanout(
+            pool, jobs, query.select_properties_batch, timeout, replica=True):
+        for base_id, ctx, prop in _decode(pool, rows):
+            found.setdefault(base_id, []).append((ctx, prop))
+
+    if ctx_list is None:
+        return [[prop for ctx, prop in found.get(base_id, ())]
+                for base_id in base_ids]
+    return [map(dict(found.get(base_id, ())).get, ctx_list)
+            for base_id in base_ids]
+
+
 def increment(pool, base_id, ctx, by=1, limit=None, timeout=None):
     '''increment (or decrement) a numeric property's value
 
@@ -232,8 +339,8 @@ def set_flags(pool, base_id, ctx, add, clear, timeout=None):
     if util.ctx_tbl(ctx) != table.PROPERTY:
         raise error.BadContext(ctx)
 
-    add = util.flags_to_int(ctx, add)
-    clear = util.flags_to_int(ctx, clear)
+    add = codec.get(ctx).flags_to_int(add)
+    clear = codec.get(ctx).flags_to_int(clear)
 
     with pool.get_by_id(base_id, timeout=timeout) as conn:
         result = query.set_flags(
@@ -243,7 +350,7 @@ def set_flags(pool, base_id, ctx, add, clear, timeout=None):
     if not result:
         return None
 
-    return util.int_to_flags(ctx, result[0])
+    return codec.get(ctx).int_to_flags(result[0])
 
 
 def remove(pool, base_id, ctx, value=_missing, timeout=None):
@@ -276,5 +383,19 @@ def remove(pool, base_id, ctx, value=_missing, timeout=None):
         if value is _missing:
             return query.remove_property(conn.cursor(), base_id, ctx)
         else:
-            value = util.storage_wrap(ctx, value)
+            value = codec.get(ctx).wrap(value)
             return query.remove_property(conn.cursor(), base_id, ctx, value)
+
+
+def _check_ctx(ctx):
+    if util.ctx_tbl(ctx) != table.PROPERTY or util.ctx_storage(ctx) is None:
+        raise error.BadContext(ctx)
+
+
+def _decode(pool, rows):
+    make = record.maker(pool, record.Property)
+    for base_id, ctx, num, value, flags in rows:
+        conv = codec.get(ctx)
+        yield base_id, ctx, make(base_id, ctx, conv.unwrap(
+            num if conv.storage == storage.INT else value),
+            conv.int_to_flags(flags))
@@ -0,0 +1,152 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import Queue
+import sys
+
+from .. import error
+from ..db import query
+
+
+__all__ = ['purge', 'TABLES']
+
+
+# every table that removals leave rows behind in
+TABLES = ['property', 'alias', 'alias_lookup', 'relationship', 'node', 'edge',
+        'name', 'prefix_lookup', 'phonetic_lookup']
+
+
+def purge(pool, retention, batch_size=1000, pause=0, tables=None,
+        progress=None, timeout=None):
+    '''delete the rows of objects removed longer than ``retention`` ago
+
+    removing an object only marks its rows as removed, so they stay in the
+    tables (and take up space in every scan of them) until they're purged.
+    this deletes them for good, in batches of around ``batch_size`` rows,
+    oldest first. each batch is its own transaction on a freshly checked out
+    connection, so a purge holds no locks for long and can be stopped at any
+    point; running it again picks up where it left off.
+
+    the shards are purged concurrently, and each shard goes through
+    ``tables`` one at a time. schema migration 03 should be in place first,
+    otherwise every batch has to scan the whole table.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param retention:
+        how long in seconds a row must have been removed before it's purged
+
+    :param int batch_size:
+        the number of rows to delete in a single transaction (a batch may go
+        a little over this on partitioned tables)
+
+    :param pause:
+        seconds for each shard to wait between batches, to throttle the load
+        the purge puts on it
+
+    :param list tables:
+        the names of the tables to purge, from :data:`TABLES` (the default
+        is all of them)
+
+    :param progress:
+        called with ``(shard, table, purged)`` after each batch that deleted
+        anything, ``purged`` being the running count for that shard and
+        table. if it returns a true value the purge is stopped, once any
+        batches in flight on other shards have finished. a
+        ``KeyboardInterrupt`` stops it the same way, and is then re-raised.
+
+    :param timeout:
+        maximum time in seconds allowed for each batch; the default of
+        ``None`` means no limit
+
+    :returns: a dict of the number of rows purged, by table name
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises ValueError: for a table name that isn't in :data:`TABLES`
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if tables is None:
+        tables = TABLES
+    for name in tables:
+        if name not in TABLES:
+            raise ValueError("not a purgeable table: %r" % (name,))
+
+    shards = [s['shard'] for s in pool._dbconf['shards']]
+    out = pool._q()
+    stopped = []
+    for shard in shards:
+        pool._background(lambda shard=shard: _purge_shard(pool, shard,
+            tables, retention, batch_size, pause, timeout, out, stopped))
+
+    counts = dict.fromkeys(tables, 0)
+    failure = None
+    remaining = len(shards)
+    while remaining:
+        try:
+            # with a timeout, as python 2 doesn't deliver a KeyboardInterrupt
+            # to a thread blocked in a Queue.get() without one
+            item = out.get(True, 1)
+        except Queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            failure = failure or sys.exc_info()
+            stopped.append(True)
+            continue
+
+        if item[0] == 'done':
+            remaining -= 1
+        elif item[0] == 'failed':
+            failure = failure or item[1]
+            stopped.append(True)
+        else:
+            tag, shard, name, count, purged, ev = item
+            counts[name] += count
+            try:
+                if (progress is not None and not stopped
+                        and progress(shard, name, purged)):
+                    stopped.append(True)
+            except KeyboardInterrupt:
+                failure = failure or sys.exc_info()
+                stopped.append(True)
+            finally:
+                ev.set()
+
+    if failure is not None:
+        klass, exc, tb = failure
+        raise klass, exc, tb
+
+    return counts
+
+
+def _purge_shard(pool, shard, tables, retention, batch_size, pause, timeout,
+        out, stopped):
+    try:
+        for name in tables:
+            purged = 0
+            while not stopped:
+                with pool.get_by_shard(shard, timeout=timeout) as conn:
+                    count = query.purge_removed(
+                            conn.cursor(), name, retention, batch_size)
+
+                if count:
+                    # hold off on the next batch until it's been reported
+                    purged += count
+                    ev = pool._ev()
+                    out.put(('batch', shard, name, count, purged, ev))
+                    ev.wait()
+
+                if count < batch_size:
+                    break
+
+                if pause:
+                    pool._pause(pause * 1000)
+    except Exception:
+        out.put(('failed', sys.exc_info()))
+    finally:
+        out.put(('done',))
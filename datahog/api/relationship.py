@@ -2,12 +2,13 @@
 
 from __future__ import absolute_import
 
-from .. import error
-from ..const import table, util
+from .. import error, record
+from ..const import codec, table, util
 from ..db import query, txn
 
 
-__all__ = ['create', 'list', 'get', 'set_flags', 'shift', 'remove']
+__all__ = ['create', 'list', 'iter', 'get', 'get_many', 'set_flags', 'shift',
+        'remove']
 
 
 def create(pool, ctx, base_id, rel_id, forward_index=None, reverse_index=None,
@@ -68,7 +69,7 @@ def create(pool, ctx, base_id, rel_id, forward_index=None, reverse_index=None,
             or util.ctx_rel_ctx(ctx) is None):
         raise error.BadContext(ctx)
 
-    flags = util.flags_to_int(ctx, flags or [])
+    flags = codec.get(ctx).flags_to_int(flags or [])
 
     return txn.create_relationship_pair(pool, base_id, rel_id, ctx,
             forward_index, reverse_index, flags, timeout)
@@ -92,8 +93,8 @@ def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
     :param int limit: maximum number of relationships to return
 
     :param int start:
-        an integer representing the index in the list of relationships from
-        which to start the results
+        ``0`` to start at the beginning of the list of relationships, or a
+        position returned by a previous call to pick up from there
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -101,19 +102,67 @@ def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
 
     :returns:
         two-tuple with a list of relationship dicts (containing ``ctx``,
-        ``base_id``, ``rel_id``, and ``flags`` keys), and an integer position
-        that can be used as ``start`` in a subsequent call to page forward from
-        after the end of this result list.
+        ``base_id``, ``rel_id``, and ``flags`` keys) or, from a ``compact``
+        pool, :class:`Relationship <datahog.record.Relationship>` records, and
+        an integer position that can be used as ``start`` in a subsequent call
+        to page forward from after the end of this result list.
     '''
-    with pool.get_by_id(id, timeout=timeout) as conn:
-        results = query.select_relationships(conn.cursor(), id, ctx, forward, limit, start)
+    with pool.get_by_id(id, timeout=timeout, replica=True) as conn:
+        rows = query.select_relationships(
+                conn.cursor(), id, ctx, forward, limit, start)
 
-    pos = 0
-    for result in results:
-        result['flags'] = util.int_to_flags(ctx, result['flags'])
-        pos = result.pop('pos') + 1
+    make = record.maker(pool, record.Relationship)
+    int_to_flags = codec.get(ctx).int_to_flags
+    if forward:
+        results = [make(id, other_id, ctx, int_to_flags(flags))
+                for other_id, flags, pos in rows]
+    else:
+        results = [make(other_id, id, ctx, int_to_flags(flags))
+                for other_id, flags, pos in rows]
 
-    return results, pos
+    return results, rows[-1][2] + 1 if rows else 0
+
+
+def iter(pool, id, ctx, forward=True, start=0, fetch_size=1000):
+    '''iterate over all the relationships associated with a id object
+
+    unlike :func:`list`, this reads through a server-side cursor, fetching
+    ``fetch_size`` relationships per round trip, and holds a single
+    connection until the generator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int id: id of the parent object
+
+    :param int ctx: context of the relationships to fetch
+
+    :param bool forward:
+        if ``True``, then fetches relationships which have ``id`` as their
+        ``base_id``, otherwise ``id`` refers to ``rel_id``
+
+    :param int start:
+        ``0`` to start at the beginning of the list of relationships, or a
+        position returned by a previous call to pick up from there
+
+    :param int fetch_size: the number of relationships to fetch at a time
+
+    :returns:
+        a generator of relationship dicts (containing ``ctx``, ``base_id``,
+        ``rel_id``, and ``flags`` keys), or of :class:`Relationship
+        <datahog.record.Relationship>` records from a ``compact`` pool
+    '''
+    make = record.maker(pool, record.Relationship)
+    int_to_flags = codec.get(ctx).int_to_flags
+    with pool.get_by_id(id, replica=True) as conn:
+        for other_id, flags, pos in query.iter_relationships(
+                conn.cursor('datahog_iter_relationships'),
+                id, ctx, forward, start, fetch_size):
+            if forward:
+                yield make(id, other_id, ctx, int_to_flags(flags))
+            else:
+                yield make(other_id, id, ctx, int_to_flags(flags))
 
 
 def get(pool, ctx, base_id, rel_id, timeout=None):
@@ -135,18 +184,69 @@ def get(pool, ctx, base_id, rel_id, timeout=None):
 
     :returns:
         a relationship dict (with ``ctx``, ``base_id``, ``rel_id``, and
-        ``flags`` keys) or None if there is no such relationship
+        ``flags`` keys), or a :class:`Relationship
+        <datahog.record.Relationship>` record from a ``compact`` pool, or None
+        if there is no such relationship
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, replica=True) as conn:
         rels = query.select_relationships(
                 conn.cursor(), base_id, ctx, True, 1, 0, rel_id)
 
-    rel = rels[0] if rels else None
-    if rel:
-        rel['flags'] = util.int_to_flags(ctx, rel['flags'])
-        rel.pop('pos')
+    if not rels:
+        return None
+
+    return record.maker(pool, record.Relationship)(
+            base_id, rel_id, ctx, codec.get(ctx).int_to_flags(rels[0][1]))
 
-    return rel
+
+def get_many(pool, triples, timeout=None):
+    '''fetch any number of relationships at once
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param list triples:
+        ``(ctx, base_id, rel_id)`` tuples describing the relationships to
+        fetch. there is one query for each shard holding any of the
+        ``base_id``\\s, and the shards are queried concurrently.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a two-tuple of lists of the same length as ``triples``. the first
+        has relationship dicts (with ``ctx``, ``base_id``, ``rel_id``, and
+        ``flags`` keys) or, from a ``compact`` pool, :class:`Relationship
+        <datahog.record.Relationship>` records, or ``None``\\s where there is
+        no such relationship.
+        the second has the relationships' positions in their ``base_id``'s
+        list (usable as the ``start`` for :func:`list`), or ``None``\\s.
+    '''
+    order = {}
+    groups = {}
+    for i, (ctx, base_id, rel_id) in enumerate(triples):
+        key = (base_id, ctx, rel_id)
+        if key not in order:
+            groups.setdefault(pool.shard_by_id(base_id), []).append(key)
+        order.setdefault(key, []).append(i)
+
+    jobs = [(shard, (group,)) for shard, group in groups.iteritems()]
+
+    make = record.maker(pool, record.Relationship)
+    results = [None] * len(triples)
+    positions = [None] * len(triples)
+    for rows in txn.fanout(pool, jobs, query.select_relationship_batch,
+            timeout, replica=True):
+        for base_id, ctx, rel_id, flags, pos in rows:
+            rel = make(base_id, rel_id, ctx,
+                    codec.get(ctx).int_to_flags(flags))
+            for i in order[(base_id, ctx, rel_id)]:
+                results[i] = rel
+                positions[i] = pos
+
+    return results, positions
 
 
 def set_flags(pool, base_id, rel_id, ctx, add, clear, timeout=None):
@@ -189,8 +289,8 @@ def set_flags(pool, base_id, rel_id, ctx, add, clear, timeout=None):
     if util.ctx_tbl(ctx) != table.RELATIONSHIP:
         raise error.BadContext(ctx)
 
-    add = util.flags_to_int(ctx, add)
-    clear = util.flags_to_int(ctx, clear)
+    add = codec.get(ctx).flags_to_int(add)
+    clear = codec.get(ctx).flags_to_int(clear)
 
     result = txn.set_relationship_flags(
             pool, base_id, rel_id, ctx, add, clear, timeout)
@@ -198,7 +298,7 @@ def set_flags(pool, base_id, rel_id, ctx, add, clear, timeout=None):
     if result is None:
         return None
 
-    return util.int_to_flags(ctx, result)
+    return codec.get(ctx).int_to_flags(result)
 
 
 def shift(pool, base_id, rel_id, ctx, forward, index, timeout=None):
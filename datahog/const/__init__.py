@@ -2,7 +2,7 @@
 
 from __future__ import absolute_import
 
-from . import context, flag, search, storage, table
+from . import codec, context, flag, search, storage, table
 from .table import *
 
 
@@ -0,0 +1,174 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import mummy
+import psycopg2
+
+from . import context, flag, storage
+from .. import error
+
+
+__all__ = ['Codec', 'get', 'decode_rows']
+
+
+_codecs = {}
+
+_Binary = type(psycopg2.Binary(''))
+
+
+class Codec(object):
+    '''value and flags conversion for a single context
+
+    these are built when the context (or one of its flags) is registered, so
+    the storage class, schema and flag bits are all worked out up front. they
+    are immutable; registering a flag replaces the context's codec.
+    '''
+    __slots__ = ['ctx', 'storage', 'schema', 'wrap', 'unwrap', '_bits',
+            '_meta', '_flag_set']
+
+    def __init__(self, ctx):
+        if ctx not in context.META:
+            raise error.BadContext(ctx)
+        meta = context.META[ctx]
+        flag_set = flag.META.get(ctx)
+        st = (meta[1] or {}).get('storage', storage.NULL)
+        schema = (meta[1] or {}).get('schema')
+
+        init = super(Codec, self).__setattr__
+        init('ctx', ctx)
+        init('storage', st)
+        init('schema', schema)
+        init('wrap', _wrapper(ctx, st, schema))
+        init('unwrap', _unwrapper(st, schema))
+        init('_bits', dict((f, 1 << (f - 1)) for f in flag_set or ()))
+        init('_meta', meta)
+        init('_flag_set', flag_set)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("codecs are immutable")
+
+    def flags_to_int(self, flag_list):
+        "convert an iterable of flag consts to a single bitmap integer"
+        bits = self._bits
+        num = 0
+        for i in flag_list:
+            if i not in bits:
+                raise error.BadFlag(i, self.ctx)
+            num |= bits[i]
+        return num
+
+    def int_to_flags(self, flag_num):
+        "convert a flags bitmap int to a set of flag consts"
+        return set(f for f, bit in self._bits.iteritems() if flag_num & bit)
+
+
+def get(ctx):
+    '''the :class:`Codec` for a context
+
+    :raises BadContext: if ``ctx`` isn't a registered context
+    '''
+    codec = _codecs.get(ctx)
+    if (codec is None or codec._meta is not context.META.get(ctx)
+            or codec._flag_set is not flag.META.get(ctx)):
+        # the META dicts were cleared or replaced behind our back
+        codec = _build(ctx)
+    return codec
+
+
+def decode_rows(rows, value=True):
+    '''convert the raw ``flags`` (and ``value``) of a list of row dicts
+
+    rows are converted in place, and may be of mixed contexts. ``None``
+    entries are skipped.
+    '''
+    codecs = {}
+    for row in rows:
+        if row is None:
+            continue
+        ctx = row['ctx']
+        codec = codecs.get(ctx)
+        if codec is None:
+            codec = codecs[ctx] = get(ctx)
+        row['flags'] = codec.int_to_flags(row['flags'])
+        if value:
+            row['value'] = codec.unwrap(row['value'])
+    return rows
+
+
+def _build(ctx):
+    codec = _codecs[ctx] = Codec(ctx)
+    return codec
+
+context.add_hook(_build)
+flag.add_hook(lambda value, ctx: _build(ctx))
+
+
+def _wrapper(ctx, st, schema):
+    if st == storage.NULL:
+        def wrap(value):
+            if value is not None:
+                raise error.StorageClassError("NULL requires None")
+            return None
+
+    elif st == storage.INT:
+        def wrap(value):
+            if not isinstance(value, (int, long)):
+                raise error.StorageClassError("INT requires int or long")
+            return value
+
+    elif st == storage.STR:
+        def wrap(value):
+            if not isinstance(value, str):
+                raise error.StorageClassError("STR requires str")
+            return psycopg2.Binary(value)
+
+    elif st == storage.UTF:
+        def wrap(value):
+            if not isinstance(value, unicode):
+                raise error.StorageClassError("UTF storage requires unicode")
+            return psycopg2.Binary(value.encode("utf8"))
+
+    elif st == storage.SERIAL and schema:
+        def wrap(value):
+            msg = schema(value)
+            try:
+                return psycopg2.Binary(msg.dumps())
+            except schema.InvalidMessage:
+                raise error.StorageClassError(
+                        "SERIAL schema validation failed", msg.message)
+
+    elif st == storage.SERIAL:
+        def wrap(value):
+            try:
+                return psycopg2.Binary(mummy.dumps(value))
+            except TypeError:
+                raise error.StorageClassError(
+                    "SERIAL requires a serializable value")
+
+    else:
+        def wrap(value):
+            raise error.BadContext(ctx)
+
+    return wrap
+
+
+def _raw(value):
+    if isinstance(value, _Binary):
+        value = value.adapted
+    if isinstance(value, buffer):
+        value = str(value)
+    return value
+
+
+def _unwrapper(st, schema):
+    if st == storage.UTF:
+        return lambda value: _raw(value).decode("utf8")
+
+    if st == storage.SERIAL and schema:
+        return lambda value: schema.untransform(mummy.loads(_raw(value)))
+
+    if st == storage.SERIAL:
+        return lambda value: mummy.loads(_raw(value))
+
+    return _raw
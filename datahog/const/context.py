@@ -9,6 +9,16 @@ from . import search, storage, table
 
 META = {}
 
+_hooks = []
+
+
+def add_hook(func):
+    '''register ``func(value)`` to be called whenever a context is set
+
+    this lets modules precompute anything that depends on context metadata.
+    '''
+    _hooks.append(func)
+
 
 def set_context(value, tbl, meta=None):
     '''create a constant for use in 'ctx'
@@ -87,4 +97,7 @@ def set_context(value, tbl, meta=None):
 
     META[value] = (tbl, meta)
 
+    for hook in _hooks:
+        hook(value)
+
     return value
@@ -6,6 +6,14 @@ from . import context
 
 META = {}
 
+_hooks = []
+
+
+def add_hook(func):
+    '''register ``func(value, ctx)`` to be called whenever a flag is set
+    '''
+    _hooks.append(func)
+
 
 def set_flag(value, ctx):
     '''create a constant for use in flags
@@ -26,4 +34,8 @@ def set_flag(value, ctx):
         raise ValueError("unrecognized context const: %r" % ctx)
 
     META.setdefault(ctx, set()).add(value)
+
+    for hook in _hooks:
+        hook(value, ctx)
+
     return value
@@ -2,11 +2,7 @@
 
 from __future__ import absolute_import
 
-import mummy
-import psycopg2
-
-from . import context, flag, storage, table
-from .. import error
+from . import codec, context, storage, table
 
 
 def ctx_tbl(ctx):
@@ -88,101 +84,20 @@ def ctx_phonetic_loose(ctx):
 
 def flags_to_int(ctx, flag_list):
     "convert an iterable of flag consts to a single bitmap integer"
-    if ctx not in context.META:
-        raise error.BadContext(ctx)
-
-    num = 0
-    for i in flag_list:
-        if i not in flag.META.get(ctx, ()):
-            raise error.BadFlag(i, ctx)
-        num |= (1 << (i - 1))
-    return num
+    return codec.get(ctx).flags_to_int(flag_list)
 
 
 def int_to_flags(ctx, flag_num):
     "convert a flags bitmap int to a set of flag consts"
-    if ctx not in context.META:
-        raise error.BadContext(ctx)
-
-    meta = flag.META.get(ctx, {})
-    flag_set = set()
-    i = 1
-    while flag_num:
-        if flag_num & 1 and i in meta:
-            flag_set.add(i)
-        flag_num >>= 1
-        i += 1
-    return flag_set
+    return codec.get(ctx).int_to_flags(flag_num)
 
 
 def storage_wrap(ctx, value):
-    st = ctx_storage(ctx)
-
-    if st == storage.NULL:
-        if value is not None:
-            raise error.StorageClassError("NULL requires None")
-        return None
-
-    if st == storage.INT:
-        if not isinstance(value, (int, long)):
-            raise error.StorageClassError("INT requires int or long")
-        return value
-
-    if st == storage.STR:
-        if not isinstance(value, str):
-            raise error.StorageClassError("STR requires str")
-        return psycopg2.Binary(value)
-
-    if st == storage.UTF:
-        if not isinstance(value, unicode):
-            raise error.StorageClassError("UTF storage requires unicode")
-        return psycopg2.Binary(value.encode("utf8"))
-
-    if st == storage.SERIAL:
-        schema = ctx_schema(ctx)
-        if schema:
-            msg = schema(value)
-            try:
-                value = msg.dumps()
-            except schema.InvalidMessage:
-                raise error.StorageClassError(
-                        "SERIAL schema validation failed", msg.message)
-        else:
-            try:
-                value = mummy.dumps(value)
-            except TypeError:
-                raise error.StorageClassError(
-                    "SERIAL requires a serializable value")
-        return psycopg2.Binary(value)
-
-
-    raise error.BadContext(ctx)
-
-
-_Binary = type(psycopg2.Binary(''))
+    return codec.get(ctx).wrap(value)
 
 
 def storage_unwrap(ctx, value):
-    st = ctx_storage(ctx)
-    if st is None:
-        raise error.BadContext(ctx)
-
-    if isinstance(value, _Binary):
-        value = value.adapted
-    if isinstance(value, buffer):
-        value = str(value)
-
-    if st == storage.UTF:
-        value = value.decode("utf8")
-
-    if st == storage.SERIAL:
-        schema = ctx_schema(ctx)
-        if schema:
-            value = schema.untransform(mummy.loads(value))
-        else:
-            value = mummy.loads(value)
-
-    return value
+    return codec.get(ctx).unwrap(value)
 
 
 _dm = None
@@ -0,0 +1,142 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import re
+
+import psycopg2
+import psycopg2.extensions
+
+
+__all__ = ["PreparingConnection", "PreparingCursor", "Statements"]
+
+
+class Statements(object):
+    '''the server-side prepared statements of a single connection
+
+    statements are keyed by their full SQL text, so every ctx-dependent
+    variant a query builder produces gets its own. a statement is only
+    prepared once it has been run ``threshold`` times on the connection, so
+    one-off texts (like those with a variable number of placeholders) don't
+    pile up, and no more than ``limit`` are ever prepared. only statements
+    that postgres can prepare (select, insert, update, delete, values and
+    ``with`` queries) are considered; anything else, like DDL or two
+    statements joined with ``;``, always runs directly.
+
+    the PREPAREs don't declare parameter types, so postgres has to infer
+    them. a statement it can't infer them for is never tried again, and runs
+    directly from then on.
+    '''
+    def __init__(self, threshold=2, limit=256):
+        self.threshold = threshold
+        self.limit = limit
+        self._counts = {}
+        self._names = {}
+        self._unpreparable = set()
+
+    def execute(self, execute, sql, args, savepoint=False):
+        '''run ``sql`` through ``execute(sql, args)``, preparing it if hot
+
+        ``execute`` is the underlying (unprepared) cursor execute method.
+        pass ``savepoint=True`` if it runs inside a transaction, so that a
+        failed PREPARE is rolled back to a savepoint instead of aborting it.
+        '''
+        if (isinstance(args, dict) or sql in self._unpreparable
+                or not _preparable(sql)):
+            return execute(sql, args)
+
+        name = self._names.get(sql)
+        if name is None:
+            count = self._counts.get(sql, 0) + 1
+            if count < self.threshold or len(self._names) >= self.limit:
+                # bound the memory spent counting one-off statements
+                if sql in self._counts or len(self._counts) < self.limit * 4:
+                    self._counts[sql] = count
+                return execute(sql, args)
+
+            name = "datahog_%d" % len(self._names)
+            self._counts.pop(sql, None)
+            if not self._prepare(execute, name, sql, savepoint):
+                if len(self._unpreparable) < self.limit * 4:
+                    self._unpreparable.add(sql)
+                return execute(sql, args)
+            self._names[sql] = name
+
+        if args:
+            return execute("execute %s (%s)" % (
+                name, ', '.join(['%s'] * len(args))), args)
+        return execute("execute %s" % name, None)
+
+    def _prepare(self, execute, name, sql, savepoint):
+        if savepoint:
+            execute("savepoint datahog_prepare", None)
+        try:
+            execute("prepare %s as %s" % (name, _placeholders(sql)), None)
+        except psycopg2.ProgrammingError:
+            # postgres couldn't infer a parameter's type, for instance
+            if savepoint:
+                execute("rollback to savepoint datahog_prepare", None)
+            return False
+        if savepoint:
+            execute("release savepoint datahog_prepare", None)
+        return True
+
+    def clear(self):
+        '''forget everything prepared (the server has already dropped them)
+        '''
+        self._counts.clear()
+        self._names.clear()
+
+
+class PreparingCursor(psycopg2.extensions.cursor):
+    '''a cursor which runs hot statements as server-side prepared statements
+
+    it must be created by a :class:`PreparingConnection`. named cursors run
+    everything directly.
+    '''
+    def execute(self, sql, args=None):
+        # a named (server-side) cursor's query is run inside a DECLARE, and
+        # "declare ... cursor for execute ..." isn't valid
+        if self.name is not None:
+            return super(PreparingCursor, self).execute(sql, args)
+        return self.connection.statements.execute(
+                super(PreparingCursor, self).execute, sql, args,
+                not self.connection.autocommit)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    '''a connection whose cursors prepare hot statements on the server
+
+    pass this as the ``connection_factory`` to ``psycopg2.connect``.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.statements = Statements()
+        self.cursor_factory = PreparingCursor
+
+    def reset(self):
+        # reset() ends with a DISCARD ALL, which deallocates everything
+        super(PreparingConnection, self).reset()
+        self.statements.clear()
+
+
+def _placeholders(sql):
+    # %s -> $1, $2, ... and %% -> %, since PREPARE text isn't run through
+    # psycopg2's parameter interpolation
+    counter = [0]
+    def sub(match):
+        if match.group(1) == '%':
+            return '%'
+        counter[0] += 1
+        return '$%d' % counter[0]
+    return _placeholder.sub(sub, sql)
+
+_placeholder = re.compile(r'%(%|s)')
+
+
+def _preparable(sql):
+    sql = sql.strip().rstrip(';')
+    return ';' not in sql and _preparable_verb.match(sql) is not None
+
+_preparable_verb = re.compile(
+        r'(select|insert|update|delete|values|with)\b', re.I)
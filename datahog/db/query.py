@@ -2,6 +2,9 @@
 
 from __future__ import absolute_import
 
+import cStringIO
+import sys
+
 import psycopg2
 
 from ..const import context, storage, table, util
@@ -10,20 +13,194 @@ from ..const import context, storage, table, util
 _missing = object() # default argument sentinel
 
 
-def select_property(cursor, base_id, ctx):
+# SQL for the queries whose text depends on their context's metadata (or on
+# some other small set of variants), keyed by (render function, ctx, variant)
+_statements = {}
+
+def _statement(render, ctx, *variant):
+    key = (render, ctx) + variant
+    try:
+        return _statements[key]
+    except KeyError:
+        sql = _statements[key] = render(ctx, *variant)
+        return sql
+
+def prime(ctx):
+    '''render and cache the SQL of every query that depends on ``ctx``
+
+    this is hooked into :func:`set_context <datahog.const.context.set_context>`
+    so that no per-call formatting is left to do, and any statements cached
+    for an earlier registration of the same ctx value are replaced.
+    '''
+    for key in [k for k in _statements if k[1] == ctx]:
+        del _statements[key]
+
+    for render, variants in _RENDERS.get(util.ctx_tbl(ctx), ()):
+        for variant in variants:
+            try:
+                _statement(render, ctx, *variant)
+            except Exception:
+                # not fully configured for this query (say, a root node ctx
+                # with no base), so the query will raise if it's ever run
+                _statements.pop((render, ctx) + variant, None)
+
+context.add_hook(prime)
+
+
+def _val_fields(ctx):
     if util.ctx_storage(ctx) == storage.INT:
-        val_field = 'num'
-    else:
-        val_field = 'value'
+        return 'num', 'value'
+    return 'value', 'num'
+
+
+# positions in ordered lists (aliases, names, relationships and edges) are
+# sparse: entries are appended _GAP past the last one, and an entry going in
+# at an index takes a position halfway between its neighbours, so an insert,
+# a move or a removal only ever writes the one row. a list is renumbered only
+# when two neighbours have no room left between them.
+_GAP = 1 << 24
+
+# for each kind of ordered list: its table, the columns picking out a single
+# list, and the column telling the entries of one list apart
+_LISTS = {
+    'alias': ('alias', ('base_id', 'ctx'), 'value'),
+    'name': ('name', ('base_id', 'ctx'), 'value'),
+    'edge': ('edge', ('base_id', 'ctx'), 'child_id'),
+    'forward': ('relationship', ('base_id', 'ctx', 'forward'), 'rel_id'),
+    'backward': ('relationship', ('rel_id', 'ctx', 'forward'), 'base_id'),
+}
+
+def _list_where(cols, indent, key=None):
+    where = "time_removed is null" + "".join(
+            "\n%sand %s=%%s" % (indent, col) for col in cols)
+    if key is not None:
+        where += "\n%sand %s<>%%s" % (indent, key)
+    return where
+
+def _last_pos_sql(tbl, cols):
+    # the position for an entry appended to a list
+    return """coalesce((
+    select pos
+    from %s
+    where
+        %s
+    order by pos desc
+    limit 1
+), 0) + %d""" % (tbl, _list_where(cols, ' ' * 8), _GAP)
+
+def _slot_sql(tbl, cols, key=None):
+    # the position for an entry going in at an index (among the entries other
+    # than ``key``, when moving one), or null if there is no room there
+    return """
+    select case
+        when hi is null then lo + %(gap)d
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %%s = 0 then 0 else coalesce((
+            select pos
+            from %(tbl)s
+            where
+                %(where)s
+            order by pos asc
+            offset %%s
+            limit 1
+        ), (
+            select pos
+            from %(tbl)s
+            where
+                %(where)s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from %(tbl)s
+            where
+                %(where)s
+            order by pos asc
+            offset %%s
+            limit 1
+        ) as hi
+    ) as neighbours""" % {
+        'gap': _GAP, 'tbl': tbl, 'where': _list_where(cols, ' ' * 16, key)}
+
+def _slot_params(scope, index, key=_missing):
+    if key is not _missing:
+        scope += (key,)
+    return (index,) + scope + (max(index - 1, 0),) + scope + scope + (index,)
+
+def _reorder_sql(tbl, cols, key):
+    where = _list_where(cols, ' ' * 8) + "\n        and %s=%%s" % (key,)
+    return """
+with target as (
+    select 1
+    from %s
+    where
+        %s
+), slot(pos) as (%s
+), move as (
+    update %s
+    set pos=slot.pos
+    from slot
+    where
+        slot.pos is not null
+        and %s
+    returning 1
+)
+select exists (select 1 from target), exists (select 1 from move)
+""" % (tbl, where, _slot_sql(tbl, cols, key), tbl, where)
 
-    cursor.execute("""
+def _rebalance_sql(tbl, cols, key):
+    return """
+update %s
+set pos=ordering.n * %d
+from (
+    select row_number() over (order by pos asc) n, %s
+    from %s
+    where
+        %s
+) as ordering
+where
+    %s.%s=ordering.%s
+    and %s
+""" % (tbl, _GAP, key, tbl, _list_where(cols, ' ' * 8), tbl, key, key,
+        _list_where(cols, ' ' * 4))
+
+_REORDERS = dict((kind, _reorder_sql(*spec))
+        for kind, spec in _LISTS.iteritems())
+_REBALANCES = dict((kind, _rebalance_sql(*spec))
+        for kind, spec in _LISTS.iteritems())
+
+def _place(cursor, kind, scope, sql, params):
+    # run a statement that puts a list entry at a slot from _slot_sql, and
+    # renumber the list and go again if it found no room at that spot.
+    # statements return whether the entry (or its parent) was found, and
+    # whether it was placed.
+    cursor.execute(sql, params)
+    found, placed = cursor.fetchone()
+    if found and not placed:
+        cursor.execute(_REBALANCES[kind], scope + scope)
+        cursor.execute(sql, params)
+        found, placed = cursor.fetchone()
+    return placed
+
+def _reorder(cursor, kind, scope, key, index):
+    return _place(cursor, kind, scope, _REORDERS[kind],
+            scope + (key,) + _slot_params(scope, index, key) + scope + (key,))
+
+
+def _select_property_sql(ctx):
+    return """
 select %s, flags
 from property
 where
     time_removed is null
     and base_id=%%s
     and ctx=%%s
-""" % (val_field,), (base_id, ctx))
+""" % (_val_fields(ctx)[0],)
+
+def select_property(cursor, base_id, ctx):
+    cursor.execute(_statement(_select_property_sql, ctx), (base_id, ctx))
 
     if not cursor.rowcount:
         return False, None, None
@@ -40,39 +217,44 @@ where
     time_removed is null
     and base_id=%%s
     %s
-""" % ('' if ctxs is None else
-            'and ctx in (%s)' % ','.join('%s' for c in ctxs),),
-        (base_id,) + tuple(ctxs or ()))
+""" % ('' if ctxs is None else 'and ctx = any(%s)',),
+        (base_id,) if ctxs is None else (base_id, list(ctxs)))
 
-    if ctxs is None:
-        return [{
-            'base_id': base_id,
-            'ctx': ctx,
-            'flags': flags,
-            'value': num if util.ctx_storage(ctx) == storage.INT else value,
-        } for ctx, num, value, flags in cursor.fetchall()]
+    return cursor.fetchall()
 
-    results = {ctx: {
-            'base_id': base_id,
-            'ctx': ctx,
-            'flags': flags,
-            'value': (
-                num if util.ctx_storage(ctx) == storage.INT else value),
-        } for ctx, num, value, flags in cursor.fetchall()}
-    return map(results.get, ctxs)
 
+def select_property_batch(cursor, pairs):
+    cursor.execute("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in (
+        select * from unnest(%s::bigint[], %s::smallint[]))
+""", _columns(pairs, 2))
+
+    return cursor.fetchall()
 
-def upsert_property(cursor, base_id, ctx, value, flags):
-    if util.ctx_storage(ctx) == storage.INT:
-        val_field = 'num'
-        other_field = 'value'
-    else:
-        val_field = 'value'
-        other_field = 'num'
-    base_tbl, base_ctx = util.ctx_base(ctx)
-    base_tbl = table.NAMES[base_tbl]
 
+def select_properties_batch(cursor, base_ids, ctxs=None):
     cursor.execute("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and base_id = any(%%s::bigint[])
+    %s
+""" % ('' if ctxs is None else 'and ctx = any(%s::smallint[])',),
+        (list(base_ids),) if ctxs is None else (list(base_ids), list(ctxs)))
+
+    return cursor.fetchall()
+
+
+def _upsert_property_sql(ctx):
+    val_field, other_field = _val_fields(ctx)
+    base_tbl = table.NAMES[util.ctx_base(ctx)[0]]
+
+    return """
 with existencequery as (
     select 1
     from %s
@@ -102,29 +284,29 @@ insertquery as (
 select
     exists (select 1 from insertquery),
     exists (select 1 from updatequery)
-""" % (base_tbl, val_field, other_field, val_field),
-            (base_id, base_ctx, value, base_id, ctx, base_id, ctx,
-                value, flags))
+""" % (base_tbl, val_field, other_field, val_field)
 
-    return cursor.fetchone()
+def upsert_property(cursor, base_id, ctx, value, flags):
+    cursor.execute(_statement(_upsert_property_sql, ctx),
+            (base_id, util.ctx_base_ctx(ctx), value, base_id, ctx, base_id,
+                ctx, value, flags))
 
+    return cursor.fetchone()
 
-def update_property(cursor, base_id, ctx, value):
-    if util.ctx_storage(ctx) == storage.INT:
-        val_field = 'num'
-        other_field = 'value'
-    else:
-        val_field = 'value'
-        other_field = 'num'
 
-    cursor.execute("""
+def _update_property_sql(ctx):
+    return """
 update property
 set %s=%%s, %s=%%s
 where
     time_removed is null
     and base_id=%%s
     and ctx=%%s
-""" % (val_field, other_field), (value, None, base_id, ctx))
+""" % _val_fields(ctx)
+
+def update_property(cursor, base_id, ctx, value):
+    cursor.execute(_statement(_update_property_sql, ctx),
+            (value, None, base_id, ctx))
 
     return cursor.rowcount
 
@@ -163,21 +345,17 @@ returning num
     return cursor.fetchone()[0]
 
 
-def remove_property(cursor, base_id, ctx, value=_missing):
-    if value is _missing:
-        where_value, params = "", (base_id, ctx)
+def _remove_property_sql(ctx, match):
+    if match is None:
+        where_value = ""
+    elif util.ctx_storage(ctx) == storage.INT:
+        where_value = "and num=%s"
+    elif match == 'null':
+        where_value = "and value is null"
     else:
-        if util.ctx_storage(ctx) == storage.INT:
-            where_value = "and num=%s"
-            params = (base_id, ctx, value)
-        elif value is None:
-            where_value = "and value is null"
-            params = (base_id, ctx)
-        else:
-            where_value = "and value=%s"
-            params = (base_id, ctx, value)
+        where_value = "and value=%s"
 
-    cursor.execute("""
+    return """
 update property
 set time_removed=now()
 where
@@ -185,7 +363,17 @@ where
     and base_id=%%s
     and ctx=%%s
     %s
-""" % (where_value,), params)
+""" % (where_value,)
+
+def remove_property(cursor, base_id, ctx, value=_missing):
+    if value is _missing:
+        match, params = None, (base_id, ctx)
+    elif value is None and util.ctx_storage(ctx) != storage.INT:
+        match, params = 'null', (base_id, ctx)
+    else:
+        match, params = 'value', (base_id, ctx, value)
+
+    cursor.execute(_statement(_remove_property_sql, ctx, match), params)
 
     return bool(cursor.rowcount)
 
@@ -196,8 +384,8 @@ update property
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
-""" % (','.join('%s' for x in base_ids),), base_ids)
+    and base_id = any(%s)
+""", (list(base_ids),))
 
     return cursor.rowcount
 
@@ -225,8 +413,7 @@ where
     }
 
 
-def select_aliases(cursor, base_id, ctx, limit, start):
-    cursor.execute("""
+_select_aliases_sql = """
 select flags, value, pos
 from alias
 where
@@ -235,21 +422,21 @@ where
     and ctx=%s
     and pos >= %s
 order by pos asc
-limit %s
-""", (base_id, ctx, start, limit))
+"""
 
-    return [{
-            'base_id': base_id,
-            'flags': flags,
-            'ctx': ctx,
-            'pos': pos,
-            'value': value.decode('utf8'),
-        } for flags, value, pos in cursor.fetchall()]
+def select_aliases(cursor, base_id, ctx, limit, start):
+    cursor.execute(_select_aliases_sql + "limit %s\n",
+            (base_id, ctx, start, limit))
 
+    return cursor.fetchall()
 
-def select_alias_batch(cursor, pairs):
-    flat_pairs = reduce(lambda a, b: a.extend(b) or a, pairs, [])
+def iter_aliases(cursor, base_id, ctx, start, size):
+    cursor.execute(_select_aliases_sql, (base_id, ctx, start))
 
+    return _fetch_lazily(cursor, size)
+
+
+def select_alias_batch(cursor, pairs):
     cursor.execute("""
 with window_query as (
     select base_id, flags, ctx, value, rank() over (
@@ -259,19 +446,15 @@ with window_query as (
     from alias
     where
         time_removed is null
-        and (base_id, ctx) in (%s)
+        and (base_id, ctx) in (
+            select * from unnest(%s::bigint[], %s::smallint[]))
 )
 select base_id, flags, ctx, value
 from window_query
 where r=1
-""" % (','.join('(%s, %s)' for pair in pairs),), flat_pairs)
+""", _columns(pairs, 2))
 
-    return [{
-            'base_id': base_id,
-            'flags': flags,
-            'ctx': ctx,
-            'value': value,
-        } for base_id, flags, ctx, value in cursor.fetchall()]
+    return cursor.fetchall()
 
 
 def maybe_insert_alias_lookup(cursor, digest, ctx, base_id, flags):
@@ -300,23 +483,13 @@ from selectquery
     return True, base_id
 
 
-def insert_alias(cursor, base_id, ctx, value, index, flags):
-    base_tbl, base_ctx = util.ctx_base(ctx)
-    base_tbl = table.NAMES[base_tbl]
+def _insert_alias_sql(ctx, indexed):
+    base_tbl = table.NAMES[util.ctx_base(ctx)[0]]
 
-    if index is None:
-        cursor.execute("""
+    if not indexed:
+        return """
 insert into alias (base_id, ctx, value, pos, flags)
-select %%s, %%s, %%s, coalesce((
-    select pos + 1
-    from alias
-    where
-        time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-    order by pos desc
-    limit 1
-), 1), %%s
+select %%s, %%s, %%s, %s, %%s
 where exists (
     select 1 from %s
     where
@@ -324,92 +497,44 @@ where exists (
         and id=%%s
         and ctx=%%s
 )
-""" % (base_tbl,),
-            (base_id, ctx, value, base_id, ctx, flags, base_id, base_ctx))
-    else:
-        cursor.execute("""
+""" % (_last_pos_sql('alias', ('base_id', 'ctx')), base_tbl)
+
+    return """
 with existence as (
     select 1 from %s
     where
         time_removed is null
         and id=%%s
         and ctx=%%s
-), increment as (
-    update alias
-    set pos = pos + 1
+), slot(pos) as (%s
+), insertion as (
+    insert into alias (base_id, ctx, value, pos, flags)
+    select %%s, %%s, %%s, pos, %%s
+    from slot
     where
         exists (select 1 from existence)
-        and time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-        and pos >= %%s
+        and pos is not null
+    returning 1
 )
-insert into alias (base_id, ctx, value, pos, flags)
-select %%s, %%s, %%s, %%s, %%s
-where exists (select 1 from existence)
-returning 1
-""" % (base_tbl,), (
-            base_id, base_ctx,
-            base_id, ctx, index,
-            base_id, ctx, value, index, flags))
+select exists (select 1 from existence), exists (select 1 from insertion)
+""" % (base_tbl, _slot_sql('alias', ('base_id', 'ctx')))
 
-    return bool(cursor.rowcount)
+def insert_alias(cursor, base_id, ctx, value, index, flags):
+    sql = _statement(_insert_alias_sql, ctx, index is not None)
+    base_ctx = util.ctx_base_ctx(ctx)
 
+    if index is None:
+        cursor.execute(sql,
+            (base_id, ctx, value, base_id, ctx, flags, base_id, base_ctx))
+        return bool(cursor.rowcount)
 
-def reorder_alias(cursor, base_id, ctx, value, pos):
-    cursor.execute("""
-with oldpos as (
-    select pos
-    from alias
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-), bump as (
-    update alias
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from alias
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update alias
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (base_id, ctx, value,
-        base_id, ctx, pos,
-        base_id, ctx,
-        pos, pos, base_id, ctx, value))
+    return _place(cursor, 'alias', (base_id, ctx), sql,
+            (base_id, base_ctx) + _slot_params((base_id, ctx), index) +
+            (base_id, ctx, value, flags))
 
-    return cursor.fetchone()[0]
+
+def reorder_alias(cursor, base_id, ctx, value, pos):
+    return _reorder(cursor, 'alias', (base_id, ctx), value, pos)
 
 
 def remove_alias_lookup(cursor, digest, ctx, base_id):
@@ -429,45 +554,30 @@ where
 
 def remove_alias(cursor, base_id, ctx, value):
     cursor.execute("""
-with removal as (
-    update alias
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update alias
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (base_id, ctx, value, base_id, ctx))
+update alias
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (base_id, ctx, value))
 
     return bool(cursor.rowcount)
 
 
 def remove_alias_lookups_multi(cursor, aliases):
-    flat = []
-    for digest, ctx in aliases:
-        flat.append(psycopg2.Binary(digest))
-        flat.append(ctx)
+    digests, ctxs = _columns(aliases, 2)
 
     cursor.execute("""
 update alias_lookup
 set time_removed=now()
 where
     time_removed is null
-    and (hash, ctx) in (%s)
+    and (hash, ctx) in (
+        select * from unnest(%s::bytea[], %s::smallint[]))
 returning hash, ctx
-""" % (','.join('(%s, %s)' for x in aliases),), flat)
+""", (map(psycopg2.Binary, digests), ctxs))
 
     return cursor.fetchall()
 
@@ -478,36 +588,24 @@ update alias
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning value, ctx
-""" % (','.join('%s' for x in base_ids),), base_ids)
+""", (list(base_ids),))
 
     return cursor.fetchall()
 
 
-def insert_relationship(cursor, base_id, rel_id, ctx, forward, index, flags):
+def _insert_relationship_sql(ctx, forward, indexed):
     if forward:
-        id_tbl, id_ctx = util.ctx_base(ctx)
-        id = base_id
-        id_col = 'base_id'
+        id_tbl, cols = util.ctx_base(ctx)[0], _LISTS['forward'][1]
     else:
-        id_tbl, id_ctx = util.ctx_rel(ctx)
-        id = rel_id
-        id_col = 'rel_id'
+        id_tbl, cols = util.ctx_rel(ctx)[0], _LISTS['backward'][1]
     id_tbl = table.NAMES[id_tbl]
 
-    if index is None:
-        cursor.execute("""
+    if not indexed:
+        return """
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %%s, %%s, %%s, %%s, (
-    select count(*)
-    from relationship
-    where
-        time_removed is null
-        and %s=%%s
-        and ctx=%%s
-        and forward=%%s
-), %%s
+select %%s, %%s, %%s, %%s, %s, %%s
 where exists (
     select 1
     from %s
@@ -517,14 +615,9 @@ where exists (
         and ctx=%%s
 )
 returning 1
-""" % (id_col, id_tbl), (
-        base_id, rel_id, ctx, forward,
-        id, ctx, forward,
-        flags,
-        id, id_ctx))
+""" % (_last_pos_sql('relationship', cols), id_tbl)
 
-    else:
-        cursor.execute("""
+    return """
 with eligible as (
     select 1
     from %s
@@ -532,40 +625,48 @@ with eligible as (
         time_removed is null
         and id=%%s
         and ctx=%%s
-), bump as (
-    update relationship
-    set pos=pos + 1
+), slot(pos) as (%s
+), insertion as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select %%s, %%s, %%s, %%s, pos, %%s
+    from slot
     where
         exists (select 1 from eligible)
-        and time_removed is null
-        and forward=%%s
-        and %s=%%s
-        and ctx=%%s
-        and pos >= %%s
+        and pos is not null
+    returning 1
 )
-insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %%s, %%s, %%s, %%s, %%s, %%s
-where exists (select 1 from eligible)
-returning 1
-""" % (id_tbl, id_col), (id, id_ctx,
-            forward, id, ctx, index,
-            base_id, rel_id, ctx, forward, index, flags))
+select exists (select 1 from eligible), exists (select 1 from insertion)
+""" % (id_tbl, _slot_sql('relationship', cols))
 
-    return cursor.rowcount
+def insert_relationship(cursor, base_id, rel_id, ctx, forward, index, flags):
+    sql = _statement(_insert_relationship_sql, ctx, bool(forward),
+            index is not None)
+    if forward:
+        id, id_ctx = base_id, util.ctx_base_ctx(ctx)
+    else:
+        id, id_ctx = rel_id, util.ctx_rel_ctx(ctx)
 
+    if index is None:
+        cursor.execute(sql, (
+            base_id, rel_id, ctx, forward,
+            id, ctx, forward,
+            flags,
+            id, id_ctx))
+        return cursor.rowcount
 
-def select_relationships(cursor, id, ctx, forward, limit, start, other_id=_missing):
+    scope = (id, ctx, forward)
+    return int(_place(cursor, 'forward' if forward else 'backward', scope,
+            sql, (id, id_ctx) + _slot_params(scope, index) +
+            (base_id, rel_id, ctx, forward, flags)))
+
+
+def _select_relationships_sql(ctx, forward, one, limited=True):
     here_name = "base_id" if forward else "rel_id"
     other_name = "rel_id" if forward else "base_id"
+    clause = "and %s=%%s" % (other_name,) if one else ""
+    limit = "limit %s" if limited else ""
 
-    if other_id is _missing:
-        clause = ""
-        params = (id, ctx, forward, start, limit)
-    else:
-        clause = "and %s=%%s" % (other_name,)
-        params = (id, ctx, forward, start, other_id, limit)
-
-    cursor.execute("""
+    return """
 select %s, flags, pos
 from relationship
 where
@@ -576,52 +677,51 @@ where
     and pos >= %%s
     %s
 order by pos asc
-limit %%s
-""" % (other_name, here_name, clause), params)
+%s
+""" % (other_name, here_name, clause, limit)
 
-    return [{
-            here_name: id,
-            'flags': flags,
-            other_name: other_id,
-            'ctx': ctx,
-            'pos': pos}
-        for other_id, flags, pos in cursor.fetchall()]
+def select_relationships(cursor, id, ctx, forward, limit, start, other_id=_missing):
+    if other_id is _missing:
+        params = (id, ctx, forward, start, limit)
+    else:
+        params = (id, ctx, forward, start, other_id, limit)
 
+    cursor.execute(_statement(_select_relationships_sql, None, bool(forward),
+        other_id is not _missing), params)
 
-def remove_relationship(cursor, base_id, rel_id, ctx, forward):
-    if forward:
-        anchor_id = base_id
-        anchor_col = "base_id"
-    else:
-        anchor_id = rel_id
-        anchor_col = "rel_id"
+    return cursor.fetchall()
 
+def select_relationship_batch(cursor, triples):
     cursor.execute("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-        and forward=%%s
-        and rel_id=%%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and %s=%%s
-        and ctx=%%s
-        and forward=%%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""" % (anchor_col,), (
-        base_id, ctx, forward, rel_id,
-        anchor_id, ctx, forward))
+select base_id, ctx, rel_id, flags, pos
+from relationship
+where
+    time_removed is null
+    and forward=true
+    and (base_id, ctx, rel_id) in (
+        select * from unnest(%s::bigint[], %s::smallint[], %s::bigint[]))
+""", _columns(triples, 3))
+
+    return cursor.fetchall()
+
+def iter_relationships(cursor, id, ctx, forward, start, size):
+    cursor.execute(_statement(_select_relationships_sql, None, bool(forward),
+        False, False), (id, ctx, forward, start))
+
+    return _fetch_lazily(cursor, size)
+
+
+def remove_relationship(cursor, base_id, rel_id, ctx, forward):
+    cursor.execute("""
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (base_id, ctx, forward, rel_id))
 
     return bool(cursor.rowcount)
 
@@ -634,7 +734,7 @@ with forwardrels (base_id, ctx, forward, rel_id) as (
     where
         time_removed is null
         and forward=true
-        and base_id in (%s)
+        and base_id = any(%s)
     returning base_id, ctx, forward, rel_id
 ),
 backwardrels (base_id, ctx, forward, rel_id) as (
@@ -643,143 +743,65 @@ backwardrels (base_id, ctx, forward, rel_id) as (
     where
         time_removed is null
         and forward=false
-        and rel_id in (%s)
+        and rel_id = any(%s)
     returning base_id, ctx, forward, rel_id
 )
 select base_id, ctx, forward, rel_id from forwardrels
 UNION ALL
 select base_id, ctx, forward, rel_id from backwardrels
-""" % ((','.join('%s' for x in base_ids),) * 2), base_ids * 2)
+""", (list(base_ids),) * 2)
 
     return cursor.fetchall()
 
 
 def remove_relationships_multi(cursor, rels):
-    flat_rels = reduce(lambda a, b: a.extend(b) or a, rels, [])
-
     cursor.execute("""
 update relationship
 set time_removed=now()
 where
     time_removed is null
-    and (base_id, ctx, forward, rel_id) in (%s)
-""" % (','.join('(%s, %s, %s, %s)' for x in rels),), flat_rels)
+    and (base_id, ctx, forward, rel_id) in (select * from unnest(
+        %s::bigint[], %s::smallint[], %s::bool[], %s::bigint[]))
+""", _columns(rels, 4))
 
     return cursor.rowcount
 
 
-def bulk_reorder_relationships(cursor, pairs, forward):
-    anchor_col = "base_id" if forward else "rel_id"
-    data_col = "rel_id" if forward else "base_id"
+def reorder_relationship(cursor, base_id, rel_id, ctx, forward, pos):
+    if forward:
+        return _reorder(cursor, 'forward', (base_id, ctx, forward), rel_id, pos)
+    return _reorder(cursor, 'backward', (rel_id, ctx, forward), base_id, pos)
 
-    replace = ','.join('(%s,%s)' for p in pairs)
-    flat_pairs = reduce(lambda a, b: a.extend(b) or a, pairs, [])
 
-    cursor.execute("""
-update relationship
-set pos = ordering.counter - 1
-from (
-    select row_number() over (
-        partition by (%s, ctx)
-        order by pos asc
-    ) counter, %s
-    from relationship
+def _insert_node_sql(ctx, based):
+    if not based:
+        existence = ""
+    else:
+        existence = """
+where exists (
+    select 1
+    from node
     where
         time_removed is null
-        and forward=%%s
-        and (%s, ctx) in (%s)
-) as ordering
-where
-    relationship.%s = ordering.%s
-    and relationship.time_removed is null
-    and relationship.forward=%%s
-    and (relationship.%s, relationship.ctx) in (%s)
-returning 1
-""" % (anchor_col, data_col, anchor_col, replace, data_col, data_col,
-            anchor_col, replace),
-        ([forward] + flat_pairs) * 2)
+        and id=%s
+        and ctx=%s
+)"""
 
-    return cursor.rowcount
+    return """
+insert into node (ctx, %s, flags)
+select %%s, %%s, %%s
+%s
+returning id
+""" % (_val_fields(ctx)[0], existence)
 
+def insert_node(cursor, base_id, ctx, value, flags):
+    if base_id is None:
+        params = (ctx, value, flags)
+    else:
+        params = (ctx, value, flags, base_id, util.ctx_base_ctx(ctx))
 
-def reorder_relationship(cursor, base_id, rel_id, ctx, forward, pos):
-    anchor_col = "base_id" if forward else "rel_id"
-    anchor_id = base_id if forward else rel_id
-
-    cursor.execute("""
-with oldpos as (
-    select pos
-    from relationship
-    where
-        time_removed is null
-        and forward=%%s
-        and base_id=%%s
-        and ctx=%%s
-        and rel_id=%%s
-), bump as (
-    update relationship
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and forward=%%s
-        and %s=%%s
-        and ctx=%%s
-        and pos between symmetric (select pos from oldpos) and %%s
-    returning 1
-), move as (
-    update relationship
-    set pos=%%s
-    where
-        time_removed is null
-        and forward=%%s
-        and base_id=%%s
-        and ctx=%%s
-        and rel_id=%%s
-    returning 1
-)
-select exists (select 1 from move)
-""" % (anchor_col,), (
-        forward, base_id, ctx, rel_id,
-        forward, anchor_id, ctx, pos,
-        pos,
-        forward, base_id, ctx, rel_id))
-
-    return cursor.fetchone()[0]
-
-
-def insert_node(cursor, base_id, ctx, value, flags):
-    if util.ctx_storage(ctx) == storage.INT:
-        val_field = 'num'
-    else:
-        val_field = 'value'
-
-    if base_id is None:
-        existence = ""
-        params = (ctx, value, flags)
-    else:
-        base_ctx = util.ctx_base_ctx(ctx)
-        existence = """
-where exists (
-    select 1
-    from node
-    where
-        time_removed is null
-        and id=%s
-        and ctx=%s
-)"""
-        params = (ctx, value, flags, base_id, base_ctx)
-
-    cursor.execute("""
-insert into node (ctx, %s, flags)
-select %%s, %%s, %%s
-%s
-returning id
-""" % (val_field, existence), params)
+    cursor.execute(
+            _statement(_insert_node_sql, ctx, base_id is not None), params)
 
     if not cursor.rowcount:
         return None
@@ -808,66 +830,46 @@ def insert_edge(cursor, base_id, ctx, child_id, pos=None, check=False):
     if pos is None:
         cursor.execute('''
 insert into edge (base_id, ctx, child_id, pos)
-select %%s, %%s, %%s, coalesce((
-    select pos + 1
-    from edge
-    where
-        time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-    order by pos desc
-    limit 1
-), 1)
+select %%s, %%s, %%s, %s
 where %s
-''' % (where,), (base_id, ctx, child_id, base_id, ctx) + where_params)
-    else:
-        cursor.execute('''
-with bump as (
-    update edge
-    set pos=pos + 1
+''' % (_last_pos_sql('edge', ('base_id', 'ctx')), where),
+            (base_id, ctx, child_id, base_id, ctx) + where_params)
+        return bool(cursor.rowcount)
+
+    return _place(cursor, 'edge', (base_id, ctx), '''
+with slot(pos) as (%s
+), insertion as (
+    insert into edge (base_id, ctx, child_id, pos)
+    select %%s, %%s, %%s, pos
+    from slot
     where
-        time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-        and pos >= %%s
+        pos is not null
         and %s
+    returning 1
 )
-insert into edge (base_id, ctx, child_id, pos)
-select %%s, %%s, %%s, %%s
-where %s
-returning 1
-''' % (where, where), (base_id, ctx, pos) + where_params + (
-            base_id, ctx, child_id, pos) + where_params)
-
-    return bool(cursor.rowcount)
+select %s, exists (select 1 from insertion)
+''' % (_slot_sql('edge', ('base_id', 'ctx')), where, where),
+        _slot_params((base_id, ctx), pos) + (base_id, ctx, child_id) +
+        where_params + where_params)
 
 
-def select_node(cursor, nid, ctx):
-    if util.ctx_storage(ctx) == storage.INT:
-        val_field = 'num'
-    else:
-        val_field = 'value'
-
-    cursor.execute("""
+def _select_node_sql(ctx):
+    return """
 select flags, %s
 from node
 where
     time_removed is null
     and id=%%s
     and ctx=%%s
-""" % (val_field,), (nid, ctx))
+""" % (_val_fields(ctx)[0],)
+
+def select_node(cursor, nid, ctx):
+    cursor.execute(_statement(_select_node_sql, ctx), (nid, ctx))
 
     if not cursor.rowcount:
         return None
 
-    flags, value = cursor.fetchone()
-
-    return {
-        'id': nid,
-        'ctx': ctx,
-        'flags': flags,
-        'value': value
-    }
+    return cursor.fetchone()
 
 
 def select_edge_exists(cursor, child_id, ctx, base_id):
@@ -885,26 +887,18 @@ where
 
 
 def select_nodes(cursor, id_ctx_pairs):
-    flat_pairs = reduce(lambda a, b: a.extend(b) or a, id_ctx_pairs, [])
-
     cursor.execute("""
 select id, ctx, flags, num, value
 from node
 where
     time_removed is null
-    and (id, ctx) in (%s)
-""" % (','.join('(%s, %s)' for p in id_ctx_pairs),), flat_pairs)
+    and (id, ctx) in (select * from unnest(%s::bigint[], %s::smallint[]))
+""", _columns(id_ctx_pairs, 2))
 
-    return [{
-            'id': id,
-            'ctx': ctx,
-            'flags': flags,
-            'value': num if util.ctx_storage(ctx) == storage.INT else val,
-        } for id, ctx, flags, num, val in cursor.fetchall()]
+    return cursor.fetchall()
 
 
-def select_node_ids(cursor, base_id, limit, pos, ctx):
-    cursor.execute("""
+_select_node_ids_sql = """
 select child_id, ctx, pos
 from edge
 where
@@ -913,29 +907,25 @@ where
     and ctx=%s
     and pos >= %s
 order by pos asc
-limit %s
-""", (base_id, ctx, pos, limit))
+"""
+
+def select_node_ids(cursor, base_id, limit, pos, ctx):
+    cursor.execute(_select_node_ids_sql + "limit %s\n",
+            (base_id, ctx, pos, limit))
 
     return cursor.fetchall()
 
+def iter_node_ids(cursor, base_id, ctx, start, size):
+    cursor.execute(_select_node_ids_sql, (base_id, ctx, start))
 
-def update_node(cursor, nid, ctx, value, old_value=_missing):
-    int_storage = util.ctx_storage(ctx) == storage.INT
-    if int_storage:
-        val_field = 'num'
-        other_field = 'value'
-    else:
-        val_field = 'value'
-        other_field = 'num'
+    return _fetch_lazily(cursor, size)
 
-    if old_value is _missing:
-        oldval_where = ""
-        params = (value, nid, ctx)
-    else:
-        oldval_where = 'and %s=%%s' % (val_field,)
-        params = (value, nid, ctx, old_value)
 
-    cursor.execute("""
+def _update_node_sql(ctx, compare):
+    val_field, other_field = _val_fields(ctx)
+    oldval_where = 'and %s=%%s' % (val_field,) if compare else ""
+
+    return """
 update node
 set %s=%%s, %s=null
 where
@@ -943,7 +933,16 @@ where
     and id=%%s
     and ctx=%%s
     %s
-""" % (val_field, other_field, oldval_where), params)
+""" % (val_field, other_field, oldval_where)
+
+def update_node(cursor, nid, ctx, value, old_value=_missing):
+    if old_value is _missing:
+        params = (value, nid, ctx)
+    else:
+        params = (value, nid, ctx, old_value)
+
+    cursor.execute(_statement(_update_node_sql, ctx,
+        old_value is not _missing), params)
 
     return bool(cursor.rowcount)
 
@@ -983,83 +982,19 @@ returning num
 
 
 def reorder_edge(cursor, base_id, ctx, child_id, pos):
-    cursor.execute("""
-with oldpos as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-), bump as (
-    update edge
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update edge
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (base_id, ctx, child_id,
-    base_id, ctx, pos,
-    base_id, ctx,
-    pos, pos, base_id, ctx, child_id))
-
-    return cursor.fetchone()[0]
+    return _reorder(cursor, 'edge', (base_id, ctx), child_id, pos)
 
 
 def remove_edge(cursor, base_id, ctx, child_id):
     cursor.execute("""
-with removal as (
-    update edge
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning pos
-), bump as (
-    update edge
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (base_id, ctx, child_id, base_id, ctx))
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (base_id, ctx, child_id))
 
     return bool(cursor.rowcount)
 
@@ -1070,9 +1005,9 @@ update edge
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning child_id
-""" % (','.join('%s' for b in base_ids),), base_ids)
+""", (list(base_ids),))
 
     return [r[0] for r in cursor.fetchall()]
 
@@ -1083,30 +1018,20 @@ update node
 set time_removed=now()
 where
     time_removed is null
-    and id in (%s)
+    and id = any(%s)
 returning id
-""" % (','.join('%s' for n in nodes),), nodes)
+""", (list(nodes),))
 
     return [r[0] for r in cursor.fetchall()]
 
 
-def insert_name(cursor, base_id, ctx, value, flags, index):
-    base_tbl, base_ctx = util.ctx_base(ctx)
-    base_tbl = table.NAMES[base_tbl]
+def _insert_name_sql(ctx, indexed):
+    base_tbl = table.NAMES[util.ctx_base(ctx)[0]]
 
-    if index is None:
-        cursor.execute("""
+    if not indexed:
+        return """
 insert into name (base_id, ctx, value, flags, pos)
-select %%s, %%s, %%s, %%s, coalesce((
-    select pos + 1
-    from name
-    where
-        time_removed is null
-        and base_id=%%s
-        and ctx=%%s
-    order by pos desc
-    limit 1
-), 1)
+select %%s, %%s, %%s, %%s, %s
 where exists (
     select 1 from %s
     where
@@ -1114,38 +1039,42 @@ where exists (
         and id=%%s
         and ctx=%%s
 )
-""" % (base_tbl,), (
-            base_id, ctx, value, flags,
-            base_id, ctx,
-            base_id, base_ctx))
-    else:
-        cursor.execute("""
+""" % (_last_pos_sql('name', ('base_id', 'ctx')), base_tbl)
+
+    return """
 with existence as (
     select 1 from %s
     where
         time_removed is null
         and id=%%s
         and ctx=%%s
-), increment as (
-update name
-set pos = pos + 1
-where
-    exists (select 1 from existence)
-    and time_removed is null
-    and base_id=%%s
-    and ctx=%%s
-    and pos >= %%s
+), slot(pos) as (%s
+), insertion as (
+    insert into name (base_id, ctx, value, flags, pos)
+    select %%s, %%s, %%s, %%s, pos
+    from slot
+    where
+        exists (select 1 from existence)
+        and pos is not null
+    returning 1
 )
-insert into name (base_id, ctx, value, flags, pos)
-select %%s, %%s, %%s, %%s, %%s
-where exists (select 1 from existence)
-returning 1
-""" % (base_tbl,), (
-            base_id, base_ctx,
-            base_id, ctx, index,
-            base_id, ctx, value, flags, index))
+select exists (select 1 from existence), exists (select 1 from insertion)
+""" % (base_tbl, _slot_sql('name', ('base_id', 'ctx')))
 
-    return cursor.rowcount
+def insert_name(cursor, base_id, ctx, value, flags, index):
+    sql = _statement(_insert_name_sql, ctx, index is not None)
+    base_ctx = util.ctx_base_ctx(ctx)
+
+    if index is None:
+        cursor.execute(sql, (
+            base_id, ctx, value, flags,
+            base_id, ctx,
+            base_id, base_ctx))
+        return cursor.rowcount
+
+    return int(_place(cursor, 'name', (base_id, ctx), sql,
+            (base_id, base_ctx) + _slot_params((base_id, ctx), index) +
+            (base_id, ctx, value, flags)))
 
 
 def insert_prefix_lookup(cursor, value, flags, ctx, base_id):
@@ -1166,8 +1095,7 @@ values (%s, %s, %s, %s, %s)
     return True
 
 
-def select_names(cursor, base_id, ctx, limit, start):
-    cursor.execute("""
+_select_names_sql = """
 select flags, value, pos
 from name
 where
@@ -1176,16 +1104,18 @@ where
     and ctx=%s
     and pos >= %s
 order by pos asc
-limit %s
-""", (base_id, ctx, start, limit))
+"""
 
-    return [{
-            'base_id': base_id,
-            'flags': flags,
-            'ctx': ctx,
-            'pos': pos,
-            'value': value,
-        } for flags, value, pos in cursor.fetchall()]
+def select_names(cursor, base_id, ctx, limit, start):
+    cursor.execute(_select_names_sql + "limit %s\n",
+            (base_id, ctx, start, limit))
+
+    return cursor.fetchall()
+
+def iter_names(cursor, base_id, ctx, start, size):
+    cursor.execute(_select_names_sql, (base_id, ctx, start))
+
+    return _fetch_lazily(cursor, size)
 
 
 def select_prefix_lookups(cursor, value, ctx, base_id=None):
@@ -1229,18 +1159,52 @@ where
     return bool(cursor.rowcount)
 
 
-def search_prefixes(cursor, value, ctx, limit, start):
+def _prefix_successor(prefix):
+    # the least string above every string starting with prefix, in codepoint
+    # (and so "C" collation and utf8 byte) order, or None if there is none
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf8')
+
+    prefix = prefix.rstrip(unichr(sys.maxunicode))
+    if not prefix:
+        return None
+
+    last = ord(prefix[-1]) + 1
+    if 0xd800 <= last <= 0xdfff:
+        last = 0xe000
+    return prefix[:-1] + unichr(last)
+
+def search_prefixes(cursor, value, ctx, limit, start, start_id=None):
+    # a range over prefix_lookup_range_idx, rather than a "like" which a
+    # btree in the database's collation can't help with. with a start_id,
+    # pick up after the (start, start_id) row rather than after every row
+    # with the value start.
+    upper = _prefix_successor(value)
+    if upper is None:
+        bound, params = "", (ctx, value)
+    else:
+        bound = """
+    and value collate "C" < %s"""
+        params = (ctx, value, upper)
+
+    if start_id is None:
+        after = """value collate "C" > %s"""
+        params += (start, limit)
+    else:
+        after = """(value collate "C", base_id) > (%s, %s)"""
+        params += (start, start_id, limit)
+
     cursor.execute("""
 select base_id, flags, value
 from prefix_lookup
 where
     time_removed is null
-    and ctx=%s
-    and value like %s || '%%'
-    and value > %s
-order by value
-limit %s
-""", (ctx, value, start, limit))
+    and ctx=%%s
+    and value collate "C" >= %%s%s
+    and %s
+order by value collate "C", base_id
+limit %%s
+""" % (bound, after), params)
 
     return [{
             'base_id': base_id,
@@ -1250,18 +1214,26 @@ limit %s
         } for base_id, flags, value in cursor.fetchall()]
 
 
-def search_phonetics(cursor, code, ctx, limit, start):
+def search_phonetics(cursor, code, ctx, limit, start, start_value=None):
+    # with a start_value, pick up after the (start, start_value) row rather
+    # than after every row with the base_id start
+    if start_value is None:
+        after, params = "base_id > %s", (ctx, code, start, limit)
+    else:
+        after = """(base_id, value collate "C") > (%s, %s)"""
+        params = (ctx, code, start, start_value, limit)
+
     cursor.execute("""
 select base_id, flags, value
 from phonetic_lookup
 where
     time_removed is null
-    and ctx=%s
-    and code=%s
-    and base_id > %s
-order by base_id
-limit %s
-""", (ctx, code, start, limit))
+    and ctx=%%s
+    and code=%%s
+    and %s
+order by base_id, value collate "C"
+limit %%s
+""" % (after,), params)
 
     return [{
             'base_id': base_id,
@@ -1273,83 +1245,19 @@ limit %s
 
 
 def reorder_name(cursor, base_id, ctx, value, index):
-    cursor.execute("""
-with oldpos as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-), bump as (
-    update name
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update name
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning 1
-)
-select 1 from move
-""", (base_id, ctx, value,
-        base_id, ctx, index,
-        base_id, ctx,
-        index, index, base_id, ctx, value))
-
-    return bool(cursor.rowcount)
+    return _reorder(cursor, 'name', (base_id, ctx), value, index)
 
 
 def remove_name(cursor, base_id, ctx, value):
     cursor.execute("""
-with removal as (
-    update name
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update name
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (base_id, ctx, value, base_id, ctx))
+update name
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (base_id, ctx, value))
 
     return bool(cursor.rowcount)
 
@@ -1389,73 +1297,472 @@ update name
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning base_id, ctx, value
-""" % (','.join('%s' for x in base_ids),), base_ids)
+""", (list(base_ids),))
 
     return cursor.fetchall()
 
 
 def remove_prefix_lookups_multi(cursor, triples):
-    flat = reduce(lambda a, b: a.extend(b) or a, triples, [])
-
     cursor.execute("""
 update prefix_lookup
 set time_removed=now()
 where
     time_removed is null
-    and (base_id, ctx, value) in (%s)
+    and (base_id, ctx, value) in (select * from unnest(
+        %s::bigint[], %s::smallint[], %s::varchar[]))
 returning base_id, ctx, value
-""" % (','.join('(%s, %s, %s)' for t in triples),), flat)
+""", _columns(triples, 3))
 
     return cursor.fetchall()
 
 
 def remove_phonetic_lookups_multi(cursor, triples):
-    flat = reduce(lambda a, b: a.extend(b) or a, triples, [])
-
     cursor.execute("""
 update phonetic_lookup
 set time_removed=now()
 where
     time_removed is null
-    and (base_id, ctx, value) in (%s)
+    and (base_id, ctx, value) in (select * from unnest(
+        %s::bigint[], %s::smallint[], %s::varchar[]))
 returning base_id, ctx, value
-""" % (','.join('(%s, %s, %s)' for t in triples)), flat)
+""", _columns(triples, 3))
 
     return cursor.fetchall()
 
 
-def set_flags(cursor, table, add, clear, where):
-    if not add|clear:
-        return []
-
-    w_clause, w_values = ['time_removed is null'], []
-    s_clause, s_values = "", []
-    for key, val in where.items():
-        if val is None:
+def _set_flags_sql(ctx, table, add, clear, where):
+    w_clause = ['time_removed is null']
+    for key, null in where:
+        if null:
             w_clause.append('%s is null' % key)
         else:
             w_clause.append('%s=%%s' % key)
-            w_values.append(val)
     w_clause = ' and '.join(w_clause)
 
     if clear:
-        s_clause = "flags & ~%s"
-        s_values.append(clear)
+        # postgres can't tell which prefix ~ is meant for a bare parameter
+        s_clause = "flags & ~%s::smallint"
 
     if add:
         if clear:
             s_clause = "(%s) | %%s" % (s_clause,)
         else:
             s_clause = "flags | %s"
-        s_values.append(add)
 
-    cursor.execute("""
+    return """
 update %s
 set flags=%s
 where %s
 returning flags
-""" % (table, s_clause, w_clause), s_values + w_values)
+""" % (table, s_clause, w_clause)
+
+def set_flags(cursor, table, add, clear, where):
+    if not add|clear:
+        return []
+
+    where = where.items()
+    values = [v for v in (clear, add) if v]
+    values.extend(val for key, val in where if val is not None)
+
+    cursor.execute(_statement(_set_flags_sql, None, table, bool(add),
+        bool(clear), tuple((key, val is None) for key, val in where)),
+        values)
+
+    return [x[0] for x in cursor.fetchall()]
+
+
+def allocate_node_ids(cursor, count):
+    cursor.execute("""
+select nextval('node_ids')
+from generate_series(1, %s)
+""", (count,))
+
+    return [x[0] for x in cursor.fetchall()]
+
+
+# staging tables for bulk loads, filled by COPY. "seq" is the position of the
+# row in the input, so loads keep the input's ordering wherever it matters
+_STAGING = {
+    'bulk_node': (
+        'seq', 'id', 'ctx', 'flags', 'num', 'value', 'base_id', 'base_ctx'),
+    'bulk_property': (
+        'seq', 'base_id', 'base_ctx', 'ctx', 'flags', 'num', 'value'),
+    'bulk_alias': ('seq', 'base_id', 'base_ctx', 'ctx', 'value', 'flags'),
+    'bulk_alias_lookup': ('seq', 'hash', 'ctx', 'base_id', 'flags'),
+    'bulk_name': ('seq', 'base_id', 'base_ctx', 'ctx', 'value', 'flags'),
+    'bulk_prefix_lookup': ('seq', 'value', 'flags', 'ctx', 'base_id'),
+    'bulk_phonetic_lookup': (
+        'seq', 'code', 'value', 'flags', 'ctx', 'base_id'),
+}
+
+_STAGING_TYPES = {
+    'seq': 'int', 'id': 'bigint', 'base_id': 'bigint', 'ctx': 'smallint',
+    'base_ctx': 'smallint', 'flags': 'smallint', 'num': 'bigint',
+    'hash': 'bytea', 'code': 'varchar(4)',
+}
+
+def stage_rows(cursor, tbl, rows):
+    columns = _STAGING[tbl]
+    types = dict(_STAGING_TYPES,
+            value='bytea' if 'num' in columns else 'varchar(255)')
+
+    cursor.execute("""
+create temp table %s (%s) on commit drop
+""" % (tbl, ', '.join('%s %s' % (c, types[c]) for c in columns)))
+
+    cursor.copy_expert("copy %s (%s) from stdin" % (tbl, ', '.join(columns)),
+            _copy_file(rows))
+
+
+def bulk_insert_nodes(cursor):
+    # a node is loaded if its base is already in place, or is itself a node
+    # being loaded by this same statement
+    cursor.execute("""
+with recursive accepted (id, ctx) as (
+    select s.id, s.ctx
+    from bulk_node s
+    where
+        s.base_id is null
+        or exists (
+            select 1 from node
+            where
+                time_removed is null
+                and id=s.base_id
+                and ctx=s.base_ctx
+        )
+    union all
+    select s.id, s.ctx
+    from bulk_node s
+    join accepted a on s.base_id=a.id and s.base_ctx=a.ctx
+), nodes as (
+    insert into node (id, ctx, flags, num, value)
+    select s.id, s.ctx, s.flags, s.num, s.value
+    from bulk_node s
+    join accepted a on a.id=s.id
+    returning id
+), edges as (
+    insert into edge (base_id, ctx, child_id, pos)
+    select s.base_id, s.ctx, s.id, coalesce((
+        select max(pos)
+        from edge
+        where
+            time_removed is null
+            and base_id=s.base_id
+            and ctx=s.ctx
+    ), 0) + %d * row_number() over (
+        partition by s.base_id, s.ctx order by s.seq)
+    from bulk_node s
+    join accepted a on a.id=s.id
+    where s.base_id is not null
+)
+select id from nodes
+""" % (_GAP,))
+
+    return [x[0] for x in cursor.fetchall()]
+
+
+def bulk_insert_properties(cursor):
+    # the last row for a (base_id, ctx) wins, but an existing property is
+    # left alone
+    cursor.execute("""
+insert into property (base_id, ctx, flags, num, value)
+select distinct on (s.base_id, s.ctx)
+    s.base_id, s.ctx, s.flags, s.num, s.value
+from bulk_property s
+where
+    exists (
+        select 1 from node
+        where
+            time_removed is null
+            and id=s.base_id
+            and ctx=s.base_ctx
+    )
+    and not exists (
+        select 1 from property
+        where
+            time_removed is null
+            and base_id=s.base_id
+            and ctx=s.ctx
+    )
+order by s.base_id, s.ctx, s.seq desc
+""")
+
+    return cursor.rowcount
+
+
+def select_alias_lookups_multi(cursor, aliases):
+    digests, ctxs = _columns(aliases, 2)
+
+    cursor.execute("""
+select hash, ctx
+from alias_lookup
+where
+    time_removed is null
+    and (hash, ctx) in (
+        select * from unnest(%s::bytea[], %s::smallint[]))
+""", (map(psycopg2.Binary, digests), ctxs))
+
+    return [(str(h), ctx) for h, ctx in cursor.fetchall()]
+
+
+def bulk_insert_alias_lookups(cursor):
+    # the first claim on an alias wins
+    cursor.execute("""
+insert into alias_lookup (hash, ctx, base_id, flags)
+select distinct on (s.hash, s.ctx)
+    s.hash, s.ctx, s.base_id, s.flags
+from bulk_alias_lookup s
+where not exists (
+    select 1 from alias_lookup
+    where
+        time_removed is null
+        and hash=s.hash
+        and ctx=s.ctx
+)
+order by s.hash, s.ctx, s.seq
+returning hash, ctx, base_id
+""")
+
+    return [(str(h), ctx, base_id) for h, ctx, base_id in cursor.fetchall()]
+
+
+def bulk_insert_aliases(cursor):
+    cursor.execute("""
+with inserted as (
+    insert into alias (base_id, ctx, value, pos, flags)
+    select s.base_id, s.ctx, s.value, coalesce((
+        select max(pos)
+        from alias
+        where
+            time_removed is null
+            and base_id=s.base_id
+            and ctx=s.ctx
+    ), 0) + %d * row_number() over (
+        partition by s.base_id, s.ctx order by s.seq),
+        s.flags
+    from bulk_alias s
+    where exists (
+        select 1 from node
+        where
+            time_removed is null
+            and id=s.base_id
+            and ctx=s.base_ctx
+    )
+    returning base_id, ctx, value
+)
+select s.seq
+from bulk_alias s
+where not exists (
+    select 1 from inserted i
+    where i.base_id=s.base_id and i.ctx=s.ctx and i.value=s.value
+)
+""" % (_GAP,))
 
+    # the rejects, so their lookups can be taken back out
     return [x[0] for x in cursor.fetchall()]
+
+
+def bulk_insert_names(cursor):
+    cursor.execute("""
+insert into name (base_id, ctx, value, flags, pos)
+select s.base_id, s.ctx, s.value, s.flags, coalesce((
+    select max(pos)
+    from name
+    where
+        time_removed is null
+        and base_id=s.base_id
+        and ctx=s.ctx
+), 0) + %d * row_number() over (
+        partition by s.base_id, s.ctx order by s.seq)
+from (
+    select distinct on (base_id, ctx, value) *
+    from bulk_name
+    order by base_id, ctx, value, seq
+) s
+where
+    exists (
+        select 1 from node
+        where
+            time_removed is null
+            and id=s.base_id
+            and ctx=s.base_ctx
+    )
+    and not exists (
+        select 1 from name
+        where
+            time_removed is null
+            and base_id=s.base_id
+            and ctx=s.ctx
+            and value=s.value
+    )
+returning base_id, ctx, value, flags
+""" % (_GAP,))
+
+    return cursor.fetchall()
+
+
+def bulk_insert_prefix_lookups(cursor):
+    cursor.execute("""
+insert into prefix_lookup (value, flags, ctx, base_id)
+select value, flags, ctx, base_id
+from bulk_prefix_lookup
+order by seq
+""")
+
+    return cursor.rowcount
+
+
+def bulk_insert_phonetic_lookups(cursor):
+    cursor.execute("""
+insert into phonetic_lookup (code, value, flags, ctx, base_id)
+select code, value, flags, ctx, base_id
+from bulk_phonetic_lookup
+order by seq
+""")
+
+    return cursor.rowcount
+
+
+# every live row of a table, in an order that keeps parents ahead of their
+# children and positioned lists in their order
+_LIVE_ROWS = {
+    table.NODE: """
+select n.id, n.ctx, n.flags, n.num, n.value, e.base_id
+from node n
+left join edge e on e.child_id=n.id and e.time_removed is null
+where n.time_removed is null
+order by n.id
+""",
+    table.PROPERTY: """
+select base_id, ctx, flags, num, value
+from property
+where time_removed is null
+order by base_id, ctx
+""",
+    table.ALIAS: """
+select base_id, ctx, flags, value
+from alias
+where time_removed is null
+order by base_id, ctx, pos
+""",
+    table.NAME: """
+select base_id, ctx, flags, value
+from name
+where time_removed is null
+order by base_id, ctx, pos
+""",
+    table.RELATIONSHIP: """
+select base_id, ctx, flags, rel_id
+from relationship
+where time_removed is null and forward=true
+order by base_id, ctx, pos
+""",
+}
+
+def set_snapshot(cursor):
+    # have every later statement in the transaction read from the snapshot
+    # taken by the first. this has to run before any query in it
+    cursor.execute(
+            "set transaction isolation level repeatable read, read only")
+
+def select_live_rows(cursor, tbl):
+    # meant for a named (server-side) cursor, to be read with fetchmany()
+    cursor.execute(_LIVE_ROWS[tbl])
+
+
+# one batch of the tombstones removed longer than a retention ago, oldest
+# first, which the *_removed_idx partial indexes can find without a scan. a
+# ctid is only unique within a partition, so the retention is checked again
+# for the rows deleted; that can take a few more than the limit.
+_PURGES = dict((name, """
+delete from %s
+where
+    ctid = any(array(
+        select ctid
+        from %s
+        where time_removed < now() - %%s * interval '1 second'
+        order by time_removed
+        limit %%s))
+    and time_removed < now() - %%s * interval '1 second'
+""" % (name, name)) for name in (
+    'node', 'edge', 'property', 'alias', 'alias_lookup', 'relationship',
+    'name', 'prefix_lookup', 'phonetic_lookup'))
+
+def purge_removed(cursor, name, retention, limit):
+    cursor.execute(_PURGES[name], (retention, limit, retention))
+    return cursor.rowcount
+
+
+def _copy_file(rows):
+    # COPY's text format: tab-separated, \N for null, backslash escapes
+    buf = cStringIO.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(_copy_field, row)))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+def _copy_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, _Binary):
+        # bytea hex input, with its backslash escaped for COPY
+        return '\\\\x' + value.adapted.encode('hex')
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return _copy_escape(value)
+
+def _copy_escape(value):
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+_Binary = type(psycopg2.Binary(''))
+
+
+def _fetch_lazily(cursor, size):
+    # size rows per round trip, from a named (server-side) cursor
+    while 1:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _columns(rows, width):
+    # split rows of a fixed width into parallel lists, for unnest()
+    if not rows:
+        return ([],) * width
+    return map(list, zip(*rows))
+
+
+# the ctx-dependent queries to render in prime(), by the ctx's table
+_RENDERS = {
+    table.PROPERTY: [
+        (_select_property_sql, [()]),
+        (_upsert_property_sql, [()]),
+        (_update_property_sql, [()]),
+        (_remove_property_sql, [(None,), ('null',), ('value',)]),
+    ],
+    table.ALIAS: [
+        (_insert_alias_sql, [(False,), (True,)]),
+    ],
+    table.RELATIONSHIP: [
+        (_insert_relationship_sql,
+            [(f, i) for f in (True, False) for i in (False, True)]),
+    ],
+    table.NODE: [
+        (_insert_node_sql, [(False,), (True,)]),
+        (_select_node_sql, [()]),
+        (_update_node_sql, [(False,), (True,)]),
+    ],
+    table.NAME: [
+        (_insert_name_sql, [(False,), (True,)]),
+    ],
+}
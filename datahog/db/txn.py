@@ -4,9 +4,11 @@ from __future__ import absolute_import
 
 import contextlib
 import hashlib
+import heapq
 import hmac
 import random
 import sys
+import threading
 import time
 
 import psycopg2
@@ -134,6 +136,105 @@ class Timer(object):
             self.conn.cancel()
 
 
+def fanout(pool, jobs, func, timeout=None, stop=None, replica=False):
+    '''run ``func(cursor, *args)`` on each of a list of ``(shard, args)`` jobs
+
+    the jobs are run concurrently in the pool's background workers, at most
+    ``pool.max_fanout`` of them at a time. the results are returned in a list
+    in the same order as ``jobs``, and the first exception raised by any job
+    is re-raised here once the rest have finished.
+
+    if ``stop`` is provided, it is called with each result as it comes in. as
+    soon as it returns true, queries still in flight on other shards are
+    cancelled and jobs that haven't started yet are skipped (their places in
+    the results list are left as ``None``).
+
+    with ``replica`` set, the jobs are run against the shards' read replicas
+    where there are any.
+    '''
+    results = [None] * len(jobs)
+
+    if len(jobs) == 1:
+        # no sense paying for a background worker
+        shard, args = jobs[0]
+        with pool.get_by_shard(
+                shard, timeout=timeout, replica=replica) as conn:
+            results[0] = func(conn.cursor(), *args)
+        return results
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    pending = range(len(jobs) - 1, -1, -1)
+    active = {}
+    failures = []
+    stopped = []
+
+    # a connection leaves active under this lock before it goes back to the
+    # pool, so a stop can't cancel a query that someone else has since
+    # started on it
+    lock = threading.Lock()
+
+    def worker(done):
+        try:
+            while not (failures or stopped):
+                try:
+                    index = pending.pop()
+                except IndexError:
+                    break
+
+                shard, args = jobs[index]
+                if timeout is not None:
+                    wait = max(deadline - time.time(), 0)
+                else:
+                    wait = None
+
+                with pool.get_by_shard(
+                        shard, timeout=wait, replica=replica) as conn:
+                    with lock:
+                        active[index] = conn
+                    try:
+                        result = func(conn.cursor(), *args)
+                    finally:
+                        with lock:
+                            active.pop(index, None)
+                results[index] = result
+
+                if stop is not None and not stopped and stop(result):
+                    stopped.append(index)
+                    with lock:
+                        for other in active.values():
+                            try:
+                                pool._cancel(other)
+                            except Exception:
+                                pass
+        except Exception:
+            # failures of queries we cancelled ourselves aren't interesting
+            if not stopped:
+                failures.append(sys.exc_info())
+        finally:
+            done.set()
+
+    events = []
+    for i in xrange(min(len(jobs), pool.max_fanout)):
+        ev = pool._ev()
+        events.append(ev)
+        pool._background(lambda ev=ev: worker(ev))
+
+    for ev in events:
+        ev.wait()
+
+    if failures:
+        klass, exc, tb = failures[0]
+        raise klass, exc, tb
+
+    return results
+
+
+def _found(result):
+    return result is not None
+
+
 def set_property(conn, base_id, ctx, value, flags):
     cursor = conn.cursor()
     try:
@@ -147,22 +248,13 @@ def set_property(conn, base_id, ctx, value, flags):
 
 
 def lookup_alias(pool, digest, ctx, timeout):
-    timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _lookup_alias(pool, digest, ctx, timer)
-    with timer:
-        return _lookup_alias(pool, digest, ctx, timer)
-
-def _lookup_alias(pool, digest, ctx, timer):
-    for shard in pool.shards_for_lookup_hash(digest):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-
-            alias = query.select_alias_lookup(conn.cursor(), digest, ctx)
-            if alias is not None:
-                return alias
-
-            timer.conn = None
+    # an alias_lookup only lives on one shard, so the first hit wins
+    jobs = [(shard, (digest, ctx))
+            for shard in pool.shards_for_lookup_hash(digest)]
+    for alias in fanout(pool, jobs, query.select_alias_lookup, timeout, _found,
+            replica=True):
+        if alias is not None:
+            return alias
 
     return None
 
@@ -724,99 +816,152 @@ def _write_phonetic_lookups(pool, base_id, ctx, value, flags, timer):
 
 
 def search_names(pool, value, ctx, limit, start, timeout):
-    timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _search_names(pool, value, ctx, limit, start, timer)
-    with timer:
-        return _search_names(pool, value, ctx, limit, start, timer)
-
-
-def _search_names(pool, value, ctx, limit, start, timer):
     sclass = util.ctx_search(ctx)
 
     if sclass == search.PREFIX:
-        return _search_prefix(pool, value, ctx, limit, start, timer)
+        return _search_prefix(pool, value, ctx, limit, start, timeout)
 
     if sclass == search.PHONETIC:
-        return _search_phonetic(pool, value, ctx, limit, start, timer)
+        return _search_phonetic(pool, value, ctx, limit, start, timeout)
+
+
+def _fetch_chunk(cursor, fetch, start, count):
+    return fetch(cursor, start, count)
+
+def _merge_streams(pool, streams, limit, timeout, unique=None):
+    '''streaming k-way merge of ordered per-shard results
+
+    ``streams`` is a list of ``(shard, fetch, key, start)``, where
+    ``fetch(cursor, start, count)`` returns up to ``count`` rows following
+    ``start`` in ``key`` order, and ``key(row)`` is both the merge key and the
+    ``start`` for fetching the chunk after ``row``.
+
+    the first chunk from every shard is fetched concurrently, and is only big
+    enough for that shard's share of ``limit``. further chunks are fetched from
+    a shard only once the merge has consumed everything it has sent so far,
+    and never ask for more than the rows still needed.
+
+    if ``unique`` is provided, rows for which it returns an already-seen value
+    are dropped. returns a two-tuple of the merged list of at most ``limit``
+    rows, and a list with the last row consumed from each stream (or None).
+    '''
+    tails = [None] * len(streams)
+    if limit <= 0 or not streams:
+        return [], tails
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    first = -(-limit // len(streams))
+    chunks = fanout(pool,
+            [(shard, (fetch, start, first))
+                for shard, fetch, key, start in streams],
+            _fetch_chunk, timeout, replica=True)
+
+    results = []
+
+    def stream(i, chunk, requested):
+        shard, fetch, key, start = streams[i]
+        n = 0
+        while 1:
+            for row in chunk:
+                yield key(row), i, n, row
+                n += 1
+
+            if len(chunk) < requested:
+                break
+
+            # only reached once the merge wants more than we've fetched
+            start = key(chunk[-1])
+            requested = limit - len(results)
+            if timeout is not None:
+                wait = max(deadline - time.time(), 0)
+            else:
+                wait = None
+            with pool.get_by_shard(
+                    shard, timeout=wait, replica=True) as conn:
+                chunk = fetch(conn.cursor(), start, requested)
+
+    seen = set()
+    for key, i, n, row in heapq.merge(
+            *[stream(i, chunk, first) for i, chunk in enumerate(chunks)]):
+        tails[i] = row
+
+        if unique is not None:
+            u = unique(row)
+            if u in seen:
+                continue
+            seen.add(u)
+
+        results.append(row)
+        if len(results) >= limit:
+            break
+
+    return results, tails
 
 
-def _search_prefix(pool, value, ctx, limit, start, timer):
+def _prefix_key(row):
+    # with base_id to break ties, so chunks pick up mid-way through a value
+    return row['value'], row['base_id']
+
+def _search_prefix(pool, value, ctx, limit, start, timeout):
     if start is None:
         start = ''
 
-    names = []
-    shards = list(pool.shards_for_lookup_prefix(value.encode('utf8')))
-    for shard in shards:
-        with pool.get_by_shard(shard) as conn:
-            try:
-                timer.conn = conn
-                names.extend(query.search_prefixes(
-                    conn.cursor(), value, ctx, limit, start))
-            finally:
-                timer.conn = None
+    def fetch(cursor, start, count):
+        return query.search_prefixes(cursor, value, ctx, count, *start)
 
-    if len(shards) > 1:
-        names.sort(key=lambda name: name['value'])
-        names = names[:limit]
+    names, tails = _merge_streams(pool,
+            [(shard, fetch, _prefix_key, (start, None))
+                for shard in pool.shards_for_lookup_prefix(
+                    value.encode('utf8'))],
+            limit, timeout)
 
-    return names, names[-1]['value']
+    return names, names[-1]['value'] if names else start
 
 
-def _sortkey(shardbits):
-    def f(d):
-        return (d['base_id'] & ((1 << (64 - shardbits)) - 1)), d['base_id']
-    return f
+def _phonetic_key(row):
+    # with value to break ties, so chunks pick up mid-way through a base_id
+    return row['base_id'], row['value']
 
-def _phontoken(results):
-    token = {}
-    for r in results:
-        token[r.pop('code')] = r['base_id']
-    return token
+def _phonetic_unique(row):
+    return row['base_id'], row['ctx'], row['value']
 
-def _search_phonetic(pool, value, ctx, limit, start, timer):
+def _search_phonetic(pool, value, ctx, limit, start, timeout):
     if start is None:
         start = {}
 
     dm, dmalt = util.dmetaphone(value)
-    results = []
-    for shard in pool.shards_for_lookup_phonetic(dm):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                results.extend(query.search_phonetics(
-                        conn.cursor(), dm, ctx, limit, start.get(dm, 0)))
-            finally:
-                timer.conn = None
+    codes = [dm]
+    if dmalt is not None and util.ctx_phonetic_loose(ctx):
+        codes.append(dmalt)
 
-    if dmalt is None or not util.ctx_phonetic_loose(ctx):
-        return results, _phontoken(results)
+    def fetcher(code):
+        def fetch(cursor, start, count):
+            return query.search_phonetics(cursor, code, ctx, count, *start)
+        return fetch
 
-    for shard in pool.shards_for_lookup_phonetic(dmalt):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                results.extend(query.search_phonetics(
-                    conn.cursor(), dmalt, ctx, limit, start.get(dmalt, 0)))
-            finally:
-                timer.conn = None
+    streams = []
+    for code in codes:
+        fetch = fetcher(code)
+        streams.extend(
+                (shard, fetch, _phonetic_key, (start.get(code, 0), None))
+                for shard in pool.shards_for_lookup_phonetic(code))
 
-    # global sort
-    results.sort(key=_sortkey(pool.shardbits))
+    # every stream is in base_id order, which is also what the paging token
+    # tracks, so a merge on base_id pages correctly
+    results, tails = _merge_streams(pool, streams, limit, timeout,
+            _phonetic_unique if len(codes) > 1 else None)
 
-    token = _phontoken(results)
+    token = dict((code, start[code]) for code in codes if code in start)
+    for row in tails:
+        if row is not None:
+            token[row['code']] = max(token.get(row['code']), row['base_id'])
 
-    # de-duplicate by the unique criteria
-    copy = []
-    seen = set()
-    for r in results:
-        trip = (r['base_id'], r['ctx'], r['value'])
-        if trip in seen:
-            continue
-        seen.add(trip)
-        copy.append(r)
-    results = copy
-    return results[:limit], token
+    for row in results:
+        row.pop('code')
+
+    return results, token
 
 
 def set_name_flags(pool, base_id, ctx, value, add, clear, timeout):
@@ -1177,35 +1322,35 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
         query.remove_properties_multiple_bases(cursor, ids)
 
         aliases = query.remove_aliases_multiple_bases(cursor, ids)
-        for value, ctx in aliases:
-            digest = hmac.new(pool.digestkey, value, hashlib.sha1).digest()
+        digests = [hmac.new(pool.digestkey, value, hashlib.sha1).digest()
+                for value, ctx in aliases]
+        for (value, ctx), digest, shards in zip(
+                aliases, digests, pool.shards_for_lookup_hashes(digests)):
             # add each alias_lookup to every shard it *might* live on
-            for s in pool.shards_for_lookup_hash(digest):
+            for s in shards:
                 group = estate.setdefault(s, (set(), set(), [], []))[0]
                 group.add((digest, ctx))
 
         names = query.remove_names_multiple_bases(cursor, ids)
-        for base_id, ctx, value in names:
-            for s in pool.shards_for_lookup_prefix(value):
+        for (base_id, ctx, value), shards in zip(names,
+                pool.shards_for_lookup_prefixes([n[2] for n in names])):
+            for s in shards:
                 group = estate.setdefault(s, (set(), set(), [], []))[1]
                 group.add((base_id, ctx, value))
 
         removed_rels = query.remove_relationships_multiple_bases(cursor, ids)
-        for base_id, ctx, forward, rel_id in removed_rels:
-            # append each relationship to the shard at the rel_id end
-            if forward:
-                s = pool.shard_by_id(rel_id)
-            else:
-                s = pool.shard_by_id(base_id)
+        # append each relationship to the shard at the rel_id end
+        for (base_id, ctx, forward, rel_id), s in zip(removed_rels,
+                pool.shards_by_id([r[3] if r[2] else r[0]
+                    for r in removed_rels])):
             if s == shard:
                 continue
             item = (base_id, ctx, not forward, rel_id)
             estate.setdefault(s, (set(), set(), [], []))[2].append(item)
 
         children = query.remove_edges_multiple_bases(cursor, ids)
-        for id in children:
+        for id, s in zip(children, pool.shards_by_id(children)):
             # append each child node to its shard
-            s = pool.shard_by_id(id)
             estate.setdefault(s, (set(), set(), [], []))[3].append(id)
 
         ids = estate[shard][3][:]
@@ -1215,16 +1360,18 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
 
     if alias_lookups:
         removed = query.remove_alias_lookups_multi(cursor, list(alias_lookups))
-        for pair in removed:
-            for s in pool.shards_for_lookup_hash(pair[0]):
+        for pair, shards in zip(removed,
+                pool.shards_for_lookup_hashes([p[0] for p in removed])):
+            for s in shards:
                 if s == shard:
                     continue
                 estate[s][0].discard(pair)
 
     if name_lookups:
         removed = _remove_lookups(cursor, name_lookups)
-        for triple in removed:
-            for s in pool.shards_for_lookup_prefix(triple[2]):
+        for triple, shards in zip(removed,
+                pool.shards_for_lookup_prefixes([t[2] for t in removed])):
+            for s in shards:
                 if s == shard:
                     continue
                 estate[s][1].discard(triple)
@@ -1232,18 +1379,6 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
     if rels:
         query.remove_relationships_multi(cursor, rels)
 
-        forw, rev = set(), set()
-        for base_id, ctx, forward, rel_id in rels:
-            if forward:
-                forw.add((base_id, ctx))
-            else:
-                rev.add((rel_id, ctx))
-        if forw:
-            query.bulk_reorder_relationships(cursor, forw, True)
-        if rev:
-            query.bulk_reorder_relationships(cursor, rev, False)
-
-
     estate.pop(shard)
 
 
@@ -1299,3 +1434,150 @@ def _remove_node(pool, id, ctx, base_id, timer):
             tpc.commit()
 
     return True
+
+
+def allocate_node_ids(pool, counts, timeout):
+    jobs = [(shard, (count,)) for shard, count in counts.iteritems()]
+    allocated = fanout(pool, jobs, query.allocate_node_ids, timeout)
+    return dict((shard, ids) for (shard, args), ids in zip(jobs, allocated))
+
+
+def bulk_load(pool, nodes, props, aliases, names, timeout):
+    '''load pre-routed rows into their shards
+
+    ``nodes``, ``props`` and ``names`` are dicts mapping shard to staging
+    rows (see ``query._STAGING``). ``aliases`` maps shard to a list of
+    ``(alias row, lookup shard, lookup row, older lookup shards)``.
+
+    returns the ids of the nodes that were loaded, and the numbers of
+    properties, names and aliases.
+    '''
+    # aliases claimed on the shards of older insertion plans can't be taken
+    taken = _bulk_taken_aliases(pool, aliases, timeout)
+    lookups = {}
+    for shard, group in aliases.iteritems():
+        for alias, lookup_shard, lookup, older in group:
+            if (str(lookup[1].adapted), lookup[2]) not in taken:
+                lookups.setdefault(lookup_shard, []).append(lookup)
+
+    # first pass: everything that isn't waiting on a lookup to be claimed
+    shards = sorted(set(nodes) | set(props) | set(names) | set(lookups))
+    jobs = [(shard, (nodes.get(shard), props.get(shard), names.get(shard),
+            lookups.get(shard))) for shard in shards]
+    node_ids, prop_count, loaded_names, claimed = [], 0, [], set()
+    for n, p, nm, c in fanout(pool, jobs, _bulk_load_first, timeout):
+        node_ids.extend(n)
+        prop_count += p
+        loaded_names.extend(nm)
+        claimed.update(c)
+
+    # second pass: the aliases whose lookups were claimed, and name lookups
+    alias_rows = {}
+    unclaim = {}
+    for shard, group in aliases.iteritems():
+        for alias, lookup_shard, lookup, older in group:
+            key = (str(lookup[1].adapted), lookup[2], lookup[3])
+            if key in claimed:
+                # only the first of any repeats of the same alias
+                claimed.discard(key)
+                alias_rows.setdefault(shard, []).append(alias)
+                unclaim[alias[0]] = (lookup_shard, key[:2])
+
+    prefixes, phonetics = _bulk_name_lookups(pool, loaded_names)
+    shards = sorted(set(alias_rows) | set(prefixes) | set(phonetics))
+    jobs = [(shard, (alias_rows.get(shard), prefixes.get(shard),
+            phonetics.get(shard))) for shard in shards]
+    rejected = {}
+    for rejects in fanout(pool, jobs, _bulk_load_second, timeout):
+        for seq in rejects:
+            shard, pair = unclaim[seq]
+            rejected.setdefault(shard, []).append(pair)
+
+    # take back the lookups claimed for aliases that couldn't be loaded
+    if rejected:
+        fanout(pool, [(shard, (pairs,)) for shard, pairs in
+            rejected.iteritems()], query.remove_alias_lookups_multi, timeout)
+
+    alias_count = len(unclaim) - sum(map(len, rejected.itervalues()))
+    return node_ids, prop_count, len(loaded_names), alias_count
+
+
+def _bulk_taken_aliases(pool, aliases, timeout):
+    checks = {}
+    for shard, group in aliases.iteritems():
+        for alias, lookup_shard, lookup, older in group:
+            for other in older:
+                checks.setdefault(other, []).append(
+                        (str(lookup[1].adapted), lookup[2]))
+    if not checks:
+        return set()
+
+    jobs = [(shard, (pairs,)) for shard, pairs in checks.iteritems()]
+    taken = set()
+    for found in fanout(pool, jobs, query.select_alias_lookups_multi,
+            timeout):
+        taken.update(found)
+    return taken
+
+
+def _bulk_name_lookups(pool, loaded_names):
+    prefixes, phonetics = {}, {}
+    for seq, (base_id, ctx, value, flags) in enumerate(loaded_names):
+        if isinstance(value, str):
+            value = value.decode('utf8')
+        sclass = util.ctx_search(ctx)
+        if sclass == search.PREFIX:
+            shard = pool.shard_for_prefix_write(value.encode('utf8'))
+            prefixes.setdefault(shard, []).append(
+                    (seq, value, flags, ctx, base_id))
+        elif sclass == search.PHONETIC:
+            dm, dmalt = util.dmetaphone(value)
+            codes = [dm]
+            if dmalt is not None and util.ctx_phonetic_loose(ctx):
+                codes.append(dmalt)
+            for code in codes:
+                shard = pool.shard_for_phonetic_write(code)
+                phonetics.setdefault(shard, []).append(
+                        (seq, code, value, flags, ctx, base_id))
+    return prefixes, phonetics
+
+
+def _bulk_load_first(cursor, nodes, props, names, lookups):
+    node_ids, prop_count, loaded_names, claimed = [], 0, [], []
+
+    if nodes:
+        query.stage_rows(cursor, 'bulk_node', nodes)
+        node_ids = query.bulk_insert_nodes(cursor)
+
+    if props:
+        query.stage_rows(cursor, 'bulk_property', props)
+        prop_count = query.bulk_insert_properties(cursor)
+
+    if names:
+        query.stage_rows(cursor, 'bulk_name', names)
+        loaded_names = query.bulk_insert_names(cursor)
+
+    if lookups:
+        query.stage_rows(cursor, 'bulk_alias_lookup', lookups)
+        claimed = query.bulk_insert_alias_lookups(cursor)
+
+    return node_ids, prop_count, loaded_names, claimed
+
+
+def _bulk_load_second(cursor, aliases, prefixes, phonetics):
+    rejects = []
+
+    if aliases:
+        query.stage_rows(cursor, 'bulk_alias', aliases)
+        rejects = query.bulk_insert_aliases(cursor)
+
+    if prefixes:
+        query.stage_rows(cursor, 'bulk_prefix_lookup', prefixes)
+        query.bulk_insert_prefix_lookups(cursor)
+
+    if phonetics:
+        query.stage_rows(cursor, 'bulk_phonetic_lookup', phonetics)
+        query.bulk_insert_phonetic_lookups(cursor)
+
+    return rejects
+
@@ -1,10 +1,16 @@
 # vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
 
 import bisect
+import collections
 import contextlib
+import fractions
+import os
 import Queue
 import random
+import sys
+import threading
 import time
+import weakref
 
 try:
     import greenhouse
@@ -28,6 +34,7 @@ import psycopg2.extensions
 
 from . import error
 from .const import util
+from .db import prepared
 
 __all__ = []
 
@@ -52,6 +59,32 @@ class ConnectionPool(object):
             - ``password``: user's password
             - ``database``: database name
 
+            These keys are optional, and let the pool grow and shrink with
+            demand:
+
+            - ``min``: the number of connections to open at :meth:`start`,
+              and never to shrink below (defaults to ``count``, which may
+              be left out if ``min`` is provided)
+            - ``max``: the most connections to ever hold open at once. when
+              a connection is requested and none are idle, a new one is
+              opened if there are fewer than this (defaults to ``min``)
+            - ``idle_timeout``: seconds a connection may sit unused before it
+              is closed, so long as that leaves at least ``min``
+            - ``max_lifetime``: seconds after which a connection is closed
+              (and replaced, if needed to keep ``min``) rather than returned
+              to the pool
+            - ``ping_interval``: seconds a connection may sit unused before
+              it is checked with a trivial query, so that connections broken
+              while idle (by a db restart, say) are replaced before they get
+              handed out
+            - ``replicas``: a list of dicts describing read replicas of this
+              shard. each takes the same keys as the shard dict (other than
+              ``shard``), falling back to the primary's values for any that
+              are left out, plus an optional integer ``weight`` (default 1).
+              reads that can tolerate replication lag are spread across the
+              replicas in proportion to their weights, everything else goes
+              to the primary
+
         ``lookup_insertion_plans``
             Lists of lists of two-tuples of shard numbers, and their integer
             weights. This is used for the associated lookup tables of aliases
@@ -87,27 +120,79 @@ class ConnectionPool(object):
             optional, the default implementation performs exponential backoff
             with random jitter, trying for a total of around 20 seconds.
 
+        ``max_fanout``
+            The maximum number of shards that a single multi-shard read (like
+            :func:`node.batch_get <datahog.api.node.batch_get>`) will query
+            concurrently. This key is optional, the default is 16.
+
+        ``prepared_statements``
+            Whether to run frequently repeated queries as server-side prepared
+            statements, so postgres only parses and plans them once per
+            connection (see :class:`datahog.db.prepared.Statements`). This key
+            is optional, the default is ``False``.
+
+        ``stats_sink``
+            A function to be called as ``sink(shard, event, value)`` on every
+            instrumented pool event (see :meth:`add_stats_sink
+            <ConnectionPool.add_stats_sink>`). This key is optional.
+
     :param bool readonly:
         Whether to disallow data-modifying methods against this connection
         pool. Can be useful for querying replication slaves to take some read
         load off of the masters (default ``False``).
+
+    :param bool compact:
+        Whether the API returns the objects it fetches through this pool as
+        records from :mod:`datahog.record` rather than dicts. Records are
+        tuples with the dict's keys as attributes, taking a fraction of a
+        dict's memory; they're immutable, and ``_asdict()`` gets the dict
+        back (default ``False``).
     '''
 
-    def __init__(self, dbconf, readonly=False):
+    def __init__(self, dbconf, readonly=False, compact=False):
         self.readonly = readonly
+        self.compact = compact
         self._dbconf = dbconf
         self._conns = {}
         self._out = {}
         self._ready_evs = []
+        self._shards = {}
+        self._confs = []
+        self._replicas = {}
+        self._sizes = {}
+        self._pending = {}
+        self._waiting = {}
+        self._born = {}
+        self._idle = {}
+        self._checked = {}
+        self._taken = {}
+        self._cancelled = set()
+        self._stats = {}
+        self._sinks = []
+
+        # guards the bookkeeping above. it is never held across anything that
+        # blocks, so it costs the green pools nothing but the acquire/release
+        self._lock = threading.RLock()
+
+        # connections inherited across a fork, which must never be closed
+        self._pid = None
+        self._orphans = []
+        self._forked_out = set()
+        self._reaper_token = None
 
         self._init_conf()
 
         self.shardbits = self._dbconf['shard_bits']
         self.digestkey = self._dbconf['digest_key']
 
+        self.max_fanout = self._dbconf.get('max_fanout', 16)
+
         if 'connection_backoff' in self._dbconf:
             self.backoff = self._dbconf['connection_backoff']
 
+        if 'stats_sink' in self._dbconf:
+            self.add_stats_sink(self._dbconf['stats_sink'])
+
     def _init_conf(self):
         conf = self._dbconf
 
@@ -118,30 +203,120 @@ class ConnectionPool(object):
 
         for plan in conf['lookup_insertion_plans']:
             _prepare_plan(plan)
+        self._router = _Router(conf['lookup_insertion_plans'])
 
         for shard in conf['shards']:
-            for key in ('shard', 'count', 'host', 'port', 'user', 'password',
+            for key in ('shard', 'host', 'port', 'user', 'password',
                     'database'):
                 if key not in shard:
                     raise Exception("missing shard dict key %r" % key)
 
+            _init_sizes(shard)
+            self._shards[shard['shard']] = shard
+            self._stats[shard['shard']] = _ShardStats()
+            self._confs.append(shard)
+
+            if shard.get('replicas'):
+                self._init_replicas(shard)
+
         if 'root_insertion_plan' not in conf:
             conf['root_insertion_plan'] = [(s['shard'], 1)
                     for s in conf['shards']]
         _prepare_plan(conf['root_insertion_plan'])
 
+    def _init_replicas(self, shard):
+        partials, keys = [], []
+        for i, replica in enumerate(shard['replicas']):
+            # replicas are pooled like shards of their own, under a tuple key
+            key = (shard['shard'], i)
+            conf = dict((k, v) for k, v in shard.iteritems()
+                    if k not in ('replicas', 'count', 'min', 'max'))
+            conf.update(replica)
+            conf['shard'] = key
+            if 'min' not in conf and 'count' not in conf:
+                conf['min'], conf['max'] = shard['min'], shard['max']
+            _init_sizes(conf)
+
+            shard['replicas'][i] = conf
+            self._shards[key] = conf
+            self._stats[key] = _ShardStats()
+            self._confs.append(conf)
+
+            partials.append(
+                    (partials[-1] if partials else 0) + conf.get('weight', 1))
+            keys.append(key)
+
+        self._replicas[shard['shard']] = (partials, keys)
+
     def start(self):
         '''Initiate the DB connections
 
         This method won't block, use :meth:`wait_ready` to wait until the
         connections have all been established.
         '''
-        for shard in self._dbconf['shards']:
+        self._pid = os.getpid()
+        self._open(True)
+
+    def after_fork(self, warm=False):
+        '''Re-establish the pool in a newly forked child process
+
+        Connections inherited from the parent process share its sockets, so
+        they are set aside for the life of the process without ever being
+        used or closed (closing one would end the parent's session). New
+        connections are then made as they are needed.
+
+        This happens automatically the first time a started pool is used in a
+        new process, so calling it by hand is only needed for the ``warm``
+        option, from a pre-fork server's post-fork hook for instance.
+
+        :param bool warm:
+            Whether to start connecting ``min`` connections per shard right
+            away, rather than opening them on demand. Like :meth:`start`, this
+            doesn't block, use :meth:`wait_ready` for that.
+        '''
+        # a lock held by another of the parent's threads at the time of the
+        # fork would never be released in this process
+        self._lock = threading.RLock()
+
+        self._orphans.append(self._conns)
+        self._forked_out.update(self._out)
+        for bookkeeping in (self._out, self._taken, self._born, self._idle,
+                self._checked):
+            bookkeeping.clear()
+        for shard in self._stats:
+            self._stats[shard] = _ShardStats()
+        self._conns = {}
+        self._ready_evs = []
+
+        self._pid = os.getpid()
+        self._open(warm)
+
+    def _open(self, warm):
+        for shard in self._confs:
             self._conns[shard['shard']] = self._q()
-            for i in xrange(shard['count']):
+            self._sizes[shard['shard']] = 0
+            self._pending[shard['shard']] = 0
+            self._waiting[shard['shard']] = 0
+            if not warm:
+                continue
+            for i in xrange(shard['min']):
                 ev = self._ev()
                 self._ready_evs.append(ev)
-                self._start_conn(shard, ev)
+                self._grow(shard, ev)
+
+        reap_after = [s[key] for s in self._confs
+                for key in ('idle_timeout', 'max_lifetime', 'ping_interval')
+                if s.get(key)]
+        if reap_after:
+            # stops any reaper left running from before a fork
+            self._reaper_token = token = object()
+            self._background(_reaper(self, min(reap_after) / 2.0, token))
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    self.after_fork()
 
     def wait_ready(self, timeout=None):
         '''Block until all dB connections are ready (or have exhausted retries)
@@ -167,40 +342,147 @@ class ConnectionPool(object):
 
         return True
 
-    def put(self, conn):
-        shard = self._out.pop(id(conn))
-        self._conns[shard].put(conn)
+    def put(self, conn, broken=False):
+        self._check_pid()
+        now = time.time()
+        with self._lock:
+            if id(conn) in self._forked_out:
+                # checked out before a fork, so it belongs to the parent
+                self._forked_out.discard(id(conn))
+                self._orphans.append(conn)
+                return
+
+            shard = self._out.pop(id(conn))
+            held = now - self._taken.pop(id(conn), now)
+            self._cancelled.discard(id(conn))
+            self._stats[shard].latency[
+                    bisect.bisect_left(LATENCY_BUCKETS, held)] += 1
+
+            broken = broken or conn.closed or self._expired(
+                    self._shards[shard], conn, now)
+            if not broken:
+                self._idle[id(conn)] = self._checked[id(conn)] = now
+
+        if broken:
+            self._replace(shard, conn)
+        else:
+            self._conns[shard].put(conn)
+
+        self._emit(shard, 'latency', held)
+
+    def add_stats_sink(self, sink):
+        '''register a function to be notified of instrumented pool events
+
+        ``sink`` is called as ``sink(shard, event, value)``, where ``shard``
+        is the shard number (or ``(shard, n)`` for the nth read replica), and
+        ``event`` is one of:
+
+        ``'wait'``
+            a connection was checked out, ``value`` is the seconds spent
+            waiting for it
+
+        ``'timeout'``
+            an :class:`error.Timeout <datahog.error.Timeout>` was raised,
+            either waiting for a connection or running a query. ``value`` is
+            ``None``
+
+        ``'latency'``
+            a connection was returned to the pool, ``value`` is the seconds it
+            was checked out for
+
+        sinks are called synchronously from the pool's hot path, so they
+        should be quick and must not raise.
+        '''
+        self._sinks.append(sink)
+
+    def remove_stats_sink(self, sink):
+        '''unregister a function registered with :meth:`add_stats_sink`
+        '''
+        self._sinks.remove(sink)
+
+    def stats(self):
+        '''take a snapshot of the pool's instrumentation
+
+        :returns:
+            a dict mapping shard numbers (and ``(shard, n)`` read replica keys)
+            to dicts with keys:
+
+            - ``size``: connections open or being opened
+            - ``in_use``: connections currently checked out
+            - ``idle``: connections sitting in the pool
+            - ``waiting``: checkouts blocked waiting for a connection
+            - ``checkouts``: total connections checked out
+            - ``timeouts``: total :class:`Timeouts <datahog.error.Timeout>`
+            - ``wait_total``: total seconds spent waiting for connections
+            - ``wait_max``: longest wait for a connection, in seconds
+            - ``latency``: a histogram of the time connections were checked
+              out for, as a list of ``(upper_bound, count)`` pairs, with
+              upper bounds in seconds and ``None`` for the last (unbounded)
+              bucket
+
+            the totals count from the creation of the pool.
+        '''
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        in_use = dict.fromkeys(self._stats, 0)
+        for shard in self._out.itervalues():
+            in_use[shard] += 1
+
+        snapshot = {}
+        for shard, stats in self._stats.iteritems():
+            queue = self._conns.get(shard)
+            snapshot[shard] = {
+                'size': self._sizes.get(shard, 0),
+                'in_use': in_use[shard],
+                'idle': queue.qsize() if queue is not None else 0,
+                'waiting': self._waiting.get(shard, 0),
+                'checkouts': stats.checkouts,
+                'timeouts': stats.timeouts,
+                'wait_total': stats.wait_total,
+                'wait_max': stats.wait_max,
+                'latency': zip(LATENCY_BUCKETS + (None,), stats.latency),
+            }
+        return snapshot
+
+    def _emit(self, shard, event, value):
+        for sink in self._sinks:
+            sink(shard, event, value)
+
+    def _timed_out(self, shard):
+        with self._lock:
+            self._stats[shard].timeouts += 1
+        self._emit(shard, 'timeout', None)
+        return error.Timeout()
 
     def shard_by_id(self, id):
         return id >> (64 - self.shardbits)
 
+    def shards_by_id(self, ids):
+        bits = 64 - self.shardbits
+        return [id >> bits for id in ids]
+
     def shards_for_lookup_hash(self, digest):
-        num = _int_hash(digest)
-        seen = set()
-        for plan in self._dbconf['lookup_insertion_plans'][::-1]:
-            shard = _pick_from_plan(digest, plan, num)
-            if shard in seen:
-                continue
-            seen.add(shard)
-            yield shard
+        return self._router.route(_int_hash(digest))
+
+    def shards_for_lookup_hashes(self, digests):
+        route = self._router.route
+        return [route(_int_hash(digest)) for digest in digests]
 
     def shards_for_lookup_prefix(self, value):
-        num = ord(value[0])
-        seen = set()
-        for plan in self._dbconf['lookup_insertion_plans'][::-1]:
-            shard = _pick_from_plan(None, plan, num)
-            if shard in seen:
-                continue
-            seen.add(shard)
-            yield shard
+        return self._router.route(ord(value[0]))
+
+    def shards_for_lookup_prefixes(self, values):
+        route = self._router.route
+        return [route(ord(value[0])) for value in values]
 
+    # the newest plan's pick always comes first in the candidates
     def shard_for_alias_write(self, digest):
-        return _pick_from_plan(digest,
-                self._dbconf['lookup_insertion_plans'][-1])
+        return self._router.route(_int_hash(digest))[0]
 
     def shard_for_prefix_write(self, value):
-        return _pick_from_plan(None,
-                self._dbconf['lookup_insertion_plans'][-1], ord(value[0]))
+        return self._router.route(ord(value[0]))[0]
 
     # pass in the dmetaphone code, then these implementations are identical
     shard_for_phonetic_write = shard_for_prefix_write
@@ -212,22 +494,50 @@ class ConnectionPool(object):
         index = bisect.bisect_right(plan, (rand, 99999999999))
         return plan[index][1]
 
-    def get_by_shard(self, shard, replace=True, timeout=None):
+    def get_by_shard(self, shard, replace=True, timeout=None, replica=False):
         if shard not in self._conns:
             raise error.NoShard(shard)
+        self._check_pid()
 
+        if replica and shard in self._replicas:
+            shard = self._pick_replica(shard)
+
+        start = time.time()
         if timeout is not None:
-            deadline = time.time() + timeout
+            deadline = start + timeout
+
+        # open a new connection if nothing's idle and the ones already on
+        # their way are spoken for by other waiters
+        queue = self._conns[shard]
+        with self._lock:
+            if (queue.empty()
+                    and self._pending[shard] <= self._waiting[shard]
+                    and self._sizes[shard] < self._shards[shard]['max']):
+                self._grow(self._shards[shard])
+            self._waiting[shard] += 1
 
         try:
-            conn = self._conns[shard].get(timeout)
+            conn = queue.get(True, timeout)
         except Queue.Empty:
-            raise error.Timeout()
+            raise self._timed_out(shard)
+        finally:
+            with self._lock:
+                self._waiting[shard] -= 1
 
+        now = time.time()
         if timeout is not None:
-            timeout = deadline - time.time()
+            timeout = deadline - now
+
+        with self._lock:
+            self._out[id(conn)] = shard
+            self._taken[id(conn)] = now
 
-        self._out[id(conn)] = shard
+            stats = self._stats[shard]
+            stats.checkouts += 1
+            stats.wait_total += now - start
+            stats.wait_max = max(stats.wait_max, now - start)
+
+        self._emit(shard, 'wait', now - start)
 
         if replace:
             if timeout is not None:
@@ -236,13 +546,48 @@ class ConnectionPool(object):
 
         return conn
 
-    def get_by_id(self, id, replace=True, timeout=None):
-        return self.get_by_shard(self.shard_by_id(id), replace, timeout)
+    def get_by_id(self, id, replace=True, timeout=None, replica=False):
+        return self.get_by_shard(
+                self.shard_by_id(id), replace, timeout, replica)
 
     def get_for_root_insert(self, replace=True, timeout=None):
         return self.get_by_shard(
                 self.shard_for_root_insert(), replace, timeout)
 
+    def _pick_replica(self, shard):
+        partials, keys = self._replicas[shard]
+        return keys[bisect.bisect_right(
+            partials, random.randrange(partials[-1]))]
+
+    def submit(self, func, *args, **kwargs):
+        '''start ``func(*args, **kwargs)`` running in the background
+
+        this is how to have any number of datahog API calls in flight at once,
+        in the background workers of whichever pool class this is (greenlets
+        for the green pools, threads for :class:`ThreadedConnPool`)::
+
+            futures = [pool.submit(datahog.node.get, pool, nid, ctx)
+                    for nid in node_ids]
+            nodes = [f.result() for f in futures]
+
+        :returns:
+            a :class:`Future` for the call's return value
+        '''
+        future = Future(self._ev())
+
+        def f():
+            try:
+                future._result = func(*args, **kwargs)
+            except Exception:
+                future._exc_info = sys.exc_info()
+            future._done.set()
+
+        self._submit(f)
+        return future
+
+    def _submit(self, f):
+        self._background(f)
+
     def backoff(self):
         yield 0 # single immediate retry
         jitter = 0.25
@@ -255,12 +600,16 @@ class ConnectionPool(object):
     @contextlib.contextmanager
     def _replacement_context(self, conn):
         c = None
+        broken = False
         try:
             with conn as c:
                 yield c
+        except (psycopg2.OperationalError, psycopg2.InterfaceError), exc:
+            broken = c is not None and _is_disconnect(c, exc)
+            raise
         finally:
             if c is not None:
-                self.put(c)
+                self.put(c, broken)
 
     @contextlib.contextmanager
     def _timeout_context(self, conn, timeout):
@@ -270,19 +619,38 @@ class ConnectionPool(object):
             with conn:
                 yield conn
         except psycopg2.extensions.QueryCanceledError:
+            with self._lock:
+                deliberate = id(conn) in self._cancelled
+            if deliberate:
+                # stopped by _cancel, not by the timer
+                raise
             conn.reset()
-            raise error.Timeout()
-        else:
+            raise self._timed_out(self._out[id(conn)])
+        finally:
+            # don't let the timer go off on a connection that's back in the
+            # pool and being used for someone else's query
             t.cancel()
 
+    def _cancel(self, conn):
+        # cancel the query on a checked out connection, on purpose rather than
+        # because it ran out of time, so it isn't accounted as a timeout
+        with self._lock:
+            self._cancelled.add(id(conn))
+        conn.cancel()
+
     def _try_conn(self, info):
+        kwargs = {}
+        if self._dbconf.get('prepared_statements'):
+            kwargs['connection_factory'] = prepared.PreparingConnection
+
         try:
             return psycopg2.connect(
                     host=info['host'],
                     port=info['port'],
                     user=info['user'],
                     password=info['password'],
-                    database=info['database'])
+                    database=info['database'],
+                    **kwargs)
         except psycopg2.OperationalError:
             return None
 
@@ -297,10 +665,120 @@ class ConnectionPool(object):
                     if conn is not None:
                         break
 
+            with self._lock:
+                self._pending[shard['shard']] -= 1
+                if conn is not None:
+                    now = time.time()
+                    self._born[id(conn)] = now
+                    self._idle[id(conn)] = now
+                    self._checked[id(conn)] = now
+                else:
+                    self._sizes[shard['shard']] -= 1
+                    # a checkout may be waiting on this connection with no
+                    # timeout, so start over rather than leave it hanging
+                    if (self._waiting[shard['shard']]
+                            > self._pending[shard['shard']]
+                            and self._sizes[shard['shard']] < shard['max']):
+                        self._grow(shard)
+
             if conn is not None:
                 self._conns[shard['shard']].put(conn)
             done.set()
 
+    def _grow(self, shard, done=None):
+        # count it right away so concurrent checkouts don't overshoot 'max'
+        with self._lock:
+            self._sizes[shard['shard']] += 1
+            self._pending[shard['shard']] += 1
+        self._start_conn(shard, done or self._ev())
+
+    def _discard(self, shard, conn):
+        with self._lock:
+            self._sizes[shard] -= 1
+            self._born.pop(id(conn), None)
+            self._idle.pop(id(conn), None)
+            self._checked.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _replace(self, shard, conn):
+        conf = self._shards[shard]
+        self._discard(shard, conn)
+
+        # rebuild it (with the usual backoff) if we're below 'min' or someone
+        # is waiting on it
+        with self._lock:
+            if self._sizes[shard] < conf['min'] or (
+                    self._waiting[shard] > self._pending[shard]
+                    and self._sizes[shard] < conf['max']):
+                self._grow(conf)
+
+    def _ping(self, conn):
+        try:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("select 1")
+                cursor.fetchall()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _expired(self, conf, conn, now):
+        lifetime = conf.get('max_lifetime')
+        return bool(lifetime) and now - self._born.get(id(conn), now) > lifetime
+
+    def _reap(self):
+        '''close idle and expired connections that aren't needed for 'min',
+        and check on the ones that haven't been used in 'ping_interval'
+        '''
+        now = time.time()
+        for shard, queue in self._conns.items():
+            conf = self._shards[shard]
+            idle_timeout = conf.get('idle_timeout')
+            ping_interval = conf.get('ping_interval')
+
+            conns = []
+            while 1:
+                try:
+                    conns.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stale, doomed = [], []
+            with self._lock:
+                size = self._sizes[shard]
+                for conn in conns:
+                    if self._expired(conf, conn, now) or (idle_timeout
+                            and size > conf['min']
+                            and now - self._idle.get(id(conn), now)
+                                > idle_timeout):
+                        doomed.append(conn)
+                        size -= 1
+                    elif (ping_interval and now - self._checked.get(
+                            id(conn), now) > ping_interval):
+                        stale.append(conn)
+                    else:
+                        queue.put(conn)
+
+            for conn in doomed:
+                self._discard(shard, conn)
+
+            with self._lock:
+                while self._sizes[shard] < conf['min']:
+                    self._grow(conf)
+
+            # the rest are back in the queue, so this blocking doesn't hold
+            # up anybody else's checkout
+            for conn in stale:
+                if self._ping(conn):
+                    with self._lock:
+                        self._checked[id(conn)] = time.time()
+                    queue.put(conn)
+                else:
+                    self._replace(shard, conn)
+
 
 if greenhouse:
     __all__.append("GreenhouseConnPool")
@@ -392,18 +870,236 @@ if gevent:
         _timer = _gevent_timer
 
 
+__all__.append("ThreadedConnPool")
+
+class _threaded_timer(object):
+    # unlike a bare threading.Timer, once cancel() has returned the function
+    # is guaranteed not to be running or to run later, so a query timeout
+    # can't cancel whatever the connection is doing after it's back in the pool
+    def __init__(self, timeout, func):
+        self._func = func
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._timer = threading.Timer(timeout, self._fire)
+        self._timer.daemon = True
+
+    def start(self):
+        self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+        self._timer.cancel()
+
+    def _fire(self):
+        with self._lock:
+            if not self._cancelled:
+                self._func()
+
+class ThreadedConnPool(ConnectionPool):
+    '''a :class:`ConnectionPool` that blocks with plain OS threads
+
+    for use in multi-threaded servers that don't run an event loop at all.
+    psycopg2 releases the GIL while it waits on the database, so queries on
+    separate threads run concurrently.
+
+    calls started with :meth:`submit <ConnectionPool.submit>` share a set of
+    worker threads, no more of them than the pool can have connections open
+    at once; calls beyond that wait their turn for a free worker.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(ThreadedConnPool, self).__init__(*args, **kwargs)
+        self._backlog = collections.deque()
+        self._workers = 0
+
+    def after_fork(self, warm=False):
+        # the parent's workers don't exist in this process
+        self._backlog.clear()
+        self._workers = 0
+        super(ThreadedConnPool, self).after_fork(warm)
+
+    def _submit(self, f):
+        with self._lock:
+            self._backlog.append(f)
+            if self._workers >= sum(conf['max'] for conf in self._confs):
+                return
+            self._workers += 1
+        self._background(self._work)
+
+    def _work(self):
+        while 1:
+            with self._lock:
+                if not self._backlog:
+                    self._workers -= 1
+                    return
+                f = self._backlog.popleft()
+            f()
+
+    @staticmethod
+    def _background(f):
+        t = threading.Thread(target=f)
+        t.daemon = True
+        t.start()
+
+    @staticmethod
+    def _q():
+        return Queue.Queue()
+
+    @staticmethod
+    def _ev():
+        return threading.Event()
+
+    @staticmethod
+    def _pause(ms):
+        time.sleep(ms / 1000.0)
+
+    _timer = _threaded_timer
+
+
+class Future(object):
+    '''the eventual outcome of a call started with :meth:`ConnectionPool.submit`
+    '''
+    def __init__(self, done):
+        self._done = done
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        '''whether the call has finished
+        '''
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''block until the call finishes and return its result
+
+        if the call raised an exception, it is re-raised here.
+
+        :param timeout:
+            maximum time in seconds to wait; the default of ``None`` means no
+            limit
+
+        :raises Timeout: if ``timeout`` expires first
+        '''
+        self.wait(timeout)
+        if self._exc_info is not None:
+            klass, exc, tb = self._exc_info
+            raise klass, exc, tb
+        return self._result
+
+    def wait(self, timeout=None):
+        '''block until the call finishes, without checking its outcome
+
+        :param timeout:
+            maximum time in seconds to wait; the default of ``None`` means no
+            limit
+
+        :raises Timeout: if ``timeout`` expires first
+        '''
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise error.Timeout()
+
+
+# upper bounds (in seconds) of the buckets in the query latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+
+class _ShardStats(object):
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def _reaper(pool, interval, token):
+    # only hold a weakref between runs so the loop doesn't keep the pool alive
+    pool_ref = weakref.ref(pool)
+    pause = pool._pause
+    del pool
+
+    def loop():
+        while 1:
+            pause(interval * 1000)
+            pool = pool_ref()
+            if pool is None or pool._reaper_token is not token:
+                break
+            pool._reap()
+            del pool
+    return loop
+
+_fork_lock = threading.Lock()
+
+
+def _init_sizes(conf):
+    if 'min' not in conf:
+        if 'count' not in conf:
+            raise Exception("missing shard dict key 'count'")
+        conf['min'] = conf['count']
+    conf.setdefault('max', conf['min'])
+    if conf['max'] < conf['min']:
+        raise Exception("shard %r 'max' is less than 'min'" % (conf['shard'],))
+
+
+# admin_shutdown, crash_shutdown and cannot_connect_now. along with class 08
+# (connection exceptions) these mean the session is gone; anything else
+# (lock timeouts, out of memory, ...) leaves the connection usable
+_DISCONNECT_STATES = frozenset(['57P01', '57P02', '57P03'])
+
+def _is_disconnect(conn, exc):
+    if conn.closed:
+        return True
+    code = getattr(exc, 'pgcode', None)
+    if code is None:
+        return False
+    return code.startswith('08') or code in _DISCONNECT_STATES
+
+
 def _int_hash(digest):
-    n = 0
-    for c in digest:
-        n <<= 8
-        n |= ord(c)
-    return n
-
-def _pick_from_plan(digest, plan, num=None):
-    if num is None:
-        num = _int_hash(digest)
-    index = bisect.bisect_right(plan, (num % plan[-1][0], 999999999))
-    return plan[index][1]
+    return int(digest.encode('hex'), 16)
+
+# the most residues we'll table candidate shards for in a _Router
+MAX_ROUTING_TABLE = 1 << 16
+
+class _Router(object):
+    '''routes lookup table rows to shards across all the insertion plans
+
+    the candidate shards for an integer depend only on it modulo each plan's
+    total weight, so unless the plans' totals have an unreasonably large least
+    common multiple, every distinct (deduplicated, newest plan first) set of
+    candidates is computed once up front and looked up by that residue.
+    '''
+    def __init__(self, plans):
+        self._plans = [([p for p, s in plan], [s for p, s in plan], plan[-1][0])
+                for plan in plans[::-1]]
+
+        period = 1
+        for partials, shards, total in self._plans:
+            period = period * total // fractions.gcd(period, total)
+            if period > MAX_ROUTING_TABLE:
+                self._period = self._table = None
+                return
+
+        # share identical candidate tuples between residues
+        interned = {}
+        self._period = period
+        self._table = [interned.setdefault(c, c)
+                for c in map(self._candidates, xrange(period))]
+
+    def _candidates(self, num):
+        found = []
+        for partials, shards, total in self._plans:
+            shard = shards[bisect.bisect_right(partials, num % total)]
+            if shard not in found:
+                found.append(shard)
+        return tuple(found)
+
+    def route(self, num):
+        if self._table is not None:
+            return self._table[num % self._period]
+        return self._candidates(num)
 
 # convert a [(shard, weight)] plan to a [(partialsum, shard)] plan
 def _prepare_plan(plan):
@@ -0,0 +1,58 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import collections
+
+
+__all__ = ['Node', 'Property', 'Alias', 'Name', 'Relationship']
+
+
+class Node(collections.namedtuple('Node', 'id ctx value flags')):
+    __slots__ = ()
+
+class Property(collections.namedtuple('Property', 'base_id ctx value flags')):
+    __slots__ = ()
+
+class Alias(collections.namedtuple('Alias', 'base_id ctx value flags')):
+    __slots__ = ()
+
+class Name(collections.namedtuple('Name', 'base_id ctx value flags')):
+    __slots__ = ()
+
+class Relationship(collections.namedtuple('Relationship',
+        'base_id rel_id ctx flags')):
+    __slots__ = ()
+
+
+def maker(pool, kind):
+    # a constructor for one of the record classes in ``pool``'s result mode,
+    # taking the fields positionally. used once per API call, not per row.
+    if pool.compact:
+        return kind
+    return _DICTS[kind]
+
+def from_dict(pool, kind, d):
+    # for results built as dicts deeper down and decoded with
+    # codec.decode_rows, like the merged streams of a search
+    if d is None or not pool.compact:
+        return d
+    return kind(*[d[field] for field in kind._fields])
+
+
+def _node(id, ctx, value, flags):
+    return {'id': id, 'ctx': ctx, 'value': value, 'flags': flags}
+
+def _base_value(base_id, ctx, value, flags):
+    return {'base_id': base_id, 'ctx': ctx, 'value': value, 'flags': flags}
+
+def _relationship(base_id, rel_id, ctx, flags):
+    return {'base_id': base_id, 'rel_id': rel_id, 'ctx': ctx, 'flags': flags}
+
+_DICTS = {
+    Node: _node,
+    Property: _base_value,
+    Alias: _base_value,
+    Name: _base_value,
+    Relationship: _relationship,
+}
@@ -0,0 +1,77 @@
+-- number the live entries of each list densely again, from 0
+
+update alias
+set pos = ordering.n - 1
+from (
+  select row_number() over (partition by base_id, ctx order by pos) n,
+    base_id, ctx, value
+  from alias
+  where time_removed is null
+) as ordering
+where
+  alias.time_removed is null
+  and alias.base_id=ordering.base_id
+  and alias.ctx=ordering.ctx
+  and alias.value=ordering.value;
+
+alter table alias
+  alter column pos type int
+  using case when time_removed is null then pos else 0 end;
+
+update relationship
+set pos = ordering.n - 1
+from (
+  select row_number() over (
+      partition by forward, case when forward then base_id else rel_id end,
+        ctx
+      order by pos) n,
+    base_id, ctx, forward, rel_id
+  from relationship
+  where time_removed is null
+) as ordering
+where
+  relationship.time_removed is null
+  and relationship.base_id=ordering.base_id
+  and relationship.ctx=ordering.ctx
+  and relationship.forward=ordering.forward
+  and relationship.rel_id=ordering.rel_id;
+
+alter table relationship
+  alter column pos type int
+  using case when time_removed is null then pos else 0 end;
+
+update edge
+set pos = ordering.n - 1
+from (
+  select row_number() over (partition by base_id, ctx order by pos) n,
+    base_id, ctx, child_id
+  from edge
+  where time_removed is null
+) as ordering
+where
+  edge.time_removed is null
+  and edge.base_id=ordering.base_id
+  and edge.ctx=ordering.ctx
+  and edge.child_id=ordering.child_id;
+
+alter table edge
+  alter column pos type int
+  using case when time_removed is null then pos else 0 end;
+
+update name
+set pos = ordering.n - 1
+from (
+  select row_number() over (partition by base_id, ctx order by pos) n,
+    base_id, ctx, value
+  from name
+  where time_removed is null
+) as ordering
+where
+  name.time_removed is null
+  and name.base_id=ordering.base_id
+  and name.ctx=ordering.ctx
+  and name.value=ordering.value;
+
+alter table name
+  alter column pos type int
+  using case when time_removed is null then pos else 0 end;
@@ -0,0 +1,17 @@
+-- SPARSE LIST POSITIONS --
+
+-- positions in ordered lists are spaced 2^24 apart, and entries put in at an
+-- index go halfway between their neighbours (see datahog/db/query.py), so
+-- they outgrow int. the existing positions are spread out to match.
+
+alter table alias
+  alter column pos type bigint using (pos + 1) * 16777216;
+
+alter table relationship
+  alter column pos type bigint using (pos + 1) * 16777216;
+
+alter table edge
+  alter column pos type bigint using (pos + 1) * 16777216;
+
+alter table name
+  alter column pos type bigint using (pos + 1) * 16777216;
@@ -0,0 +1 @@
+drop index prefix_lookup_range_idx;
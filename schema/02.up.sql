@@ -0,0 +1,13 @@
+-- RANGE-SCANNED PREFIX SEARCH --
+
+-- prefix searches are now a range over the "C" ordering of prefix_lookup's
+-- values (see search_prefixes in datahog/db/query.py). prefix_lookup_idx is
+-- in the database's collation, so it can't serve that range unless the
+-- database happens to be "C" itself. this index can, and as it carries every
+-- column the search selects it can be read with an index-only scan.
+
+-- prefix_lookup_idx stays for the removals, which look up exact values.
+
+create index prefix_lookup_range_idx on prefix_lookup (
+  ctx, value collate "C", base_id, flags
+) where time_removed is null;
@@ -0,0 +1,9 @@
+drop index phonetic_lookup_removed_idx;
+drop index prefix_lookup_removed_idx;
+drop index name_removed_idx;
+drop index edge_removed_idx;
+drop index node_removed_idx;
+drop index relationship_removed_idx;
+drop index alias_lookup_removed_idx;
+drop index alias_removed_idx;
+drop index property_removed_idx;
@@ -0,0 +1,32 @@
+-- PURGING REMOVED ROWS --
+
+-- every other index only covers live rows, so without these finding the
+-- rows that datahog.purge should delete means scanning the whole table. they
+-- only hold tombstones, and the purge keeps that down to the retention.
+
+create index property_removed_idx on property (time_removed)
+where time_removed is not null;
+
+create index alias_removed_idx on alias (time_removed)
+where time_removed is not null;
+
+create index alias_lookup_removed_idx on alias_lookup (time_removed)
+where time_removed is not null;
+
+create index relationship_removed_idx on relationship (time_removed)
+where time_removed is not null;
+
+create index node_removed_idx on node (time_removed)
+where time_removed is not null;
+
+create index edge_removed_idx on edge (time_removed)
+where time_removed is not null;
+
+create index name_removed_idx on name (time_removed)
+where time_removed is not null;
+
+create index prefix_lookup_removed_idx on prefix_lookup (time_removed)
+where time_removed is not null;
+
+create index phonetic_lookup_removed_idx on phonetic_lookup (time_removed)
+where time_removed is not null;
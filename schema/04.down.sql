@@ -0,0 +1,141 @@
+-- put everything back in plain tables, whichever contexts have their own
+-- partitions
+
+alter table property rename to property_partitioned;
+
+create table property (
+  like property_partitioned including defaults including constraints
+);
+
+insert into property select * from property_partitioned;
+
+drop table property_partitioned;
+
+create unique index property_uniq on property (
+  base_id, ctx
+) where time_removed is null;
+
+create index property_removed_idx on property (time_removed)
+where time_removed is not null;
+
+alter table alias rename to alias_partitioned;
+
+create table alias (
+  like alias_partitioned including defaults including constraints
+);
+
+insert into alias select * from alias_partitioned;
+
+drop table alias_partitioned;
+
+create index alias_idx on alias (
+  base_id, ctx, pos
+) where time_removed is null;
+
+create index alias_removed_idx on alias (time_removed)
+where time_removed is not null;
+
+alter table alias_lookup rename to alias_lookup_partitioned;
+
+create table alias_lookup (
+  like alias_lookup_partitioned including defaults including constraints
+);
+
+insert into alias_lookup select * from alias_lookup_partitioned;
+
+drop table alias_lookup_partitioned;
+
+create unique index alias_lookup_uniq on alias_lookup (
+  hash, ctx
+) where time_removed is null;
+
+create index alias_lookup_removed_idx on alias_lookup (time_removed)
+where time_removed is not null;
+
+alter table relationship rename to relationship_partitioned;
+
+create table relationship (
+  like relationship_partitioned including defaults including constraints
+);
+
+insert into relationship select * from relationship_partitioned;
+
+drop table relationship_partitioned;
+
+create unique index relationship_uniq_forward on relationship (
+  base_id, ctx, rel_id
+) where time_removed is null and forward=true;
+
+create index relationship_forward_idx on relationship (
+  base_id, ctx, pos
+) where time_removed is null and forward=true;
+
+create unique index relationship_uniq_backward on relationship (
+  rel_id, ctx, base_id
+) where time_removed is null and forward=false;
+
+create index relationship_backward_idx on relationship (
+  rel_id, ctx, pos
+) where time_removed is null and forward=false;
+
+create index relationship_removed_idx on relationship (time_removed)
+where time_removed is not null;
+
+alter table name rename to name_partitioned;
+
+create table name (
+  like name_partitioned including defaults including constraints
+);
+
+insert into name select * from name_partitioned;
+
+drop table name_partitioned;
+
+create index name_idx on name (
+  base_id, ctx, pos
+) where time_removed is null;
+
+create unique index name_uniq on name (
+  base_id, ctx, value
+) where time_removed is null;
+
+create index name_removed_idx on name (time_removed)
+where time_removed is not null;
+
+alter table prefix_lookup rename to prefix_lookup_partitioned;
+
+create table prefix_lookup (
+  like prefix_lookup_partitioned including defaults including constraints
+);
+
+insert into prefix_lookup select * from prefix_lookup_partitioned;
+
+drop table prefix_lookup_partitioned;
+
+create index prefix_lookup_idx on prefix_lookup (
+  ctx, value
+) where time_removed is null;
+
+create index prefix_lookup_range_idx on prefix_lookup (
+  ctx, value collate "C", base_id, flags
+) where time_removed is null;
+
+create index prefix_lookup_removed_idx on prefix_lookup (time_removed)
+where time_removed is not null;
+
+alter table phonetic_lookup rename to phonetic_lookup_partitioned;
+
+create table phonetic_lookup (
+  like phonetic_lookup_partitioned including defaults including constraints
+);
+
+insert into phonetic_lookup select * from phonetic_lookup_partitioned;
+
+drop table phonetic_lookup_partitioned;
+
+create index phonetic_lookup_idx on phonetic_lookup (
+  ctx, code, base_id
+) where time_removed is null;
+
+create index phonetic_lookup_removed_idx on phonetic_lookup (time_removed)
+where time_removed is not null;
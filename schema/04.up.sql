@@ -0,0 +1,165 @@
+-- PARTITIONING BY CONTEXT --
+
+-- the tables that hold objects of many contexts are list partitioned by ctx,
+-- so a context can be given a partition (with its own indexes, statistics
+-- and vacuuming) of its own. to start with every table has just a default
+-- partition holding everything; split contexts out of it with
+-- "schema/migrate partition <table> <ctx>".
+--
+-- node and edge are left alone: node ids are unique across contexts, which
+-- a partitioned table can only enforce per partition.
+--
+-- this needs postgresql 11 or later.
+
+alter table property rename to property_unpartitioned;
+
+create table property (
+  like property_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table property_default partition of property default;
+
+insert into property select * from property_unpartitioned;
+
+drop table property_unpartitioned;
+
+create unique index property_uniq on property (
+  base_id, ctx
+) where time_removed is null;
+
+create index property_removed_idx on property (time_removed)
+where time_removed is not null;
+
+alter table alias rename to alias_unpartitioned;
+
+create table alias (
+  like alias_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table alias_default partition of alias default;
+
+insert into alias select * from alias_unpartitioned;
+
+drop table alias_unpartitioned;
+
+create index alias_idx on alias (
+  base_id, ctx, pos
+) where time_removed is null;
+
+create index alias_removed_idx on alias (time_removed)
+where time_removed is not null;
+
+alter table alias_lookup rename to alias_lookup_unpartitioned;
+
+create table alias_lookup (
+  like alias_lookup_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table alias_lookup_default partition of alias_lookup default;
+
+insert into alias_lookup select * from alias_lookup_unpartitioned;
+
+drop table alias_lookup_unpartitioned;
+
+create unique index alias_lookup_uniq on alias_lookup (
+  hash, ctx
+) where time_removed is null;
+
+create index alias_lookup_removed_idx on alias_lookup (time_removed)
+where time_removed is not null;
+
+alter table relationship rename to relationship_unpartitioned;
+
+create table relationship (
+  like relationship_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table relationship_default partition of relationship default;
+
+insert into relationship select * from relationship_unpartitioned;
+
+drop table relationship_unpartitioned;
+
+create unique index relationship_uniq_forward on relationship (
+  base_id, ctx, rel_id
+) where time_removed is null and forward=true;
+
+create index relationship_forward_idx on relationship (
+  base_id, ctx, pos
+) where time_removed is null and forward=true;
+
+create unique index relationship_uniq_backward on relationship (
+  rel_id, ctx, base_id
+) where time_removed is null and forward=false;
+
+create index relationship_backward_idx on relationship (
+  rel_id, ctx, pos
+) where time_removed is null and forward=false;
+
+create index relationship_removed_idx on relationship (time_removed)
+where time_removed is not null;
+
+alter table name rename to name_unpartitioned;
+
+create table name (
+  like name_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table name_default partition of name default;
+
+insert into name select * from name_unpartitioned;
+
+drop table name_unpartitioned;
+
+create index name_idx on name (
+  base_id, ctx, pos
+) where time_removed is null;
+
+create unique index name_uniq on name (
+  base_id, ctx, value
+) where time_removed is null;
+
+create index name_removed_idx on name (time_removed)
+where time_removed is not null;
+
+alter table prefix_lookup rename to prefix_lookup_unpartitioned;
+
+create table prefix_lookup (
+  like prefix_lookup_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table prefix_lookup_default partition of prefix_lookup default;
+
+insert into prefix_lookup select * from prefix_lookup_unpartitioned;
+
+drop table prefix_lookup_unpartitioned;
+
+create index prefix_lookup_idx on prefix_lookup (
+  ctx, value
+) where time_removed is null;
+
+create index prefix_lookup_range_idx on prefix_lookup (
+  ctx, value collate "C", base_id, flags
+) where time_removed is null;
+
+create index prefix_lookup_removed_idx on prefix_lookup (time_removed)
+where time_removed is not null;
+
+alter table phonetic_lookup rename to phonetic_lookup_unpartitioned;
+
+create table phonetic_lookup (
+  like phonetic_lookup_unpartitioned including defaults including constraints
+) partition by list (ctx);
+
+create table phonetic_lookup_default partition of phonetic_lookup default;
+
+insert into phonetic_lookup select * from phonetic_lookup_unpartitioned;
+
+drop table phonetic_lookup_unpartitioned;
+
+create index phonetic_lookup_idx on phonetic_lookup (
+  ctx, code, base_id
+) where time_removed is null;
+
+create index phonetic_lookup_removed_idx on phonetic_lookup (time_removed)
+where time_removed is not null;
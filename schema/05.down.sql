@@ -0,0 +1,29 @@
+drop index node_id;
+
+create unique index node_id on node (
+  id
+) where time_removed is null;
+
+drop index relationship_backward_idx;
+
+create index relationship_backward_idx on relationship (
+  rel_id, ctx, pos
+) where time_removed is null and forward=false;
+
+drop index relationship_forward_idx;
+
+create index relationship_forward_idx on relationship (
+  base_id, ctx, pos
+) where time_removed is null and forward=true;
+
+drop index alias_lookup_uniq;
+
+create unique index alias_lookup_uniq on alias_lookup (
+  hash, ctx
+) where time_removed is null;
+
+drop index property_uniq;
+
+create unique index property_uniq on property (
+  base_id, ctx
+) where time_removed is null;
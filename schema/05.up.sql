@@ -0,0 +1,41 @@
+-- COVERING INDEXES FOR POINT READS --
+
+-- the indexes behind the busiest single-row and list reads carry the columns
+-- those reads select, so they can be answered by index-only scans without
+-- visiting the heap (pages vacuum has marked all-visible, at least).
+--
+-- property and node values are bytea of any length, too long to go in an
+-- index, so only num is carried: reads of int storage contexts are covered,
+-- the rest still fetch their value from the heap.
+--
+-- INCLUDE needs postgresql 11 or later.
+
+drop index property_uniq;
+
+create unique index property_uniq on property (
+  base_id, ctx
+) include (num, flags) where time_removed is null;
+
+drop index alias_lookup_uniq;
+
+create unique index alias_lookup_uniq on alias_lookup (
+  hash, ctx
+) include (base_id, flags) where time_removed is null;
+
+drop index relationship_forward_idx;
+
+create index relationship_forward_idx on relationship (
+  base_id, ctx, pos
+) include (rel_id, flags) where time_removed is null and forward=true;
+
+drop index relationship_backward_idx;
+
+create index relationship_backward_idx on relationship (
+  rel_id, ctx, pos
+) include (base_id, flags) where time_removed is null and forward=false;
+
+drop index node_id;
+
+create unique index node_id on node (
+  id
+) include (ctx, num, flags) where time_removed is null;
@@ -28,10 +28,12 @@ class TestCase(unittest.TestCase):
         'shard_bits': 8,
         'digest_key': 'digest key',
     }
+    POOL_KWARGS = {}
     maxDiff = None
 
     def setUp(self):
-        self.p = datahog.GreenhouseConnPool(copy.deepcopy(self.CONFIG))
+        self.p = datahog.GreenhouseConnPool(copy.deepcopy(self.CONFIG),
+                **self.POOL_KWARGS)
         self.p.start()
         self.p.wait_ready()
         reset()
@@ -42,3 +44,28 @@ class TestCase(unittest.TestCase):
         datahog.context.META.clear()
         datahog.flag.META.clear()
         reset()
+
+
+class ShardedTestCase(TestCase):
+    CONFIG = dict(TestCase.CONFIG, shards=[{
+            'shard': 0,
+            'count': 2,
+            'host': None,
+            'port': None,
+            'user': None,
+            'password': None,
+            'database': None,
+        }, {
+            'shard': 1,
+            'count': 2,
+            'host': None,
+            'port': None,
+            'user': None,
+            'password': None,
+            'database': None,
+        }],
+        lookup_insertion_plans=[[(0, 1)], [(1, 1)]])
+
+    def tearDown(self):
+        self.assertEqual(len(self.p._conns[1]._data), 2)
+        super(ShardedTestCase, self).tearDown()
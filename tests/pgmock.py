@@ -9,9 +9,11 @@ import psycopg2
 
 __all__ = ["activate", "deactivate", "reset", "connect_fail", "query_fail",
         "add_fetch_result", "eventlog", "CONNECT", "CONNECT_FAIL",
-        "GET_CURSOR", "COMMIT", "ROLLBACK", "RESET", "TPC_BEGIN", "TPC_COMMIT",
-        "TPC_ROLLBACK", "TPC_PREPARE", "FETCH_ONE", "FETCH_ALL", "ROWCOUNT",
-        "EXECUTE", "EXECUTE_FAILURE"]
+        "GET_CURSOR", "COMMIT", "ROLLBACK", "RESET", "CLOSE", "TPC_BEGIN",
+        "TPC_COMMIT",
+        "TPC_ROLLBACK", "TPC_PREPARE", "FETCH_ONE", "FETCH_ALL", "FETCH_MANY",
+        "ROWCOUNT", "CANCEL",
+        "EXECUTE", "EXECUTE_FAILURE", "COPY"]
 
 
 def activate():
@@ -61,13 +63,16 @@ GET_CURSOR = pgevent("GET_CURSOR")
 COMMIT = pgevent("COMMIT")
 ROLLBACK = pgevent("ROLLBACK")
 RESET = pgevent("RESET")
+CLOSE = pgevent("CLOSE")
 TPC_BEGIN = pgevent("TPC_BEGIN")
 TPC_COMMIT = pgevent("TPC_COMMIT")
 TPC_ROLLBACK = pgevent("TPC_ROLLBACK")
 TPC_PREPARE = pgevent("TPC_PREPARE")
 FETCH_ONE = pgevent("FETCH_ONE")
 FETCH_ALL = pgevent("FETCH_ALL")
+FETCH_MANY = pgevent("FETCH_MANY")
 ROWCOUNT = pgevent("ROWCOUNT")
+CANCEL = pgevent("CANCEL")
 class EXECUTE(object):
     def __init__(self, pattern, args):
         self.pattern = _spaces.sub('', pattern)
@@ -85,16 +90,25 @@ class EXECUTE(object):
                 self.args == other.args)
 class EXECUTE_FAILURE(EXECUTE):
     pass
+class COPY(EXECUTE):
+    def __init__(self, pattern, data):
+        super(COPY, self).__init__(pattern, (data,))
 
 
 class FakePGConn(object):
-    def cursor(self):
+    closed = 0
+
+    def cursor(self, name=None):
         _log(GET_CURSOR)
         return FakePGCursor()
 
     def commit(self): _log(COMMIT)
     def rollback(self): _log(ROLLBACK)
     def reset(self): _log(RESET)
+    def cancel(self): _log(CANCEL)
+    def close(self):
+        _log(CLOSE)
+        self.closed = 1
     def tpc_begin(self, xid): _log(TPC_BEGIN)
     def tpc_commit(self, xid): _log(TPC_COMMIT)
     def tpc_rollback(self, xid=None): _log(TPC_ROLLBACK)
@@ -113,17 +127,26 @@ class FakePGConn(object):
         return ''.join(map(repr, args))
 
 
+def _unbinary(x):
+    if isinstance(x, list):
+        return map(_unbinary, x)
+    if isinstance(x, type(psycopg2.Binary(''))):
+        return x.adapted
+    return x
+
+
 class FakePGCursor(object):
     def execute(self, pattern, args=()):
-        args = tuple(
-                x.adapted if isinstance(x, type(psycopg2.Binary(''))) else x
-                for x in args)
+        args = tuple(map(_unbinary, args or ()))
         if _query_fail is not None:
             _log(EXECUTE_FAILURE(pattern, args))
             raise _query_fail()
         _log(EXECUTE(pattern, args))
         _fetch[0] += 1
 
+    def copy_expert(self, sql, fp):
+        _log(COPY(sql, fp.read()))
+
     def fetchone(self):
         _log(FETCH_ONE)
         if not _fetch:
@@ -138,6 +161,16 @@ class FakePGCursor(object):
         _fetch[1][i][:] = []
         return results
 
+    def fetchmany(self, size):
+        _log(FETCH_MANY)
+        i = _fetch[0]
+        results = _fetch[1][i][:size]
+        _fetch[1][i][:size] = []
+        return results
+
+    def close(self):
+        pass
+
     @property
     def rowcount(self):
         _log(ROWCOUNT)
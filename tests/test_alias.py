@@ -8,6 +8,7 @@ import unittest
 
 import datahog
 from datahog import error
+from datahog.db import query
 import psycopg2
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -59,7 +60,7 @@ from selectquery
             EXECUTE("""
 insert into alias (base_id, ctx, value, pos, flags)
 select %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from alias
     where
         time_removed is null
@@ -67,7 +68,7 @@ select %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1), %s
+), 0) + 16777216, %s
 where exists (
     select 1 from node
     where
@@ -268,6 +269,37 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter(self):
+        add_fetch_result([(0, 'val1', 0), (0, 'val2', 1), (0, 'val3', 2)])
+
+        self.assertEqual(
+                list(datahog.alias.iter(self.p, 123, 2, fetch_size=2)),
+                [
+                    {'base_id': 123, 'ctx': 2, 'value': 'val1',
+                        'flags': set([])},
+                    {'base_id': 123, 'ctx': 2, 'value': 'val2',
+                        'flags': set([])},
+                    {'base_id': 123, 'ctx': 2, 'value': 'val3',
+                        'flags': set([])},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select flags, value, pos
+from alias
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (123, 2, 0)),
+            FETCH_MANY,
+            FETCH_MANY,
+            FETCH_MANY,
+            COMMIT])
+
     def test_list_empty(self):
         add_fetch_result([])
 
@@ -320,12 +352,13 @@ with window_query as (
     from alias
     where
         time_removed is null
-        and (base_id, ctx) in ((%s, %s),(%s, %s),(%s, %s),(%s, %s))
+        and (base_id, ctx) in (
+            select * from unnest(%s::bigint[], %s::smallint[]))
 )
 select base_id, flags, ctx, value
 from window_query
 where r=1
-""", (123, 2, 124, 2, 125, 2, 126, 2)),
+""", ([123, 124, 125, 126], [2, 2, 2, 2])),
             FETCH_ALL,
             COMMIT])
 
@@ -423,7 +456,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update alias_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and hash=%s
 returning flags
 """, (6, 2, h)),
@@ -433,7 +466,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update alias
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (6, 2, 'value', 123)),
@@ -535,7 +568,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update alias_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and hash=%s
 returning flags
 """, (3, 2, h)),
@@ -545,7 +578,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update alias
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (3, 2, 'value', 123)),
@@ -585,7 +618,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update alias_lookup
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and ctx=%s and hash=%s
 returning flags
 """, (2, 5, 2, h)),
@@ -595,7 +628,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update alias
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (2, 5, 2, 'value', 123)),
@@ -616,7 +649,7 @@ returning flags
                 None)
             
     def test_shift(self):
-        add_fetch_result([(True,)])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.alias.shift(self.p, 123, 2, 'value', 3),
@@ -625,56 +658,117 @@ returning flags
         self.assertEqual(eventlog, [
             GET_CURSOR,
             EXECUTE("""
-with oldpos as (
-    select pos
+with target as (
+    select 1
     from alias
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
         and value=%s
-), bump as (
+), slot(pos) as (
+    select case
+        when hi is null then lo + 16777216
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %s = 0 then 0 else coalesce((
+            select pos
+            from alias
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and value<>%s
+            order by pos asc
+            offset %s
+            limit 1
+        ), (
+            select pos
+            from alias
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and value<>%s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from alias
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and value<>%s
+            order by pos asc
+            offset %s
+            limit 1
+        ) as hi
+    ) as neighbours
+), move as (
     update alias
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
+    set pos=slot.pos
+    from slot
     where
-        exists (select 1 from oldpos)
+        slot.pos is not null
         and time_removed is null
         and base_id=%s
         and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
+        and value=%s
+    returning 1
+)
+select exists (select 1 from target), exists (select 1 from move)
+""", (123, 2, 'value',
+                3, 123, 2, 'value', 2, 123, 2, 'value', 123, 2, 'value', 3,
+                123, 2, 'value')),
+            FETCH_ONE,
+            COMMIT])
+
+    def test_shift_rebalances(self):
+        add_fetch_result([(True, False)])
+        add_fetch_result([])
+        add_fetch_result([(True, True)])
+
+        self.assertEqual(
+                datahog.alias.shift(self.p, 123, 2, 'value', 3),
+                True)
+
+        params = (123, 2, 'value',
+                3, 123, 2, 'value', 2, 123, 2, 'value', 123, 2, 'value', 3,
+                123, 2, 'value')
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(query._REORDERS['alias'], params),
+            FETCH_ONE,
+            EXECUTE("""
+update alias
+set pos=ordering.n * 16777216
+from (
+    select row_number() over (order by pos asc) n, value
     from alias
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update alias
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (123, 2, 'value', 123, 2, 3, 123, 2, 3, 3, 123, 2, 'value')),
+) as ordering
+where
+    alias.value=ordering.value
+    and time_removed is null
+    and base_id=%s
+    and ctx=%s
+""", (123, 2, 123, 2)),
+            EXECUTE(query._REORDERS['alias'], params),
             FETCH_ONE,
             COMMIT])
 
+    def test_shift_failure(self):
+        add_fetch_result([(False, False)])
+
+        self.assertEqual(
+                datahog.alias.shift(self.p, 123, 2, 'value', 3),
+                False)
+
     def test_remove(self):
         add_fetch_result([(123, 0)])
         add_fetch_result([()])
@@ -715,31 +809,80 @@ where
             RESET,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update alias
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update alias
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 2, 'value', 123, 2)),
+update alias
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (123, 2, 'value')),
             ROWCOUNT,
             COMMIT,
             TPC_COMMIT])
 
 
+class ShardedAliasTests(base.ShardedTestCase):
+    def setUp(self):
+        super(ShardedAliasTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.ALIAS, {'base_ctx': 1})
+
+    def test_batch_multiple_shards(self):
+        other = 1 << 56
+        add_fetch_result([(123, 0, 2, 'val1')])
+        add_fetch_result([(other, 0, 2, 'val2')])
+
+        self.assertEqual(
+                datahog.alias.batch(self.p, [(other, 2), (124, 2), (123, 2)]),
+                [
+                    {'base_id': other, 'flags': set([]), 'ctx': 2,
+                        'value': 'val2'},
+                    None,
+                    {'base_id': 123, 'flags': set([]), 'ctx': 2,
+                        'value': 'val1'}])
+
+        self.assertEqual(len([ev for ev in eventlog if ev is COMMIT]), 2)
+
+    def test_lookup_first_hit_skips_older_plans(self):
+        add_fetch_result([(123, 0)])
+
+        self.assertEqual(
+                datahog.alias.lookup(self.p, 'value', 2),
+                {'base_id': 123, 'ctx': 2, 'value': 'value', 'flags': set([])})
+
+        # the newest plan's shard had it, so the older one never got queried
+        self.assertEqual(eventlog.count(GET_CURSOR), 1)
+
+    def test_lookup_falls_back_to_older_plans(self):
+        add_fetch_result([])
+        add_fetch_result([(123, 0)])
+
+        self.assertEqual(
+                datahog.alias.lookup(self.p, 'value', 2),
+                {'base_id': 123, 'ctx': 2, 'value': 'value', 'flags': set([])})
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+        lookup = EXECUTE("""
+select base_id, flags
+from alias_lookup
+where
+    time_removed is null
+    and hash=%s
+    and ctx=%s
+""", (h, 2))
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            lookup,
+            ROWCOUNT,
+            COMMIT,
+            GET_CURSOR,
+            lookup,
+            ROWCOUNT,
+            FETCH_ONE,
+            COMMIT])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import hashlib
+import hmac
+import os
+import StringIO
+import sys
+import unittest
+
+import datahog
+from datahog.db import query
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+class BulkTests(base.TestCase):
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.STR})
+        datahog.set_context(4, datahog.ALIAS, {'base_ctx': 1})
+        datahog.set_context(5, datahog.NAME, {
+            'base_ctx': 1, 'search': datahog.search.PREFIX})
+        datahog.set_flag(1, 3)
+
+    def digest(self, value):
+        return hmac.new(self.p.digestkey, value, hashlib.sha1).digest()
+
+    def copies(self):
+        return [(e.pattern, e.args[0]) for e in eventlog
+                if isinstance(e, COPY)]
+
+    def test_load(self):
+        add_fetch_result([(1,), (2,)])
+        add_fetch_result([])
+        add_fetch_result([(1,), (2,)])
+        add_fetch_result([])
+        add_fetch_result([None])
+        add_fetch_result([])
+        add_fetch_result([(1, 5, 'nm', 0)])
+        add_fetch_result([])
+        add_fetch_result([(self.digest('al'), 4, 1)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([None])
+
+        records = [
+            {'type': 'node', 'ctx': 1, 'ref': 'a'},
+            {'type': 'node', 'ctx': 2, 'base': 'a', 'value': 7},
+            {'type': 'prop', 'ctx': 3, 'base': 'a', 'value': 'x\ty',
+                'flags': [1]},
+            {'type': 'alias', 'ctx': 4, 'base': 'a', 'value': u'al'},
+            {'type': 'name', 'ctx': 5, 'base': 'a', 'value': u'nm'},
+        ]
+
+        self.assertEqual(
+                datahog.bulk.load(self.p, records),
+                ({'a': 1}, {'node': 2, 'prop': 1, 'alias': 1, 'name': 1}))
+
+        self.assertEqual(self.copies(), [
+            ("copybulk_node(seq,id,ctx,flags,num,value,base_id,base_ctx)"
+                "fromstdin",
+                "0\t1\t1\t0\t\\N\t\\N\t\\N\t\\N\n"
+                "1\t2\t2\t0\t7\t\\N\t1\t1\n"),
+            ("copybulk_property(seq,base_id,base_ctx,ctx,flags,num,value)"
+                "fromstdin",
+                "2\t1\t1\t3\t1\t\\N\t\\\\x780979\n"),
+            ("copybulk_name(seq,base_id,base_ctx,ctx,value,flags)fromstdin",
+                "4\t1\t1\t5\tnm\t0\n"),
+            ("copybulk_alias_lookup(seq,hash,ctx,base_id,flags)fromstdin",
+                "3\t\\\\x%s\t4\t1\t0\n" % self.digest('al').encode('hex')),
+            ("copybulk_alias(seq,base_id,base_ctx,ctx,value,flags)fromstdin",
+                "3\t1\t1\t4\tal\t0\n"),
+            ("copybulk_prefix_lookup(seq,value,flags,ctx,base_id)fromstdin",
+                "0\tnm\t0\t5\t1\n"),
+        ])
+
+    def test_rejected_alias_unclaimed(self):
+        digest = self.digest('al')
+        add_fetch_result([])
+        add_fetch_result([(digest, 4, 1234)])
+        add_fetch_result([])
+        add_fetch_result([(0,)])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.bulk.load(self.p, [{'type': 'alias', 'ctx': 4,
+                    'base_id': 1234, 'value': u'al'}]),
+                ({}, {'node': 0, 'prop': 0, 'alias': 0, 'name': 0}))
+
+        self.assertEqual(eventlog[-4:], [
+            GET_CURSOR,
+            EXECUTE("""
+update alias_lookup
+set time_removed=now()
+where
+    time_removed is null
+    and (hash, ctx) in (
+        select * from unnest(%s::bytea[], %s::smallint[]))
+returning hash, ctx
+""", ([digest], [4])),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_unknown_ref(self):
+        self.assertRaises(ValueError, datahog.bulk.load, self.p,
+                [{'type': 'prop', 'ctx': 3, 'base': 'nope', 'value': 'x'}])
+
+    def test_read_jsonl(self):
+        fp = StringIO.StringIO(
+                '{"type": "prop", "ctx": 3, "base_id": 1, "value": "x"}\n'
+                '\n'
+                '{"type": "alias", "ctx": 4, "base_id": 1, "value": "y"}\n')
+
+        records = list(datahog.bulk.read_jsonl(fp))
+
+        self.assertEqual(type(records[0]['value']), str)
+        self.assertEqual(type(records[1]['value']), unicode)
+
+
+class CopyFormatTests(unittest.TestCase):
+    def test_fields(self):
+        self.assertEqual(
+                query._copy_file([
+                    (None, True, 12L, psycopg2.Binary('\x00\\'),
+                        u'a\tb\\c\n\xe9')]).read(),
+                '\\N\tt\t12\t\\\\x005c\ta\\tb\\\\c\\n\xc3\xa9\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
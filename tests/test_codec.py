@@ -0,0 +1,63 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import os
+import sys
+import unittest
+
+import datahog
+from datahog import error
+from datahog.const import codec
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+
+
+class CodecTests(base.TestCase):
+    def setUp(self):
+        super(CodecTests, self).setUp()
+        datahog.set_context(1, datahog.NODE, {
+            'storage': datahog.storage.INT})
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.UTF})
+
+    def test_unknown_context(self):
+        self.assertRaises(error.BadContext, codec.get, 3)
+
+    def test_rebuilt_by_set_flag(self):
+        before = codec.get(1)
+        self.assertRaises(error.BadFlag, before.flags_to_int, [2])
+
+        datahog.set_flag(2, 1)
+        after = codec.get(1)
+
+        self.assertEqual(after.flags_to_int([2]), 2)
+        self.assertEqual(after.int_to_flags(3), set([2]))
+        self.assertEqual(before.int_to_flags(3), set())
+
+    def test_rebuilt_after_meta_cleared(self):
+        datahog.context.META.clear()
+        self.assertRaises(error.BadContext, codec.get, 1)
+
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, codec.get(1), 'storage',
+                datahog.storage.STR)
+
+    def test_decode_rows(self):
+        datahog.set_flag(1, 2)
+        rows = [
+            {'ctx': 1, 'flags': 1, 'value': 5},
+            None,
+            {'ctx': 2, 'flags': 1, 'value': psycopg2.Binary('x')},
+        ]
+
+        self.assertEqual(codec.decode_rows(rows), [
+            {'ctx': 1, 'flags': set(), 'value': 5},
+            None,
+            {'ctx': 2, 'flags': set([1]), 'value': u'x'},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
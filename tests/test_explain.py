@@ -0,0 +1,129 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import json
+import os
+import sys
+import unittest
+
+import datahog
+from datahog.db import query
+import psycopg2
+import psycopg2.extensions
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pgmock
+
+
+# these run the queries' plans on a real postgres (11 or later), in a scratch
+# schema built from the migrations. point this at a database to run them:
+#   DATAHOG_TEST_DSN="dbname=scratch" python -m pytest tests/test_explain.py
+DSN = os.environ.get('DATAHOG_TEST_DSN')
+
+SCHEMA = 'datahog_explain_%d' % os.getpid()
+MIGRATIONS = ['00', '01', '02', '03', '04', '05']
+
+
+class ExplainingCursor(object):
+    # runs EXPLAIN in place of each query, and looks empty to the caller
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, sql, params=()):
+        self.cursor.execute("explain (format json) " + sql, params)
+        plan = self.cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        self.plans.append(plan[0]['Plan'])
+
+    rowcount = 0
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+def node_types(plan):
+    types = [plan['Node Type']]
+    for child in plan.get('Plans', ()):
+        types.extend(node_types(child))
+    return types
+
+
+@unittest.skipUnless(DSN, "DATAHOG_TEST_DSN isn't set")
+class ExplainTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        here = os.path.dirname(os.path.abspath(__file__))
+        cls.conn = pgmock.real_connect(DSN)
+        cls.conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = cls.conn.cursor()
+        cursor.execute("create schema %s" % SCHEMA)
+        cursor.execute("set search_path to %s" % SCHEMA)
+        for migration in MIGRATIONS:
+            with open('%s/../schema/%s.up.sql' % (here, migration)) as fp:
+                cursor.execute(fp.read() % {'start': 1, 'max': 1 << 56})
+
+        # all-visible pages, and no other way to read the tables
+        cursor.execute("vacuum analyze property, alias_lookup, relationship, "
+                "node, prefix_lookup")
+        cursor.execute("set enable_seqscan to off")
+        cursor.execute("set enable_bitmapscan to off")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.cursor().execute("drop schema %s cascade" % SCHEMA)
+        cls.conn.close()
+
+    def setUp(self):
+        datahog.set_context(1, datahog.NODE, {
+            'storage': datahog.storage.INT})
+        datahog.set_context(2, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(3, datahog.ALIAS, {'base_ctx': 1})
+        datahog.set_context(4, datahog.RELATIONSHIP, {
+            'base_ctx': 1, 'rel_ctx': 1})
+        datahog.set_context(5, datahog.NAME, {
+            'base_ctx': 1, 'search': datahog.search.PREFIX})
+        self.cursor = ExplainingCursor(self.conn.cursor())
+
+    def tearDown(self):
+        datahog.context.META.clear()
+        datahog.flag.META.clear()
+
+    def assertIndexOnly(self):
+        for plan in self.cursor.plans:
+            types = node_types(plan)
+            self.assertTrue('Index Only Scan' in types, types)
+            self.assertFalse('Index Scan' in types, types)
+            self.assertFalse('Seq Scan' in types, types)
+
+    def test_select_property(self):
+        query.select_property(self.cursor, 1, 2)
+        self.assertIndexOnly()
+
+    def test_select_alias_lookup(self):
+        query.select_alias_lookup(self.cursor, 'x' * 20, 3)
+        self.assertIndexOnly()
+
+    def test_select_node(self):
+        query.select_node(self.cursor, 1, 1)
+        self.assertIndexOnly()
+
+    def test_select_relationships(self):
+        query.select_relationships(self.cursor, 1, 4, True, 100, 0)
+        query.select_relationships(self.cursor, 1, 4, False, 100, 0)
+        self.assertIndexOnly()
+
+    def test_search_prefixes(self):
+        query.search_prefixes(self.cursor, 'val', 5, 100, '')
+        query.search_prefixes(self.cursor, '', 5, 100, '')
+        self.assertIndexOnly()
+
+
+if __name__ == '__main__':
+    unittest.main()
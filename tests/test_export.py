@@ -0,0 +1,106 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import os
+import StringIO
+import sys
+import unittest
+
+import datahog
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+class ExportTests(base.TestCase):
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.SERIAL})
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(4, datahog.ALIAS, {'base_ctx': 1})
+        datahog.set_context(5, datahog.NAME, {
+            'base_ctx': 1, 'search': datahog.search.PREFIX})
+        datahog.set_context(6, datahog.RELATIONSHIP, {
+            'base_ctx': 1, 'rel_ctx': 1})
+        datahog.set_flag(1, 3)
+
+    def dump(self):
+        # the set transaction
+        add_fetch_result([])
+        # nodes come back with a child ahead of its parent
+        add_fetch_result([
+            (5, 2, 0, None, psycopg2.Binary('\x10\x01\x02\x01'), 7),
+            (7, 1, 0, None, None, None),
+            (8, 1, 0, None, None, None)])
+        add_fetch_result([(7, 3, 1, 12, None)])
+        add_fetch_result([(7, 4, 0, 'al')])
+        add_fetch_result([(7, 5, 0, '\xc3\xa9')])
+        add_fetch_result([(7, 6, 0, 8)])
+
+        fp = StringIO.StringIO()
+        counts = datahog.export.dump(self.p, fp, chunk_size=2)
+        fp.seek(0)
+        return counts, fp
+
+    def test_round_trip(self):
+        counts, fp = self.dump()
+
+        self.assertEqual(counts, {'node': 3, 'property': 1, 'alias': 1,
+            'name': 1, 'relationship': 1})
+
+        contexts, rows = datahog.export.read(fp)
+        self.assertEqual(contexts[2],
+                (datahog.NODE, {'base_ctx': 1,
+                    'storage': datahog.storage.SERIAL}))
+        self.assertEqual(list(rows), [
+            (datahog.NODE, (5, 2, 0, [1], 7)),
+            (datahog.NODE, (7, 1, 0, None, None)),
+            (datahog.NODE, (8, 1, 0, None, None)),
+            (datahog.PROPERTY, (7, 3, 1, 12)),
+            (datahog.ALIAS, (7, 4, 0, u'al')),
+            (datahog.NAME, (7, 5, 0, u'\xe9')),
+            (datahog.RELATIONSHIP, (7, 6, 0, 8)),
+        ])
+
+    def test_single_snapshot(self):
+        self.dump()
+
+        self.assertEqual(eventlog[:2], [
+            GET_CURSOR,
+            EXECUTE(
+                "set transaction isolation level repeatable read, read only",
+                ())])
+
+    def test_records(self):
+        counts, fp = self.dump()
+
+        self.assertEqual(list(datahog.export.records(fp)), [
+            {'type': 'node', 'ref': 7, 'ctx': 1, 'value': None,
+                'flags': []},
+            {'type': 'node', 'ref': 5, 'ctx': 2, 'value': [1], 'flags': [],
+                'base': 7},
+            {'type': 'node', 'ref': 8, 'ctx': 1, 'value': None,
+                'flags': []},
+            {'type': 'prop', 'ctx': 3, 'value': 12, 'flags': [1],
+                'base': 7},
+            {'type': 'alias', 'ctx': 4, 'value': u'al', 'flags': [],
+                'base': 7},
+            {'type': 'name', 'ctx': 5, 'value': u'\xe9', 'flags': [],
+                'base': 7},
+        ])
+
+    def test_truncated(self):
+        counts, fp = self.dump()
+        fp = StringIO.StringIO(fp.getvalue()[:-3])
+
+        contexts, rows = datahog.export.read(fp)
+        self.assertRaises(ValueError, list, rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
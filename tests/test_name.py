@@ -6,6 +6,7 @@ import unittest
 
 import datahog
 from datahog import error
+from datahog.db import query
 import fuzzy
 import psycopg2
 
@@ -48,7 +49,7 @@ class NameTests(base.TestCase):
             EXECUTE("""
 insert into name (base_id, ctx, value, flags, pos)
 select %s, %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from name
     where
         time_removed is null
@@ -56,7 +57,7 @@ select %s, %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where exists (
     select 1 from node
     where
@@ -94,7 +95,7 @@ values (%s, %s, %s, %s, %s)
             EXECUTE("""
 insert into name (base_id, ctx, value, flags, pos)
 select %s, %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from name
     where
         time_removed is null
@@ -102,7 +103,7 @@ select %s, %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where exists (
     select 1 from node
     where
@@ -144,7 +145,7 @@ values (%s, %s, %s, %s, %s)
             EXECUTE("""
 insert into name (base_id, ctx, value, flags, pos)
 select %s, %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from name
     where
         time_removed is null
@@ -152,7 +153,7 @@ select %s, %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where exists (
     select 1 from node
     where
@@ -185,7 +186,7 @@ values (%s, %s, %s, %s)
             EXECUTE("""
 insert into name (base_id, ctx, value, flags, pos)
 select %s, %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from name
     where
         time_removed is null
@@ -193,7 +194,7 @@ select %s, %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where exists (
     select 1 from node
     where
@@ -225,11 +226,12 @@ from prefix_lookup
 where
     time_removed is null
     and ctx=%s
-    and value like %s || '%%'
-    and value > %s
-order by value
+    and value collate "C" >= %s
+    and value collate "C" < %s
+    and value collate "C" > %s
+order by value collate "C", base_id
 limit %s
-""", (3, 'value', '', 100)),
+""", (3, 'value', u'valuf', '', 100)),
             FETCH_ALL,
             COMMIT])
 
@@ -262,7 +264,7 @@ where
     and ctx=%s
     and code=%s
     and base_id > %s
-order by base_id
+order by base_id, value collate "C"
 limit %s
 """, (2, dm, 0, 100)),
             FETCH_ALL,
@@ -297,7 +299,7 @@ where
     and ctx=%s
     and code=%s
     and base_id > %s
-order by base_id
+order by base_id, value collate "C"
 limit %s
 """, (2, dm, 125, 100)),
             FETCH_ALL,
@@ -329,9 +331,9 @@ where
     and ctx=%s
     and code=%s
     and base_id > %s
-order by base_id
+order by base_id, value collate "C"
 limit %s
-""", (2, dm, 0, 100)),
+""", (2, dm, 0, 50)),
             FETCH_ALL,
             COMMIT,
             GET_CURSOR,
@@ -343,9 +345,9 @@ where
     and ctx=%s
     and code=%s
     and base_id > %s
-order by base_id
+order by base_id, value collate "C"
 limit %s
-""", (2, dmalt, 0, 100)),
+""", (2, dmalt, 0, 50)),
             FETCH_ALL,
             COMMIT])
 
@@ -601,7 +603,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (6, 3, 'value', 123)),
@@ -611,7 +613,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update prefix_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (6, 3, 'value', 123)),
@@ -652,7 +654,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (6, 2, 'value', 123)),
@@ -662,7 +664,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update phonetic_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and code=%s and ctx=%s and base_id=%s and value=%s
 returning flags
 """, (6, dm, 2, 123, 'value')),
@@ -718,7 +720,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (6, 2, 'window', 123)),
@@ -729,7 +731,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update phonetic_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and code=%s and ctx=%s and base_id=%s and value=%s
 returning flags
 """, (6, dm, 2, 123, 'window')),
@@ -739,7 +741,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update phonetic_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and code=%s and ctx=%s and base_id=%s and value=%s
 returning flags
 """, (6, dmalt, 2, 123, 'window')),
@@ -846,7 +848,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where
     time_removed is null
     and ctx=%s
@@ -860,7 +862,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update prefix_lookup
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where
     time_removed is null
     and ctx=%s
@@ -902,7 +904,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where
     time_removed is null
     and ctx=%s
@@ -916,7 +918,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update prefix_lookup
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where
     time_removed is null
     and ctx=%s
@@ -976,7 +978,7 @@ where
             GET_CURSOR,
             EXECUTE("""
 update name
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and ctx=%s and value=%s and base_id=%s
 returning flags
 """, (1, 6, 2, 'window', 123)),
@@ -987,7 +989,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update phonetic_lookup
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and code=%s and ctx=%s and base_id=%s and value=%s
 returning flags
 """, (1, 6, dm, 2, 123, 'window')),
@@ -997,7 +999,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update phonetic_lookup
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and code=%s and ctx=%s and base_id=%s and value=%s
 returning flags
 """, (1, 6, dmalt, 2, 123, 'window')),
@@ -1007,7 +1009,7 @@ returning flags
             TPC_COMMIT])
 
     def test_shift(self):
-        add_fetch_result([None])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.name.shift(self.p, 123, 2, 'value', 7),
@@ -1015,58 +1017,12 @@ returning flags
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-), bump as (
-    update name
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update name
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning 1
-)
-select 1 from move
-""", (123, 2, 'value', 123, 2, 7, 123, 2, 7, 7, 123, 2, 'value')),
-            ROWCOUNT,
+            EXECUTE(query._REORDERS['name'], (123, 2, 'value', 7, 123, 2, 'value', 6, 123, 2, 'value', 123, 2, 'value', 7, 123, 2, 'value')),
+            FETCH_ONE,
             COMMIT])
 
     def test_shift_failure(self):
-        add_fetch_result([])
+        add_fetch_result([(False, False)])
 
         self.assertEqual(
                 datahog.name.shift(self.p, 123, 2, 'value', 7),
@@ -1074,54 +1030,8 @@ select 1 from move
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-), bump as (
-    update name
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from name
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update name
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning 1
-)
-select 1 from move
-""", (123, 2, 'value', 123, 2, 7, 123, 2, 7, 7, 123, 2, 'value')),
-            ROWCOUNT,
+            EXECUTE(query._REORDERS['name'], (123, 2, 'value', 7, 123, 2, 'value', 6, 123, 2, 'value', 123, 2, 'value', 7, 123, 2, 'value')),
+            FETCH_ONE,
             ROLLBACK])
 
     def test_remove_prefix(self):
@@ -1149,27 +1059,14 @@ where
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update name
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update name
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, 'value', 123, 3)),
+update name
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (123, 3, 'value')),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
@@ -1215,27 +1112,14 @@ where
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update name
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update name
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 2, 'value', 123, 2)),
+update name
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (123, 2, 'value')),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
@@ -1297,27 +1181,14 @@ where
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update name
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and value=%s
-    returning pos
-), bump as (
-    update name
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 2, 'window', 123, 2)),
+update name
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (123, 2, 'window')),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
@@ -1353,5 +1224,157 @@ where
             TPC_COMMIT])
 
 
+class ShardedNameTests(base.ShardedTestCase):
+    def setUp(self):
+        super(ShardedNameTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(3, datahog.NAME,
+                {'base_ctx': 1, 'search': datahog.search.PREFIX})
+
+    def test_search_prefix_merges_shards(self):
+        add_fetch_result([(123, 0, 'value1'), (124, 0, 'value3')])
+        add_fetch_result([(125, 0, 'value2'), (126, 0, 'value4')])
+
+        self.assertEqual(
+                datahog.name.search(self.p, 'value', 3, limit=3),
+                ([
+                    {'base_id': 123, 'ctx': 3, 'value': 'value1',
+                        'flags': set([])},
+                    {'base_id': 125, 'ctx': 3, 'value': 'value2',
+                        'flags': set([])},
+                    {'base_id': 124, 'ctx': 3, 'value': 'value3',
+                        'flags': set([])},
+                ], 'value3'))
+
+        self.assertEqual(eventlog.count(GET_CURSOR), 2)
+
+    def test_search_prefix_no_results(self):
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.name.search(self.p, 'value', 3, start='value0'),
+                ([], 'value0'))
+
+    def test_search_prefix_fetches_more_from_a_busy_shard(self):
+        # with a limit of 4, each shard first gets asked for 2 rows
+        add_fetch_result([(123, 0, 'value1'), (124, 0, 'value2')])
+        add_fetch_result([(125, 0, 'value5')])
+        add_fetch_result([(126, 0, 'value3'), (127, 0, 'value4')])
+
+        self.assertEqual(
+                datahog.name.search(self.p, 'value', 3, limit=4),
+                ([
+                    {'base_id': 123, 'ctx': 3, 'value': 'value1',
+                        'flags': set([])},
+                    {'base_id': 124, 'ctx': 3, 'value': 'value2',
+                        'flags': set([])},
+                    {'base_id': 126, 'ctx': 3, 'value': 'value3',
+                        'flags': set([])},
+                    {'base_id': 127, 'ctx': 3, 'value': 'value4',
+                        'flags': set([])},
+                ], 'value4'))
+
+        search = """
+select base_id, flags, value
+from prefix_lookup
+where
+    time_removed is null
+    and ctx=%s
+    and value collate "C" >= %s
+    and value collate "C" < %s
+    and value collate "C" > %s
+order by value collate "C", base_id
+limit %s
+"""
+        resume = search.replace('and value collate "C" > %s',
+                'and (value collate "C", base_id) > (%s, %s)')
+        self.assertEqual(
+                [ev for ev in eventlog if isinstance(ev, EXECUTE)], [
+                    EXECUTE(search, (3, 'value', u'valuf', '', 2)),
+                    EXECUTE(search, (3, 'value', u'valuf', '', 2)),
+                    EXECUTE(resume, (3, 'value', u'valuf', 'value2', 124, 2))])
+
+    def test_search_prefix_chunks_split_a_value(self):
+        # the second chunk starts part way through the 'value1's
+        add_fetch_result([(123, 0, 'value1'), (124, 0, 'value1')])
+        add_fetch_result([(126, 0, 'value2')])
+        add_fetch_result([(125, 0, 'value1')])
+
+        self.assertEqual(
+                datahog.name.search(self.p, 'value', 3, limit=4),
+                ([
+                    {'base_id': 123, 'ctx': 3, 'value': 'value1',
+                        'flags': set([])},
+                    {'base_id': 124, 'ctx': 3, 'value': 'value1',
+                        'flags': set([])},
+                    {'base_id': 125, 'ctx': 3, 'value': 'value1',
+                        'flags': set([])},
+                    {'base_id': 126, 'ctx': 3, 'value': 'value2',
+                        'flags': set([])},
+                ], 'value2'))
+
+        self.assertEqual(
+                [ev for ev in eventlog if isinstance(ev, EXECUTE)][-1],
+                EXECUTE("""
+select base_id, flags, value
+from prefix_lookup
+where
+    time_removed is null
+    and ctx=%s
+    and value collate "C" >= %s
+    and value collate "C" < %s
+    and (value collate "C", base_id) > (%s, %s)
+order by value collate "C", base_id
+limit %s
+""", (3, 'value', u'valuf', 'value1', 124, 2)))
+
+    def test_search_phonetic_chunks_split_a_base_id(self):
+        datahog.set_context(4, datahog.NAME,
+                {'base_ctx': 1, 'search': datahog.search.PHONETIC})
+        dm, dmalt = _dm('fancy')
+
+        # the second chunk starts part way through base_id 123's names
+        add_fetch_result([(123, 0, 'fancy'), (123, 0, 'fancyer')])
+        add_fetch_result([(125, 0, 'phancy')])
+        add_fetch_result([(123, 0, 'fancyest')])
+
+        results, token = datahog.name.search(self.p, 'fancy', 4, limit=4)
+        self.assertEqual([(r['base_id'], r['value']) for r in results],
+                [(123, 'fancy'), (123, 'fancyer'), (123, 'fancyest'),
+                    (125, 'phancy')])
+
+        self.assertEqual(
+                [ev for ev in eventlog if isinstance(ev, EXECUTE)][-1],
+                EXECUTE("""
+select base_id, flags, value
+from phonetic_lookup
+where
+    time_removed is null
+    and ctx=%s
+    and code=%s
+    and (base_id, value collate "C") > (%s, %s)
+order by base_id, value collate "C"
+limit %s
+""", (4, dm, 123, 'fancyer', 2)))
+
+
+class PrefixSuccessorTests(unittest.TestCase):
+    def test_increments_last_char(self):
+        self.assertEqual(query._prefix_successor('abc'), u'abd')
+        self.assertEqual(query._prefix_successor(u'caf\xe9'), u'caf\xea')
+
+    def test_skips_surrogates(self):
+        self.assertEqual(query._prefix_successor(u'a\ud7ff'), u'a\ue000')
+
+    def test_carries_past_max_char(self):
+        top = unichr(sys.maxunicode)
+        self.assertEqual(query._prefix_successor(u'ab' + top + top), u'ac')
+        self.assertEqual(query._prefix_successor(top), None)
+
+    def test_empty_prefix_has_no_bound(self):
+        self.assertEqual(query._prefix_successor(''), None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 # vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
 
+import copy
 import os
 import sys
 import unittest
@@ -7,6 +8,7 @@ import unittest
 import datahog
 from datahog.const import util
 from datahog import error
+from datahog.db import query
 import mummy
 import psycopg2
 
@@ -51,7 +53,7 @@ returning id
             EXECUTE("""
 insert into edge (base_id, ctx, child_id, pos)
 select %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from edge
     where
         time_removed is null
@@ -59,7 +61,7 @@ select %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where true
 """, (123, 2, 1234, 123, 2)),
             ROWCOUNT,
@@ -67,7 +69,7 @@ where true
 
     def test_create_at_index(self):
         add_fetch_result([(1234,)])
-        add_fetch_result([(1,)])
+        add_fetch_result([(True, True)])
         self.assertEqual(
                 datahog.node.create(self.p, 2, 12, 123, 5),
                 {'id': 1234, 'ctx': 2, 'value': 12, 'flags': set()})
@@ -90,22 +92,55 @@ returning id
             ROWCOUNT,
             FETCH_ONE,
             EXECUTE("""
-with bump as (
-    update edge
-    set pos=pos + 1
+with slot(pos) as (
+    select case
+        when hi is null then lo + 16777216
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %s = 0 then 0 else coalesce((
+            select pos
+            from edge
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ), (
+            select pos
+            from edge
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from edge
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ) as hi
+    ) as neighbours
+), insertion as (
+    insert into edge (base_id, ctx, child_id, pos)
+    select %s, %s, %s, pos
+    from slot
     where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos >= %s
+        pos is not null
         and true
+    returning 1
 )
-insert into edge (base_id, ctx, child_id, pos)
-select %s, %s, %s, %s
-where true
-returning 1
-""", (123, 2, 5, 123, 2, 1234, 5)),
-            ROWCOUNT,
+select true, exists (select 1 from insertion)
+""", (5, 123, 2, 4, 123, 2, 123, 2, 5, 123, 2, 1234)),
+            FETCH_ONE,
             COMMIT])
 
     def test_get(self):
@@ -160,8 +195,8 @@ select id, ctx, flags, num, value
 from node
 where
     time_removed is null
-    and (id, ctx) in ((%s,%s), (%s,%s), (%s,%s), (%s,%s))
-""", (1234, 2, 1235, 2, 1236, 2, 1237, 3)),
+    and (id, ctx) in (select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([1234, 1235, 1236, 1237], [2, 2, 2, 3])),
             FETCH_ALL,
             COMMIT])
 
@@ -274,8 +309,8 @@ select id, ctx, flags, num, value
 from node
 where
     time_removed is null
-    and (id, ctx) in ((%s, %s),(%s, %s),(%s, %s))
-""", (1234, 2, 1235, 2, 1236, 2)),
+    and (id, ctx) in (select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([1234, 1235, 1236], [2, 2, 2])),
             FETCH_ALL,
             COMMIT])
 
@@ -484,7 +519,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update node
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where
     time_removed is null
     and ctx=%s and id=%s
@@ -540,7 +575,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update node
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where
     time_removed is null
     and ctx=%s and id=%s
@@ -563,7 +598,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update node
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where
     time_removed is null
     and ctx=%s and id=%s
@@ -583,7 +618,7 @@ returning flags
                 None)
 
     def test_shift(self):
-        add_fetch_result([(True,)])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.node.shift(self.p, 1234, 2, 123, 0),
@@ -591,58 +626,12 @@ returning flags
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-), bump as (
-    update edge
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update edge
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (123, 2, 1234, 123, 2, 0, 123, 2, 0, 0, 123, 2, 1234)),
+            EXECUTE(query._REORDERS['edge'], (123, 2, 1234, 0, 123, 2, 1234, 0, 123, 2, 1234, 123, 2, 1234, 0, 123, 2, 1234)),
             FETCH_ONE,
             COMMIT])
 
     def test_shift_failure(self):
-        add_fetch_result([(False,)])
+        add_fetch_result([(False, False)])
 
         self.assertEqual(
                 datahog.node.shift(self.p, 1234, 2, 123, 0),
@@ -650,53 +639,7 @@ select exists (select 1 from move)
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-), bump as (
-    update edge
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-), maxpos(n) as (
-    select pos
-    from edge
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-    order by pos desc
-    limit 1
-), move as (
-    update edge
-    set pos=(case
-        when %s > (select n from maxpos)
-        then (select n from maxpos)
-        else %s
-        end)
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (123, 2, 1234, 123, 2, 0, 123, 2, 0, 0, 123, 2, 1234)),
+            EXECUTE(query._REORDERS['edge'], (123, 2, 1234, 0, 123, 2, 1234, 0, 123, 2, 1234, 123, 2, 1234, 0, 123, 2, 1234)),
             FETCH_ONE,
             COMMIT])
 
@@ -712,32 +655,19 @@ select exists (select 1 from move)
         self.assertEqual(eventlog, [
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update edge
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning pos
-), bump as (
-    update edge
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 2, 1234, 123, 2)),
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (123, 2, 1234)),
             ROWCOUNT,
             EXECUTE("""
 insert into edge (base_id, ctx, child_id, pos)
 select %s, %s, %s, coalesce((
-    select pos + 1
+    select pos
     from edge
     where
         time_removed is null
@@ -745,7 +675,7 @@ select %s, %s, %s, coalesce((
         and ctx=%s
     order by pos desc
     limit 1
-), 1)
+), 0) + 16777216
 where exists(
     select 1 from node
     where
@@ -759,7 +689,7 @@ where exists(
 
     def test_move_to_index(self):
         add_fetch_result([(1,)])
-        add_fetch_result([(1,)])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.node.move(self.p, 1234, 2, 123, 124, 4),
@@ -768,57 +698,78 @@ where exists(
         self.assertEqual(eventlog, [
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update edge
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning pos
-), bump as (
-    update edge
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 2, 1234, 123, 2)),
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (123, 2, 1234)),
             ROWCOUNT,
             EXECUTE("""
-with bump as (
-    update edge
-    set pos=pos + 1
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos >= %s
-        and exists (
-            select 1 from node
+with slot(pos) as (
+    select case
+        when hi is null then lo + 16777216
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %s = 0 then 0 else coalesce((
+            select pos
+            from edge
             where
                 time_removed is null
-                and id=%s
+                and base_id=%s
                 and ctx=%s
-        )
-)
-insert into edge (base_id, ctx, child_id, pos)
-select %s, %s, %s, %s
-where exists (
+            order by pos asc
+            offset %s
+            limit 1
+        ), (
+            select pos
+            from edge
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from edge
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ) as hi
+    ) as neighbours
+), insertion as (
+    insert into edge (base_id, ctx, child_id, pos)
+    select %s, %s, %s, pos
+    from slot
+    where
+        pos is not null
+        and exists(
     select 1 from node
     where
         time_removed is null
         and id=%s
         and ctx=%s
 )
-returning 1
-""", (124, 2, 4, 124, 1, 124, 2, 1234, 4, 124, 1)),
-            ROWCOUNT,
+    returning 1
+)
+select exists(
+    select 1 from node
+    where
+        time_removed is null
+        and id=%s
+        and ctx=%s
+), exists (select 1 from insertion)
+""", (4, 124, 2, 3, 124, 2, 124, 2, 4, 124, 2, 1234, 124, 1, 124,
+                1)),
+            FETCH_ONE,
             COMMIT])
 
     def test_remove_lone_node(self):
@@ -842,27 +793,14 @@ returning 1
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update edge
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning pos
-), bump as (
-    update edge
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (base_id, ctx, id, base_id, ctx)),
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (base_id, ctx, id)),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
@@ -873,35 +811,35 @@ update node
 set time_removed=now()
 where
     time_removed is null
-    and id in (%s)
+    and id = any(%s)
 returning id
-""", (id,)),
+""", ([id],)),
             FETCH_ALL,
             EXECUTE("""
 update property
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
-""", (id,)),
+    and base_id = any(%s)
+""", ([id],)),
             ROWCOUNT,
             EXECUTE("""
 update alias
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning value, ctx
-""", (id,)),
+""", ([id],)),
             FETCH_ALL,
             EXECUTE("""
 update name
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning base_id, ctx, value
-""", (id,)),
+""", ([id],)),
             FETCH_ALL,
             EXECUTE("""
 with forwardrels (base_id, ctx, forward, rel_id) as (
@@ -910,7 +848,7 @@ with forwardrels (base_id, ctx, forward, rel_id) as (
     where
         time_removed is null
         and forward=true
-        and base_id in (%s)
+        and base_id = any(%s)
     returning base_id, ctx, forward, rel_id
 ),
 backwardrels (base_id, ctx, forward, rel_id) as (
@@ -919,22 +857,22 @@ backwardrels (base_id, ctx, forward, rel_id) as (
     where
         time_removed is null
         and forward=false
-        and rel_id in (%s)
+        and rel_id = any(%s)
     returning base_id, ctx, forward, rel_id
 )
 select base_id, ctx, forward, rel_id from forwardrels
 UNION ALL
 select base_id, ctx, forward, rel_id from backwardrels
-""", (id, id)),
+""", ([id], [id])),
             FETCH_ALL,
             EXECUTE("""
 update edge
 set time_removed=now()
 where
     time_removed is null
-    and base_id in (%s)
+    and base_id = any(%s)
 returning child_id
-""", (id,)),
+""", ([id],)),
             FETCH_ALL,
             TPC_PREPARE,
             RESET,
@@ -956,27 +894,14 @@ returning child_id
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update edge
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and child_id=%s
-    returning pos
-), bump as (
-    update edge
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (base_id, ctx, id, base_id, ctx)),
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (base_id, ctx, id)),
             ROWCOUNT,
             TPC_ROLLBACK])
 
@@ -1030,5 +955,96 @@ select 1 from removal
                 ['test', 'path', {10: 0.1}])
 
 
+class SingleConnectionTests(unittest.TestCase):
+    def setUp(self):
+        conf = copy.deepcopy(base.TestCase.CONFIG)
+        conf['shards'][0]['count'] = 1
+        self.p = datahog.ThreadedConnPool(conf)
+        self.p.start()
+        self.assertEqual(self.p.wait_ready(1), True)
+        reset()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def tearDown(self):
+        self.assertEqual(self.p._out, {})
+        self.assertEqual(self.p._conns[0].qsize(), 1)
+        self.p = None
+        datahog.context.META.clear()
+        datahog.flag.META.clear()
+        reset()
+
+    def test_iter_children(self):
+        # each page's nodes come from the same (and only) connection that
+        # its ids did, so it must be back in the pool by then
+        add_fetch_result([(1234, 2, 0)])
+        add_fetch_result([(1234, 2, 0, 87422, None)])
+        add_fetch_result([(1235, 2, 1)])
+        add_fetch_result([(1235, 2, 0, 742, None)])
+        add_fetch_result([])
+
+        future = self.p.submit(list,
+                datahog.node.iter_children(self.p, 1233, 2, fetch_size=1))
+
+        self.assertEqual(future.result(1), [
+            {'id': 1234, 'ctx': 2, 'value': 87422, 'flags': set()},
+            {'id': 1235, 'ctx': 2, 'value': 742, 'flags': set()}])
+
+        self.assertEqual([ev for ev in eventlog if ev is COMMIT], [COMMIT] * 5)
+
+
+class ShardedNodeTests(base.ShardedTestCase):
+    def setUp(self):
+        super(ShardedNodeTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def test_batch_get_multiple_shards(self):
+        other = 1 << 56
+        add_fetch_result([(1234, 2, 0, 10, None)])
+        add_fetch_result([(other + 5, 2, 0, 11, None)])
+
+        self.assertEqual(
+                datahog.node.batch_get(self.p, [
+                    (other + 5, 2), (1234, 2), (other + 6, 2)]),
+                [{'id': other + 5, 'ctx': 2, 'flags': set(), 'value': 11},
+                {'id': 1234, 'ctx': 2, 'flags': set(), 'value': 10},
+                None])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select id, ctx, flags, num, value
+from node
+where
+    time_removed is null
+    and (id, ctx) in (select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([1234], [2])),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+select id, ctx, flags, num, value
+from node
+where
+    time_removed is null
+    and (id, ctx) in (select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([other + 5, other + 6], [2, 2])),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_batch_get_failure_waits_for_all_shards(self):
+        query_fail(psycopg2.ProgrammingError)
+
+        self.assertRaises(psycopg2.ProgrammingError,
+                datahog.node.batch_get, self.p, [(1234, 2), (1 << 56, 2)])
+
+        self.assertEqual(len(self.p._out), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
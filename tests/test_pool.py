@@ -0,0 +1,571 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import copy
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+import datahog
+from datahog import error, pool
+from datahog.db import txn
+import greenhouse
+import psycopg2
+import psycopg2.extensions
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+class ElasticPoolTests(base.TestCase):
+    CONFIG = dict(base.TestCase.CONFIG, shards=[{
+            'shard': 0,
+            'min': 2,
+            'max': 3,
+            'idle_timeout': 60,
+            'max_lifetime': 3600,
+            'host': None,
+            'port': None,
+            'user': None,
+            'password': None,
+            'database': None,
+        }])
+
+    def tearDown(self):
+        self.assertEqual(self.p._out, {})
+        self.assertEqual(len(self.p._conns[0]._data), self.p._sizes[0])
+        self.p = None
+        reset()
+
+    def test_grows_when_empty(self):
+        c1 = self.p.get_by_shard(0, replace=False)
+        c2 = self.p.get_by_shard(0, replace=False)
+        self.assertEqual(eventlog, [])
+
+        c3 = self.p.get_by_shard(0, replace=False)
+        self.assertEqual(eventlog, [CONNECT])
+        self.assertEqual(self.p._sizes[0], 3)
+
+        for c in (c1, c2, c3):
+            self.p.put(c)
+
+    def test_no_growth_past_max(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(3)]
+
+        self.assertRaises(error.Timeout,
+                self.p.get_by_shard, 0, replace=False, timeout=0.01)
+        self.assertEqual(eventlog, [CONNECT])
+
+        for c in conns:
+            self.p.put(c)
+
+    def test_growth_retried_for_waiter(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(2)]
+        self.p.backoff = lambda: iter([0])
+        connect_fail(True)
+
+        got = []
+        greenhouse.schedule(
+                lambda: got.append(self.p.get_by_shard(0, replace=False)))
+        for i in xrange(10):
+            greenhouse.pause()
+
+        # the first attempt and its retry, then they start over
+        self.assertEqual(got, [])
+        self.assertEqual(eventlog[:3], [CONNECT_FAIL] * 3)
+
+        connect_fail(False)
+        for i in xrange(10):
+            greenhouse.pause()
+
+        self.assertEqual(len(got), 1)
+        self.assertEqual(eventlog[-1], CONNECT)
+        self.assertEqual(self.p._sizes[0], 3)
+
+        for c in conns + got:
+            self.p.put(c)
+
+    def test_reap_idle_down_to_min(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(3)]
+        for c in conns:
+            self.p.put(c)
+        del eventlog[:]
+
+        for key in self.p._idle:
+            self.p._idle[key] -= 120
+        self.p._reap()
+
+        self.assertEqual(eventlog, [CLOSE])
+        self.assertEqual(self.p._sizes[0], 2)
+
+        # they've all been idle too long, but we never go below 'min'
+        self.p._reap()
+        self.assertEqual(eventlog, [CLOSE])
+
+    def test_recycle_after_lifetime(self):
+        conn = self.p.get_by_shard(0, replace=False)
+        self.p._born[id(conn)] -= 7200
+        self.p.put(conn)
+
+        # closed, and replaced since that took us below 'min'
+        self.assertEqual(eventlog, [CLOSE])
+        self.assertEqual(self.p._sizes[0], 2)
+
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(2)]
+        self.assertEqual(eventlog, [CLOSE, CONNECT])
+        self.assertEqual(conn in conns, False)
+
+        for c in conns:
+            self.p.put(c)
+
+
+class AdminShutdown(psycopg2.OperationalError):
+    pgcode = '57P01'
+
+class LockNotAvailable(psycopg2.OperationalError):
+    pgcode = '55P03'
+
+
+class HealthCheckTests(base.TestCase):
+    CONFIG = dict(base.TestCase.CONFIG, shards=[dict(
+        base.TestCase.CONFIG['shards'][0], ping_interval=30)])
+
+    def test_disconnect_error_replaces_conn(self):
+        query_fail(AdminShutdown)
+
+        def f():
+            with self.p.get_by_shard(0) as conn:
+                conn.cursor().execute("select 1")
+        self.assertRaises(psycopg2.OperationalError, f)
+        query_fail(None)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE("select 1", ()),
+            ROLLBACK,
+            CLOSE])
+
+        greenhouse.pause()
+        self.assertEqual(eventlog[-1:], [CONNECT])
+        self.assertEqual(self.p._sizes[0], 2)
+
+    def test_closed_conn_error_replaces_conn(self):
+        def f():
+            with self.p.get_by_shard(0) as conn:
+                conn.closed = 2
+                raise psycopg2.OperationalError()
+        self.assertRaises(psycopg2.OperationalError, f)
+
+        self.assertEqual(eventlog, [ROLLBACK, CLOSE])
+
+        greenhouse.pause()
+        self.assertEqual(eventlog[-1:], [CONNECT])
+        self.assertEqual(self.p._sizes[0], 2)
+
+    def test_lock_timeout_keeps_conn(self):
+        query_fail(LockNotAvailable)
+
+        def f():
+            with self.p.get_by_shard(0) as conn:
+                conn.cursor().execute("select 1")
+        self.assertRaises(psycopg2.OperationalError, f)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE("select 1", ()),
+            ROLLBACK])
+
+    def test_query_error_keeps_conn(self):
+        query_fail(psycopg2.ProgrammingError)
+
+        def f():
+            with self.p.get_by_shard(0) as conn:
+                conn.cursor().execute("select 1")
+        self.assertRaises(psycopg2.ProgrammingError, f)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE("select 1", ()),
+            ROLLBACK])
+
+    def test_closed_conn_discarded_on_put(self):
+        conn = self.p.get_by_shard(0, replace=False)
+        conn.closed = 2
+        self.p.put(conn)
+        self.assertEqual(eventlog, [CLOSE])
+
+        greenhouse.pause()
+        self.assertEqual(eventlog, [CLOSE, CONNECT])
+        self.assertEqual(conn in self.p._conns[0]._data, False)
+
+    def test_ping_idle_conns(self):
+        add_fetch_result([(1,)])
+        add_fetch_result([(1,)])
+        for key in self.p._checked:
+            self.p._checked[key] -= 60
+        self.p._reap()
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("select 1", ()),
+            FETCH_ALL,
+            COMMIT] * 2)
+
+        # just checked, so they're left alone this time
+        self.p._reap()
+        self.assertEqual(len(eventlog), 8)
+
+    def test_failed_ping_replaces_conn(self):
+        query_fail(psycopg2.OperationalError)
+        for key in self.p._checked:
+            self.p._checked[key] -= 60
+        self.p._reap()
+        query_fail(None)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE("select 1", ()),
+            ROLLBACK,
+            CLOSE] * 2)
+
+        greenhouse.pause()
+        self.assertEqual(eventlog[-2:], [CONNECT, CONNECT])
+        self.assertEqual(self.p._sizes[0], 2)
+
+
+class ReplicaTests(base.TestCase):
+    CONFIG = dict(base.TestCase.CONFIG, shards=[dict(
+        base.TestCase.CONFIG['shards'][0], replicas=[
+            {'host': 'replica0', 'count': 1},
+            {'host': 'replica1', 'weight': 3},
+        ])])
+
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+
+        self.routed = []
+        get_by_shard = self.p.get_by_shard
+        def spy(shard, replace=True, timeout=None, replica=False):
+            self.routed.append(replica)
+            return get_by_shard(shard, replace, timeout, replica)
+        self.p.get_by_shard = spy
+
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def tearDown(self):
+        self.assertEqual(len(self.p._conns[(0, 0)]._data), 1)
+        self.assertEqual(len(self.p._conns[(0, 1)]._data), 2)
+        super(ReplicaTests, self).tearDown()
+
+    def test_replica_conf_inherits_from_primary(self):
+        conf = self.p._shards[(0, 1)]
+        self.assertEqual(conf['host'], 'replica1')
+        self.assertEqual(conf['min'], 2)
+        self.assertEqual(conf['max'], 2)
+        self.assertEqual(self.p._shards[(0, 0)]['min'], 1)
+
+    def test_weighted_replica_choice(self):
+        random.seed(0)
+        counts = {(0, 0): 0, (0, 1): 0}
+        for i in xrange(4000):
+            counts[self.p._pick_replica(0)] += 1
+        self.assertEqual(900 < counts[(0, 0)] < 1100, True)
+
+    def test_primary_unless_asked(self):
+        conn = self.p.get_by_shard(0, replace=False)
+        self.assertEqual(self.p._out[id(conn)], 0)
+        self.p.put(conn)
+
+        conn = self.p.get_by_id(1234, replace=False, replica=True)
+        self.assertEqual(self.p._out[id(conn)] in ((0, 0), (0, 1)), True)
+        self.p.put(conn)
+
+    def test_reads_use_replicas(self):
+        add_fetch_result([(0, 4781)])
+        datahog.node.get(self.p, 1234, 2)
+
+        self.assertEqual(self.routed, [True])
+
+    def test_writes_use_primary(self):
+        add_fetch_result([(True, False)])
+        datahog.prop.set(self.p, 1234, 3, 10)
+
+        self.assertEqual(self.routed, [False])
+
+
+class StatsTests(base.TestCase):
+    def setUp(self):
+        super(StatsTests, self).setUp()
+        self.events = []
+        self.p.add_stats_sink(
+                lambda shard, event, value: self.events.append((shard, event)))
+
+    def test_checkout_and_return(self):
+        conn = self.p.get_by_shard(0, replace=False)
+
+        stats = self.p.stats()[0]
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['waiting'], 0)
+
+        self.p.put(conn)
+
+        stats = self.p.stats()[0]
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(sum(n for bound, n in stats['latency']), 1)
+        self.assertEqual(stats['latency'][-1], (None, 0))
+
+        self.assertEqual(self.events, [(0, 'wait'), (0, 'latency')])
+
+    def test_timeouts_counted(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(2)]
+        self.assertRaises(error.Timeout,
+                self.p.get_by_shard, 0, timeout=0.01)
+
+        stats = self.p.stats()[0]
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(self.events[-1], (0, 'timeout'))
+
+        for c in conns:
+            self.p.put(c)
+
+    def test_deliberate_cancel_isnt_a_timeout(self):
+        def run(cancel):
+            with self.p.get_by_shard(0, timeout=5) as conn:
+                if cancel:
+                    self.p._cancel(conn)
+                raise psycopg2.extensions.QueryCanceledError()
+
+        self.assertRaises(psycopg2.extensions.QueryCanceledError, run, True)
+        self.assertEqual(self.p.stats()[0]['timeouts'], 0)
+        self.assertEqual(eventlog, [CANCEL, ROLLBACK])
+
+        # and the mark doesn't outlive the checkout
+        self.assertRaises(error.Timeout, run, False)
+        self.assertEqual(self.p.stats()[0]['timeouts'], 1)
+        self.assertEqual(eventlog[2:], [ROLLBACK, RESET])
+
+
+class RouterTests(unittest.TestCase):
+    PLANS = [[(0, 1)], [(0, 2), (1, 3)], [(1, 1), (2, 1), (3, 5)]]
+
+    def naive(self, plans, num):
+        found = []
+        for plan in plans[::-1]:
+            total = sum(w for s, w in plan)
+            n = num % total
+            for shard, weight in plan:
+                if n < weight:
+                    break
+                n -= weight
+            if shard not in found:
+                found.append(shard)
+        return tuple(found)
+
+    def check(self, plans):
+        prepared = [list(plan) for plan in plans]
+        for plan in prepared:
+            pool._prepare_plan(plan)
+        router = pool._Router(prepared)
+
+        for i in xrange(500):
+            num = pool._int_hash(hashlib.sha1(str(i)).digest())
+            self.assertEqual(router.route(num), self.naive(plans, num))
+
+        return router
+
+    def test_tabled(self):
+        router = self.check(self.PLANS)
+        self.assertEqual(router._period, 35)
+
+    def test_untabled(self):
+        router = self.check(self.PLANS + [[(4, 65537), (5, 3)]])
+        self.assertEqual(router._table, None)
+
+    def test_int_hash(self):
+        self.assertEqual(pool._int_hash('\x01\x00\xff'), 0x0100ff)
+
+
+class ThreadedPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.p = datahog.ThreadedConnPool(copy.deepcopy(base.TestCase.CONFIG))
+        self.p.start()
+        self.assertEqual(self.p.wait_ready(1), True)
+        reset()
+
+    def tearDown(self):
+        self.assertEqual(self.p._out, {})
+        self.assertEqual(self.p._conns[0].qsize(), 2)
+        self.p = None
+        reset()
+
+    def test_concurrent_checkouts(self):
+        def work():
+            for i in xrange(50):
+                with self.p.get_by_shard(0) as conn:
+                    conn.cursor()
+
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = self.p.stats()[0]
+        self.assertEqual(stats['checkouts'], 400)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(len(eventlog), 800)
+
+    def test_checkout_timeout(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(2)]
+        self.assertRaises(error.Timeout,
+                self.p.get_by_shard, 0, timeout=0.01)
+
+        for c in conns:
+            self.p.put(c)
+
+    def test_submit_workers_bounded(self):
+        running, peak = [0], [0]
+        lock = threading.Lock()
+        go = threading.Event()
+
+        def work(i):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            go.wait()
+            with lock:
+                running[0] -= 1
+            return i
+
+        futures = [self.p.submit(work, i) for i in xrange(10)]
+        time.sleep(0.01)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(self.p._workers, 2)
+
+        go.set()
+        self.assertEqual([f.result(1) for f in futures], range(10))
+        self.assertEqual(peak[0], 2)
+
+    def test_fanout_past_its_deadline(self):
+        # the second job starts after the deadline, and must get a Timeout
+        # or a zero wait rather than a negative one
+        self.p.max_fanout = 1
+
+        def job(cursor, pause):
+            time.sleep(pause)
+            return pause
+
+        self.assertEqual(
+                txn.fanout(self.p, [(0, (0.03,)), (0, (0,))], job, 0.01),
+                [0.03, 0])
+
+    def test_cancelled_timer_never_fires(self):
+        fired = []
+        t = self.p._timer(0.01, lambda: fired.append(1))
+        t.start()
+        t.cancel()
+        time.sleep(0.03)
+        self.assertEqual(fired, [])
+
+        t = self.p._timer(0.01, lambda: fired.append(1))
+        t.start()
+        time.sleep(0.03)
+        self.assertEqual(fired, [1])
+
+
+class ForkTests(base.TestCase):
+    def tearDown(self):
+        self.assertEqual(self.p._out, {})
+        self.assertEqual(len(self.p._conns[0]._data), self.p._sizes[0])
+        self.p = None
+        reset()
+
+    def fork(self):
+        # pretend we're in a child process
+        self.p._pid = -1
+
+    def test_reconnects_lazily(self):
+        inherited = list(self.p._conns[0]._data)
+        self.fork()
+
+        conn = self.p.get_by_shard(0, replace=False)
+        self.assertEqual(eventlog, [CONNECT])
+        self.assertEqual(conn in inherited, False)
+        self.p.put(conn)
+
+        # the parent's connections are kept around, but never closed
+        self.assertEqual(CLOSE in eventlog, False)
+        self.assertEqual(list(self.p._orphans[0][0]._data), inherited)
+        self.assertEqual(self.p._sizes[0], 1)
+
+    def test_checked_out_across_fork(self):
+        conn = self.p.get_by_shard(0, replace=False)
+        self.fork()
+
+        self.p.put(conn)
+        self.assertEqual(eventlog, [])
+        self.assertEqual(self.p._orphans[-1], conn)
+        self.assertEqual(self.p._conns[0].qsize(), 0)
+
+    def test_warm_after_fork(self):
+        self.p.after_fork(warm=True)
+        self.assertEqual(self.p.wait_ready(), True)
+
+        self.assertEqual(eventlog, [CONNECT, CONNECT])
+        self.assertEqual(self.p._sizes[0], 2)
+
+
+class SubmitTests(base.TestCase):
+    def setUp(self):
+        super(SubmitTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def test_concurrent_calls(self):
+        add_fetch_result([(0, 10)])
+        add_fetch_result([(0, 20)])
+
+        futures = [self.p.submit(datahog.node.get, self.p, nid, 2)
+                for nid in (1234, 1235)]
+        self.assertEqual(futures[0].done(), False)
+
+        self.assertEqual([f.result()['value'] for f in futures], [10, 20])
+        self.assertEqual(futures[0].done(), True)
+
+    def test_exception_reraised(self):
+        query_fail(psycopg2.ProgrammingError)
+
+        future = self.p.submit(datahog.node.get, self.p, 1234, 2)
+        self.assertRaises(psycopg2.ProgrammingError, future.result)
+
+    def test_wait_timeout(self):
+        conns = [self.p.get_by_shard(0, replace=False) for i in xrange(2)]
+
+        future = self.p.submit(datahog.node.get, self.p, 1234, 2)
+        self.assertRaises(error.Timeout, future.result, 0.01)
+
+        add_fetch_result([(0, 10)])
+        for c in conns:
+            self.p.put(c)
+        self.assertEqual(future.result()['value'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import os
+import sys
+import unittest
+
+from datahog.db import prepared
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import datahog
+from datahog.db import query
+import pgmock
+import psycopg2
+import psycopg2.extensions
+
+
+# the cursor tests need a real postgres, as in test_explain
+DSN = os.environ.get('DATAHOG_TEST_DSN')
+
+
+class StatementsTests(unittest.TestCase):
+    def setUp(self):
+        self.executed = []
+        self.statements = prepared.Statements(threshold=2, limit=2)
+
+    def execute(self, sql, args):
+        self.executed.append((sql, args))
+        if sql.startswith("prepare") and "ambiguous" in sql:
+            raise psycopg2.ProgrammingError()
+
+    def run_sql(self, sql, args=(), savepoint=False):
+        self.statements.execute(self.execute, sql, args, savepoint)
+
+    def test_prepared_once_hot(self):
+        sql = "select value from node where id=%s and ctx=%s"
+        self.run_sql(sql, (1, 2))
+        self.run_sql(sql, (3, 4))
+        self.run_sql(sql, (5, 6))
+
+        self.assertEqual(self.executed, [
+            (sql, (1, 2)),
+            ("prepare datahog_0 as "
+                "select value from node where id=$1 and ctx=$2", None),
+            ("execute datahog_0 (%s, %s)", (3, 4)),
+            ("execute datahog_0 (%s, %s)", (5, 6)),
+        ])
+
+    def test_no_args(self):
+        for i in xrange(2):
+            self.run_sql("select 1")
+
+        self.assertEqual(self.executed[-1], ("execute datahog_0", None))
+
+    def test_percent_escapes(self):
+        for i in xrange(2):
+            self.run_sql("select 1 where value like %s || '%%'", ('a',))
+
+        self.assertEqual(self.executed[1], (
+            "prepare datahog_0 as select 1 where value like $1 || '%'", None))
+
+    def test_limit(self):
+        for sql in ("select 1", "select 2", "select 3"):
+            for i in xrange(2):
+                self.run_sql(sql)
+
+        self.assertEqual(self.executed[-2:], [
+            ("select 3", ()),
+            ("select 3", ())])
+
+    def test_not_preparable(self):
+        for sql in ("create temp table t (id int)",
+                "select 1; select 2"):
+            for i in xrange(3):
+                self.run_sql(sql)
+
+        self.assertEqual(self.executed, [
+            ("create temp table t (id int)", ())] * 3 + [
+            ("select 1; select 2", ())] * 3)
+
+    def test_savepoint(self):
+        for i in xrange(2):
+            self.run_sql("select 1", savepoint=True)
+
+        self.assertEqual(self.executed[1:], [
+            ("savepoint datahog_prepare", None),
+            ("prepare datahog_0 as select 1", None),
+            ("release savepoint datahog_prepare", None),
+            ("execute datahog_0", None)])
+
+    def test_failed_prepare(self):
+        sql = "select %s ~ 'ambiguous'"
+        for i in xrange(4):
+            self.run_sql(sql, ('a',), savepoint=True)
+
+        self.assertEqual(self.executed, [
+            (sql, ('a',)),
+            ("savepoint datahog_prepare", None),
+            ("prepare datahog_0 as select $1 ~ 'ambiguous'", None),
+            ("rollback to savepoint datahog_prepare", None),
+            (sql, ('a',)),
+            (sql, ('a',)),
+            (sql, ('a',))])
+
+    def test_clear(self):
+        for i in xrange(2):
+            self.run_sql("select 1")
+        self.statements.clear()
+        for i in xrange(2):
+            self.run_sql("select 1")
+
+        self.assertEqual(
+                [sql for sql, args in self.executed].count(
+                    "prepare datahog_0 as select 1"),
+                2)
+
+
+SCHEMA = 'datahog_prepared_%d' % os.getpid()
+MIGRATIONS = ['00', '01', '02', '03', '04', '05']
+
+
+@unittest.skipUnless(DSN, "DATAHOG_TEST_DSN isn't set")
+class PreparingCursorTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        here = os.path.dirname(os.path.abspath(__file__))
+        conn = pgmock.real_connect(DSN)
+        conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        cursor.execute("create schema %s" % SCHEMA)
+        cursor.execute("set search_path to %s" % SCHEMA)
+        for migration in MIGRATIONS:
+            with open('%s/../schema/%s.up.sql' % (here, migration)) as fp:
+                cursor.execute(fp.read() % {'start': 1, 'max': 1 << 56})
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        conn = pgmock.real_connect(DSN)
+        conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute("drop schema %s cascade" % SCHEMA)
+        conn.close()
+
+    def setUp(self):
+        datahog.set_context(1, datahog.NODE, {
+            'storage': datahog.storage.INT})
+        datahog.set_context(2, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(3, datahog.NAME, {
+            'base_ctx': 1, 'search': datahog.search.PREFIX})
+        self.conn = pgmock.real_connect(DSN,
+                connection_factory=prepared.PreparingConnection)
+        self.conn.cursor().execute("set search_path to %s" % SCHEMA)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.conn.close()
+        datahog.context.META.clear()
+        datahog.flag.META.clear()
+
+    def test_named_cursor_runs_directly(self):
+        # hot enough to be prepared by the second run, were it not named
+        for i in xrange(3):
+            cursor = self.conn.cursor('datahog_iter_test')
+            cursor.execute("select generate_series(1, %s)", (3,))
+            self.assertEqual([row[0] for row in cursor], [1, 2, 3])
+            self.conn.rollback()
+
+        self.assertEqual(self.conn.statements._names, {})
+
+    def test_unnamed_cursor_prepares(self):
+        for i in xrange(3):
+            cursor = self.conn.cursor()
+            cursor.execute("select generate_series(1, %s)", (3,))
+            self.assertEqual([row[0] for row in cursor], [1, 2, 3])
+
+        self.assertEqual(self.conn.statements._names.values(), ['datahog_0'])
+
+    def test_query_sql_prepares(self):
+        cursor = self.conn.cursor()
+        cursor.execute("insert into property (base_id, ctx, num, flags) "
+                "values (1, 2, 5, 3)")
+
+        for i in xrange(3):
+            self.assertEqual(query.set_flags(cursor, 'property', 4, 1,
+                {'base_id': 1, 'ctx': 2}), [6])
+            self.assertEqual(query.set_flags(cursor, 'property', 1, 4,
+                {'base_id': 1, 'ctx': 2}), [3])
+            self.assertEqual(query.set_flags(cursor, 'property', 0, 2,
+                {'base_id': 1, 'ctx': 2}), [1])
+            self.assertEqual(query.set_flags(cursor, 'property', 2, 0,
+                {'base_id': 1, 'ctx': 2}), [3])
+            self.assertEqual(query.search_prefixes(cursor, 'val', 3, 10, ''),
+                    [])
+            self.assertEqual(len(query.select_properties(cursor, 1, [2])), 1)
+            self.assertEqual(
+                    query.remove_properties_multiple_bases(cursor, [2]), 0)
+
+        names = self.conn.statements._names
+        self.assertEqual(self.conn.statements._unpreparable, set())
+        self.assertEqual(len(names), 6)
+
+    def test_failed_prepare_keeps_the_transaction(self):
+        cursor = self.conn.cursor()
+        for i in xrange(3):
+            # "unknown + unknown" is ambiguous, but fine with values bound
+            cursor.execute("select %s + %s", (1, 2))
+            self.assertEqual(cursor.fetchone(), (3,))
+
+        self.assertEqual(self.conn.statements._unpreparable,
+                set(["select %s + %s"]))
+        cursor.execute("select 1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -219,6 +219,31 @@ where
             EXECUTE("""
 select num, flags
 from property
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+""", (1234, 2)),
+            ROWCOUNT,
+            FETCH_ONE,
+            COMMIT])
+
+    def test_get_after_context_redefined(self):
+        datahog.context.META.clear()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.PROPERTY,
+                {'base_ctx': 1, 'storage': datahog.storage.STR})
+        add_fetch_result([('foo', 0)])
+
+        self.assertEqual(
+                datahog.prop.get(self.p, 1234, 2),
+                {'base_id': 1234, 'ctx': 2, 'flags': set([]), 'value': 'foo'})
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select value, flags
+from property
 where
     time_removed is null
     and base_id=%s
@@ -278,8 +303,8 @@ from property
 where
     time_removed is null
     and base_id=%s
-    and ctx in (%s, %s, %s)
-""", (123, 2, 3, 4)),
+    and ctx = any(%s)
+""", (123, [2, 3, 4])),
             FETCH_ALL,
             COMMIT])
 
@@ -317,6 +342,90 @@ where
             FETCH_ALL,
             COMMIT])
 
+    def test_get_many(self):
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.STR})
+        datahog.set_flag(1, 3)
+        add_fetch_result([
+            (124, 3, None, "foobar", 1),
+            (123, 2, 10, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.get_many(self.p,
+                    [(123, 2), (124, 2), (124, 3), (123, 2)]),
+                [
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10},
+                    None,
+                    {'base_id': 124, 'ctx': 3, 'flags': set([1]),
+                        'value': 'foobar'},
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in (
+        select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([123, 124, 124], [2, 2, 3])),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_get_many_bad_ctx(self):
+        self.assertRaises(error.BadContext,
+                datahog.prop.get_many, self.p, [(123, 2), (123, 1)])
+        self.assertEqual(eventlog, [])
+
+    def test_get_list_matches_get_lists(self):
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.SERIAL})
+        value = mummy.dumps(['test', 'path', {10: 0.1}])
+        add_fetch_result([(3, None, value, 0)])
+        add_fetch_result([(123, 3, None, value, 0)])
+
+        single = datahog.prop.get_list(self.p, 123, [3])
+        self.assertEqual(single, datahog.prop.get_lists(self.p, [123], [3])[0])
+        self.assertEqual(single[0]['value'], ['test', 'path', {10: 0.1}])
+
+    def test_get_lists(self):
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.STR})
+        add_fetch_result([
+            (124, 3, None, "foobar", 0),
+            (123, 2, 10, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.get_lists(self.p, [123, 125, 124], [2, 3]),
+                [
+                    [{'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10},
+                        None],
+                    [None, None],
+                    [None, {'base_id': 124, 'ctx': 3, 'flags': set([]),
+                        'value': 'foobar'}],
+                ])
+
+        self.assertEqual(eventlog[:2], [
+            GET_CURSOR,
+            EXECUTE("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and base_id = any(%s::bigint[])
+    and ctx = any(%s::smallint[])
+""", ([123, 125, 124], [2, 3]))])
+
+    def test_get_lists_all(self):
+        add_fetch_result([(123, 2, 10, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.get_lists(self.p, [123, 124]),
+                [[{'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10}],
+                    []])
+
     def test_increment(self):
         add_fetch_result([(10,)])
 
@@ -438,7 +547,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update property
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and ctx=%s and base_id=%s
 returning flags
 """, (3, 2, 123)),
@@ -491,7 +600,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update property
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where
     time_removed is null and ctx=%s and base_id=%s
 returning flags
@@ -513,7 +622,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update property
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where
     time_removed is null and ctx=%s and base_id=%s
 returning flags
@@ -642,5 +751,47 @@ where
                 ['test', 'path', {10: 0.1}])
 
 
+class ShardedPropertyTests(base.ShardedTestCase):
+    def setUp(self):
+        super(ShardedPropertyTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.PROPERTY,
+                {'base_ctx': 1, 'storage': datahog.storage.INT})
+
+    def test_get_many(self):
+        other = 1 << 56
+        add_fetch_result([(123, 2, 10, None, 0)])
+        add_fetch_result([(other + 5, 2, 11, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.get_many(self.p,
+                    [(other + 5, 2), (123, 2), (other + 6, 2)]),
+                [
+                    {'base_id': other + 5, 'ctx': 2, 'flags': set([]),
+                        'value': 11},
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10},
+                    None,
+                ])
+
+        self.assertEqual(
+                [ev for ev in eventlog if isinstance(ev, EXECUTE)], [
+                    EXECUTE("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in (
+        select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([123], [2])),
+                    EXECUTE("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in (
+        select * from unnest(%s::bigint[], %s::smallint[]))
+""", ([other + 5, other + 6], [2, 2]))])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,137 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import copy
+import os
+import sys
+import thread
+import threading
+import unittest
+
+import datahog
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+def purge_sql(name):
+    return """
+delete from %s
+where
+    ctid = any(array(
+        select ctid
+        from %s
+        where time_removed < now() - %%s * interval '1 second'
+        order by time_removed
+        limit %%s))
+    and time_removed < now() - %%s * interval '1 second'
+""" % (name, name)
+
+
+class PurgeTests(base.TestCase):
+    def test_purge(self):
+        add_fetch_result([None, None])
+        add_fetch_result([None])
+        add_fetch_result([])
+
+        seen = []
+        def progress(*args):
+            seen.append(args)
+
+        self.assertEqual(
+                datahog.purge.purge(self.p, 86400, batch_size=2,
+                    tables=['relationship', 'alias'], progress=progress),
+                {'relationship': 3, 'alias': 0})
+
+        self.assertEqual(seen, [(0, 'relationship', 2),
+            (0, 'relationship', 3)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(purge_sql('relationship'), (86400, 2, 86400)),
+            ROWCOUNT,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE(purge_sql('relationship'), (86400, 2, 86400)),
+            ROWCOUNT,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE(purge_sql('alias'), (86400, 2, 86400)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_progress_stops(self):
+        add_fetch_result([None, None])
+        add_fetch_result([None, None])
+
+        self.assertEqual(
+                datahog.purge.purge(self.p, 60, batch_size=2,
+                    tables=['node', 'edge'], progress=lambda *a: True),
+                {'node': 2, 'edge': 0})
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(purge_sql('node'), (60, 2, 60)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_progress_interrupted(self):
+        add_fetch_result([None, None])
+        add_fetch_result([None, None])
+
+        def progress(*args):
+            raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, datahog.purge.purge, self.p, 60,
+                batch_size=2, tables=['node'], progress=progress)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(purge_sql('node'), (60, 2, 60)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_bad_table(self):
+        self.assertRaises(ValueError, datahog.purge.purge, self.p, 60,
+                tables=['nodes'])
+
+    def test_readonly(self):
+        self.p.readonly = True
+        self.assertRaises(datahog.error.ReadOnly, datahog.purge.purge,
+                self.p, 60)
+
+
+class ThreadedPurgeTests(unittest.TestCase):
+    def setUp(self):
+        self.p = datahog.ThreadedConnPool(copy.deepcopy(base.TestCase.CONFIG))
+        self.p.start()
+        self.assertEqual(self.p.wait_ready(1), True)
+        reset()
+
+    def tearDown(self):
+        self.assertEqual(self.p._out, {})
+        self.p = None
+        reset()
+
+    def test_interrupted(self):
+        # the interrupt comes while the main thread waits on the shard's
+        # pause, and stops the purge before its second batch
+        add_fetch_result([None, None])
+        add_fetch_result([])
+
+        timer = threading.Timer(0.05, thread.interrupt_main)
+        timer.start()
+        self.assertRaises(KeyboardInterrupt, datahog.purge.purge, self.p, 60,
+                batch_size=2, pause=0.5, tables=['node'])
+        timer.join()
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(purge_sql('node'), (60, 2, 60)),
+            ROWCOUNT,
+            COMMIT])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import os
+import sys
+import unittest
+
+import datahog
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+class CompactTests(base.TestCase):
+    POOL_KWARGS = {'compact': True}
+
+    def setUp(self):
+        super(CompactTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(3, datahog.RELATIONSHIP, {
+            'base_ctx': 1, 'rel_ctx': 2})
+        datahog.set_context(4, datahog.ALIAS, {'base_ctx': 1})
+        datahog.set_context(5, datahog.NAME, {
+            'base_ctx': 1, 'search': datahog.search.PREFIX})
+        datahog.set_flag(1, 3)
+        datahog.set_flag(1, 4)
+        datahog.set_flag(1, 5)
+
+    def test_batch_get(self):
+        add_fetch_result([(124, 2, 0, 5, None), (123, 2, 0, 4, None)])
+
+        nodes = datahog.node.batch_get(self.p, [(123, 2), (124, 2), (125, 2)])
+
+        self.assertEqual(nodes, [
+            datahog.record.Node(123, 2, 4, set()),
+            datahog.record.Node(124, 2, 5, set()),
+            None])
+        self.assertEqual(nodes[0].value, 4)
+        self.assertEqual(nodes[1]._asdict(),
+                {'id': 124, 'ctx': 2, 'value': 5, 'flags': set()})
+
+    def test_list_relationships(self):
+        add_fetch_result([(123, 1, 0), (124, 0, 1)])
+
+        rels, pos = datahog.relationship.list(self.p, 456, 3, False)
+
+        self.assertEqual(rels, [
+            datahog.record.Relationship(123, 456, 3, set([1])),
+            datahog.record.Relationship(124, 456, 3, set())])
+        self.assertEqual(pos, 2)
+        self.assertEqual(rels[0].base_id, 123)
+
+    def test_iter_aliases(self):
+        add_fetch_result([(0, 'val1', 0), (1, 'val2', 1)])
+
+        self.assertEqual(
+                list(datahog.alias.iter(self.p, 123, 4)),
+                [datahog.record.Alias(123, 4, u'val1', set()),
+                    datahog.record.Alias(123, 4, u'val2', set([1]))])
+
+    def test_search_names(self):
+        add_fetch_result([(123, 1, 'value1'), (124, 0, 'value2')])
+
+        names, token = datahog.name.search(self.p, 'value', 5)
+
+        self.assertEqual(names, [
+            datahog.record.Name(123, 5, 'value1', set([1])),
+            datahog.record.Name(124, 5, 'value2', set())])
+        self.assertEqual(token, 'value2')
+
+
+class DictDefaultTests(base.TestCase):
+    def test_default(self):
+        self.assertFalse(self.p.compact)
+
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT})
+        add_fetch_result([(0, 4)])
+
+        self.assertEqual(datahog.node.get(self.p, 123, 2),
+                {'id': 123, 'ctx': 2, 'value': 4, 'flags': set()})
+
+
+if __name__ == '__main__':
+    unittest.main()
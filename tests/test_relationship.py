@@ -6,6 +6,7 @@ import unittest
 
 import datahog
 from datahog import error
+from datahog.db import query
 import psycopg2
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -36,15 +37,17 @@ class RelationshipTests(base.TestCase):
             GET_CURSOR,
             EXECUTE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -61,15 +64,17 @@ returning 1
             GET_CURSOR,
             EXECUTE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and rel_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -95,15 +100,17 @@ returning 1
             GET_CURSOR,
             EXECUTE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -129,15 +136,17 @@ returning 1
             GET_CURSOR,
             EXECUTE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -154,15 +163,17 @@ returning 1
             GET_CURSOR,
             EXECUTE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and rel_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -189,15 +200,17 @@ returning 1
             GET_CURSOR,
             EXECUTE_FAILURE("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, (
-    select count(*)
+select %s, %s, %s, %s, coalesce((
+    select pos
     from relationship
     where
         time_removed is null
         and base_id=%s
         and ctx=%s
         and forward=%s
-), %s
+    order by pos desc
+    limit 1
+), 0) + 16777216, %s
 where exists (
     select 1
     from node
@@ -211,8 +224,8 @@ returning 1
             TPC_ROLLBACK])
 
     def test_create_with_positions(self):
-        add_fetch_result([(1,)])
-        add_fetch_result([(1,)])
+        add_fetch_result([(True, True)])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.relationship.create(self.p, 3, 123, 456, 4, 5),
@@ -229,23 +242,59 @@ with eligible as (
         time_removed is null
         and id=%s
         and ctx=%s
-), bump as (
-    update relationship
-    set pos=pos + 1
+), slot(pos) as (
+    select case
+        when hi is null then lo + 16777216
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %s = 0 then 0 else coalesce((
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ), (
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and base_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ) as hi
+    ) as neighbours
+), insertion as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select %s, %s, %s, %s, pos, %s
+    from slot
     where
         exists (select 1 from eligible)
-        and time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and pos >= %s
+        and pos is not null
+    returning 1
 )
-insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, %s, %s
-where exists (select 1 from eligible)
-returning 1
-""", (123, 1, True, 123, 3, 4, 123, 456, 3, True, 4, 0)),
-            ROWCOUNT,
+select exists (select 1 from eligible), exists (select 1 from insertion)
+""", (123, 1, 4, 123, 3, True, 3, 123, 3, True, 123, 3, True, 4,
+                123, 456, 3, True, 0)),
+            FETCH_ONE,
             TPC_PREPARE,
             RESET,
             GET_CURSOR,
@@ -257,23 +306,59 @@ with eligible as (
         time_removed is null
         and id=%s
         and ctx=%s
-), bump as (
-    update relationship
-    set pos=pos + 1
+), slot(pos) as (
+    select case
+        when hi is null then lo + 16777216
+        when hi - lo > 1 then lo + (hi - lo) / 2
+        end
+    from (
+        select case when %s = 0 then 0 else coalesce((
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and rel_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ), (
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and rel_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos desc
+            limit 1
+        ), 0) end as lo, (
+            select pos
+            from relationship
+            where
+                time_removed is null
+                and rel_id=%s
+                and ctx=%s
+                and forward=%s
+            order by pos asc
+            offset %s
+            limit 1
+        ) as hi
+    ) as neighbours
+), insertion as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select %s, %s, %s, %s, pos, %s
+    from slot
     where
         exists (select 1 from eligible)
-        and time_removed is null
-        and forward=%s
-        and rel_id=%s
-        and ctx=%s
-        and pos >= %s
+        and pos is not null
+    returning 1
 )
-insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
-select %s, %s, %s, %s, %s, %s
-where exists (select 1 from eligible)
-returning 1
-""", (456, 2, False, 456, 3, 5, 123, 456, 3, False, 5, 0)),
-            ROWCOUNT,
+select exists (select 1 from eligible), exists (select 1 from insertion)
+""", (456, 2, 5, 456, 3, False, 4, 456, 3, False, 456, 3, False,
+                5, 123, 456, 3, False, 0)),
+            FETCH_ONE,
             COMMIT,
             TPC_COMMIT])
 
@@ -306,6 +391,35 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter(self):
+        add_fetch_result([(456, 0, 0), (457, 0, 1), (458, 0, 2)])
+
+        self.assertEqual(
+                list(datahog.relationship.iter(self.p, 123, 3, start=0,
+                    fetch_size=5)),
+                [
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 456, 'flags': set([])},
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 457, 'flags': set([])},
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 458, 'flags': set([])},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select rel_id, flags, pos
+from relationship
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and pos >= %s
+order by pos asc
+""", (123, 3, True, 0)),
+            FETCH_MANY,
+            FETCH_MANY,
+            COMMIT])
+
     def test_list_reverse(self):
         add_fetch_result([(123, 0, 0), (124, 0, 1), (125, 0, 2), (126, 0, 3)])
 
@@ -385,6 +499,40 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_get_many(self):
+        datahog.set_flag(1, 3)
+        add_fetch_result([
+            (124, 3, 456, 1, 5 << 24),
+            (123, 3, 456, 0, 1 << 24)])
+
+        self.assertEqual(
+                datahog.relationship.get_many(self.p, [
+                    (3, 123, 456), (3, 123, 457), (3, 124, 456),
+                    (3, 123, 456)]),
+                ([
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 456,
+                        'flags': set([])},
+                    None,
+                    {'ctx': 3, 'base_id': 124, 'rel_id': 456,
+                        'flags': set([1])},
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 456,
+                        'flags': set([])},
+                ], [1 << 24, None, 5 << 24, 1 << 24]))
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select base_id, ctx, rel_id, flags, pos
+from relationship
+where
+    time_removed is null
+    and forward=true
+    and (base_id, ctx, rel_id) in (
+        select * from unnest(%s::bigint[], %s::smallint[], %s::bigint[]))
+""", ([123, 123, 124], [3, 3, 3], [456, 457, 456])),
+            FETCH_ALL,
+            COMMIT])
+
     def test_add_flags(self):
         datahog.set_flag(1, 3)
         datahog.set_flag(2, 3)
@@ -448,7 +596,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (5, True, 456, 3, 123)),
@@ -458,7 +606,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (5, False, 456, 3, 123)),
@@ -529,7 +677,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (3, True, 456, 3, 123)),
@@ -539,7 +687,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=flags & ~%s
+set flags=flags & ~%s::smallint
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (3, False, 456, 3, 123)),
@@ -564,7 +712,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (2, 5, True, 456, 3, 123)),
@@ -574,7 +722,7 @@ returning flags
             GET_CURSOR,
             EXECUTE("""
 update relationship
-set flags=(flags & ~%s) | %s
+set flags=(flags & ~%s::smallint) | %s
 where time_removed is null and forward=%s and rel_id=%s and ctx=%s and base_id=%s
 returning flags
 """, (2, 5, False, 456, 3, 123)),
@@ -583,7 +731,7 @@ returning flags
             TPC_COMMIT])
 
     def test_shift(self):
-        add_fetch_result([(True,)])
+        add_fetch_result([(True, True)])
 
         self.assertEqual(
                 datahog.relationship.shift(self.p, 123, 456, 3, True, 7),
@@ -591,49 +739,12 @@ returning flags
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from relationship
-    where
-        time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and rel_id=%s
-), bump as (
-    update relationship
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-    returning 1
-), move as (
-    update relationship
-    set pos=%s
-    where
-        time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and rel_id=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (True, 123, 3, 456, True, 123, 3, 7, 7, True, 123, 3, 456)),
+            EXECUTE(query._REORDERS['forward'], (123, 3, True, 456, 7, 123, 3, True, 456, 6, 123, 3, True, 456, 123, 3, True, 456, 7, 123, 3, True, 456)),
             FETCH_ONE,
             COMMIT])
 
     def test_shift_failure(self):
-        add_fetch_result([(False,)])
+        add_fetch_result([(False, False)])
 
         self.assertEqual(
                 datahog.relationship.shift(self.p, 123, 456, 3, True, 7),
@@ -641,44 +752,7 @@ select exists (select 1 from move)
 
         self.assertEqual(eventlog, [
             GET_CURSOR,
-            EXECUTE("""
-with oldpos as (
-    select pos
-    from relationship
-    where
-        time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and rel_id=%s
-), bump as (
-    update relationship
-    set pos=pos + (case
-        when (select pos from oldpos) < pos
-        then -1
-        else 1
-        end)
-    where
-        exists (select 1 from oldpos)
-        and time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and pos between symmetric (select pos from oldpos) and %s
-    returning 1
-), move as (
-    update relationship
-    set pos=%s
-    where
-        time_removed is null
-        and forward=%s
-        and base_id=%s
-        and ctx=%s
-        and rel_id=%s
-    returning 1
-)
-select exists (select 1 from move)
-""", (True, 123, 3, 456, True, 123, 3, 7, 7, True, 123, 3, 456)),
+            EXECUTE(query._REORDERS['forward'], (123, 3, True, 456, 7, 123, 3, True, 456, 6, 123, 3, True, 456, 123, 3, True, 456, 7, 123, 3, True, 456)),
             FETCH_ONE,
             COMMIT])
 
@@ -694,57 +768,29 @@ select exists (select 1 from move)
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and rel_id=%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, True, 456, 123, 3, True)),
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (123, 3, True, 456)),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and rel_id=%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and rel_id=%s
-        and ctx=%s
-        and forward=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, False, 456, 456, 3, False)),
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (123, 3, False, 456)),
             ROWCOUNT,
             COMMIT,
             TPC_COMMIT])
@@ -760,29 +806,15 @@ select 1 from removal
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and rel_id=%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, True, 456, 123, 3, True)),
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (123, 3, True, 456)),
             ROWCOUNT,
             TPC_ROLLBACK])
 
@@ -798,57 +830,29 @@ select 1 from removal
             TPC_BEGIN,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and rel_id=%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, True, 456, 123, 3, True)),
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (123, 3, True, 456)),
             ROWCOUNT,
             TPC_PREPARE,
             RESET,
             GET_CURSOR,
             EXECUTE("""
-with removal as (
-    update relationship
-    set time_removed=now()
-    where
-        time_removed is null
-        and base_id=%s
-        and ctx=%s
-        and forward=%s
-        and rel_id=%s
-    returning pos
-), bump as (
-    update relationship
-    set pos = pos - 1
-    where
-        exists (select 1 from removal)
-        and time_removed is null
-        and rel_id=%s
-        and ctx=%s
-        and forward=%s
-        and pos > (select pos from removal)
-)
-select 1 from removal
-""", (123, 3, False, 456, 456, 3, False)),
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (123, 3, False, 456)),
             ROWCOUNT,
             ROLLBACK,
             TPC_ROLLBACK])